@@ -1,17 +1,38 @@
+import signal
+import asyncio
+import hashlib
 import logging
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler,
+    Application, CommandHandler, MessageHandler, TypeHandler,
     CallbackQueryHandler, ConversationHandler, ContextTypes, filters
 )
 
-from config import BOT_TOKEN
-from ui import base_reply_markup, delete_all_bot_messages
-from cart_manager import add_to_cart, get_cart, replace_cart
+from config import (
+    BOT_TOKEN, PHOTO_PREWARM, MENU_BROWSE_MODE, DOMAIN, YOOKASSA_SHOP_ID, SHEETS_EXPORT_ENABLED,
+    UPDATE_CONCURRENCY, PERSISTENCE_FLUSH_SECONDS, BOT_MODE, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS
+)
+from ui import base_reply_markup, delete_all_bot_messages, track_message
+from cart_manager import add_to_cart, replace_cart
 from handlers import cart as cart_h
 from handlers import menu as menu_h
 from handlers import order as order_h
-from sheets_async import get_sheet_names
+from sheets_async import get_menu, refresh_loop, load_snapshot, on_menu_change
+import sheets_client
+import photo_cache
+import webhook_server
+from update_processor import OrderedUpdateProcessor
+from persistence import StatePersistence
+from state_store import create_store
+import sheets_async
+import memory_manager
+import payment
+import payment_tracker
+import timers
+import order_journal
+import sheets_export
+import operator_outbox
+import operator_board
 
 logging.basicConfig(level=logging.INFO)
 
@@ -32,12 +53,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['in_dishes'] = False
     context.user_data['in_checkout'] = False
 
-    await delete_all_bot_messages(context, chat_id)
+    await delete_all_bot_messages(context, chat_id, background=True)
     sent = await update.message.reply_text(
         "Добро пожаловать в доставку еды!\n\nВыберите действие:",
         reply_markup=base_reply_markup()
     )
-    context.user_data["message_ids"].append(sent.message_id)
+    track_message(context.user_data, sent)
 
 # -------------------- TEXT HANDLER --------------------
 
@@ -55,21 +76,21 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Назад к категориям
             context.user_data['in_dishes'] = False
             context.user_data['in_categories'] = True
-            await delete_all_bot_messages(context, chat_id)
-            cats = await get_sheet_names()
-            rows = [cats[i:i+2] for i in range(0, len(cats), 2)]
+            await delete_all_bot_messages(context, chat_id, background=True)
+            cats = (await get_menu()).categories
+            rows = [list(cats[i:i+2]) for i in range(0, len(cats), 2)]
             rows.append(["⬅️ Назад"])
             sent = await update.message.reply_text(
                 "Выберите категорию:",
                 reply_markup=ReplyKeyboardMarkup(rows, resize_keyboard=True)
             )
-            context.user_data["message_ids"].append(sent.message_id)
+            track_message(context.user_data, sent)
             return
         # Иначе — в главное
         context.user_data['in_categories'] = False
-        await delete_all_bot_messages(context, chat_id)
+        await delete_all_bot_messages(context, chat_id, background=True)
         sent = await update.message.reply_text("Выберите действие:", reply_markup=base_reply_markup())
-        context.user_data["message_ids"].append(sent.message_id)
+        track_message(context.user_data, sent)
         return
 
     # Меню
@@ -84,13 +105,13 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text == "🔁 Повторить заказ":
         from cart_manager import get_last_order
         items = get_last_order(update.effective_user.id)
-        await delete_all_bot_messages(context, chat_id)
+        await delete_all_bot_messages(context, chat_id, background=True)
         if not items:
             sent = await update.message.reply_text(
                 "Пока нечего повторять — оформите первый заказ 😊",
                 reply_markup=base_reply_markup()
             )
-            context.user_data.setdefault("message_ids", []).append(sent.message_id)
+            track_message(context.user_data, sent)
             return
         replace_cart(update.effective_user.id, items)
         # сразу показываем корзину
@@ -98,12 +119,12 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Контакты
     if text == "📞 Контакты":
-        await delete_all_bot_messages(context, chat_id)
+        await delete_all_bot_messages(context, chat_id, background=True)
         sent = await update.message.reply_text(
             "📞 Телефон для связи: +7 900 000-00-00",
             reply_markup=base_reply_markup()
         )
-        context.user_data["message_ids"].append(sent.message_id)
+        track_message(context.user_data, sent)
         return
 
     # Если мы в меню категорий — трактуем текст как выбор категории
@@ -121,30 +142,33 @@ async def inline_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         from handlers import order as order_h  # локальный импорт чтобы избежать циклов
         return await order_h.qr_inline_callbacks(update, context)
 
+    # Доска заказов в чате оператора: смена статуса
+    if data.startswith("board:"):
+        return await operator_board.on_callback(update, context)
+
+    # Листалка категории (◀️/▶️)
+    if data.startswith("pg:"):
+        return await menu_h.pager_callback(update, context)
+
     # Добавление позиции в корзину
     if data.startswith("add:"):
-        await query.answer()
         _, sheet_name, dish_id = data.split(":", 2)
 
-        # Найдём блюдо
-        from sheets_async import get_dishes_by_sheet
-        dishes = await get_dishes_by_sheet(sheet_name)
-        dish = next((item for item in dishes if str(item.get("ID")) == dish_id), None)
+        # Найдём блюдо в текущем снимке меню (поиск по индексу, без перебора)
+        dish = (await get_menu()).find_dish(sheet_name, dish_id)
         if dish:
-            name = dish.get("Название блюда", "Без названия")
-            price = dish.get("Цена", "0")
-            add_to_cart(query.from_user.id, {
-                "Название блюда": name,
-                "Цена": price,
-                "sheet_name": sheet_name,
-                "dish_id": dish_id
-            })
+            add_to_cart(query.from_user.id, dish)
+        if MENU_BROWSE_MODE == "pager":
+            # в листалке не плодим сообщения — хватает всплывающего уведомления
+            await query.answer("✅ Добавлено в корзину." if dish else "Блюдо не найдено")
+            return
+        await query.answer()
         sent = await query.message.reply_text("✅ Добавлено в корзину.", reply_markup=base_reply_markup())
-        context.user_data.setdefault("message_ids", []).append(sent.message_id)
+        track_message(context.user_data, sent)
         return
 
-    # Остальное (del/clear/back) — корзина
-    if data in ("clear", "back") or data.startswith("del:"):
+    # Остальное (inc/dec/del/clear/back) — корзина
+    if data in ("clear", "back") or data.startswith(("inc:", "dec:", "del:")):
         return await cart_h.inline_cart_handler(update, context)
 
     # data == "checkout" сюда НЕ попадёт — ConversationHandler перехватит
@@ -154,16 +178,165 @@ async def inline_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logging.exception("Unhandled exception while processing update: %s", update, exc_info=context.error)
 
+# -------------------- lifecycle --------------------
+
+_background_tasks = []
+
+async def _prewarm_photos(app: Application):
+    try:
+        await photo_cache.prewarm(app.bot, await get_menu())
+    except Exception:
+        logging.exception("Photo pre-warm failed")
+
+async def post_init(app: Application):
+    # фоновое обновление меню: пользователи не ждут Sheets после прогрева
+    _background_tasks.append(asyncio.create_task(refresh_loop()))
+    # выгрузка из памяти простаивающих пользователей
+    _background_tasks.append(asyncio.create_task(memory_manager.sweep_loop(app)))
+    # напоминания и авто-отмена QR-оплаты, в том числе поднятые с прошлого запуска
+    _background_tasks.append(timers.start(app))
+    if isinstance(app.update_processor, OrderedUpdateProcessor):
+        _background_tasks.append(asyncio.create_task(app.update_processor.log_stats_loop()))
+    # уведомления оператору: по порядку, с повторами, не задерживая оформление
+    _background_tasks.append(asyncio.create_task(operator_outbox.run(app)))
+    if operator_board.enabled():
+        _background_tasks.append(asyncio.create_task(operator_board.run(app)))
+    # онлайн-оплаты: уведомления ЮKassa и сверка заказов, по которым их не было
+    payment_tracker.attach(app)
+    if YOOKASSA_SHOP_ID:
+        _background_tasks.append(asyncio.create_task(payment_tracker.reconcile_loop()))
+    if SHEETS_EXPORT_ENABLED:
+        _background_tasks.append(asyncio.create_task(sheets_export.run()))
+    if PHOTO_PREWARM:
+        _background_tasks.append(asyncio.create_task(_prewarm_photos(app)))
+    _register_health(app)
+
+def _register_health(app: Application):
+    """Разделы /health (режим webhook): каждая подсистема отдаёт свой stats()."""
+    def menu_version():
+        menu = sheets_async.cached_menu()
+        return menu.version if menu else None
+
+    for name, provider in (
+        ("menu_version", menu_version),
+        ("updates", getattr(app.update_processor, "stats", lambda: None)),
+        ("memory", lambda: memory_manager.stats(app)),
+        ("payments", payment_tracker.stats),
+        ("timers", timers.stats),
+        ("orders", order_journal.stats),
+        ("sheets_export", sheets_export.stats),
+        ("operator_outbox", operator_outbox.stats),
+        ("operator_board", operator_board.stats),
+    ):
+        webhook_server.add_health_provider(name, provider)
+
+async def post_shutdown(app: Application):
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await timers.stop()
+    await sheets_export.stop()
+    await operator_outbox.stop()
+    await order_journal.close()
+    await payment.close()
+
+# -------------------- webhook --------------------
+
+def _webhook_secret() -> str:
+    # без явного секрета выводим его из токена: одинаковый у всех реплик и не угадывается
+    return WEBHOOK_SECRET or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:48]
+
+async def run_webhook(app: Application):
+    """
+    Режим webhook: Telegram сам шлёт апдейты на DOMAIN + WEBHOOK_PATH, встроенный
+    сервер кладёт их в очередь PTB. Несколько реплик можно поставить за балансировщик.
+    """
+    if not DOMAIN:
+        raise RuntimeError("BOT_MODE=webhook requires DOMAIN")
+    secret = _webhook_secret()
+    webhook_server.install_telegram_routes(app, WEBHOOK_PATH, secret)
+    payment_tracker.install_routes()
+    server = webhook_server.Server()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    await app.initialize()
+    try:
+        await post_init(app)
+        await app.start()
+        await server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+        await app.bot.set_webhook(
+            url=DOMAIN.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+        )
+        await stop.wait()
+    finally:
+        await server.stop()
+        if app.running:
+            await app.stop()
+        await post_shutdown(app)
+        await app.shutdown()
+
 # -------------------- main --------------------
 
 def main():
-    app = (
+    # ключ сервисного аккаунта и discovery-документ — один раз, до первого запроса
+    sheets_client.warm_up()
+    # последний удачный снимок меню с диска — первые пользователи не ждут Google
+    load_snapshot()
+    # file_id фото блюд с прошлых запусков; устаревшие сбрасываются при смене меню
+    photo_cache.load()
+    # онлайн-заказы, которые ещё ждали оплаты при остановке
+    payment_tracker.load()
+    timers.load()
+    # индексы заказов и счётчик номеров
+    order_journal.load()
+    # заказы, которые не успели уйти в таблицу до остановки
+    sheets_export.load()
+    # уведомления оператору, не доставленные до остановки
+    operator_outbox.load()
+    # доска активных заказов (OPERATOR_BOARD_MODE)
+    operator_board.load()
+    on_menu_change(photo_cache.sync_with_menu)
+
+    processor = OrderedUpdateProcessor()
+    builder = (
         Application.builder()
         .token(BOT_TOKEN)
-        .concurrent_updates(10)
-        .connection_pool_size(20)
-        .build()
+        # параллельно между пользователями, по порядку внутри одного пользователя
+        .concurrent_updates(processor)
+        .connection_pool_size(max(20, UPDATE_CONCURRENCY))  # каждому обработчику — своё соединение
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
     )
+    store = create_store()
+    persistence = None
+    if store is not None:
+        # корзины, user_data и шаги оформления переживают рестарт
+        persistence = StatePersistence(store, update_interval=PERSISTENCE_FLUSH_SECONDS)
+        builder = builder.persistence(persistence)
+    app = builder.build()
+    if persistence is not None:
+        persistence.attach(app)
+    if persistence is not None and persistence.shared:
+        # несколько процессов: состояние пользователя читается и пишется под его блокировкой,
+        # а меню из Sheets выбирает один процесс и делится снимком с остальными
+        processor.guard = persistence.guard
+        sheets_async.set_shared_store(store)
+        # онлайн-оплату может подтвердить любая реплика, на которую пришло уведомление
+        payment_tracker.set_shared_store(store)
+        if operator_board.enabled():
+            logging.warning("OPERATOR_BOARD_MODE with a shared state store: the board shows only this replica's orders")
 
     conv = ConversationHandler(
         entry_points=[CallbackQueryHandler(order_h.start_checkout, pattern="^checkout$")],
@@ -176,8 +349,11 @@ def main():
         },
         fallbacks=[MessageHandler(filters.Regex("^❌ Отмена$"), order_h.cancel_checkout_msg)],
         per_message=False,  # предупреждение от PTB — можно игнорировать
+        name="checkout",
+        persistent=persistence is not None,
     )
 
+    app.add_handler(TypeHandler(Update, memory_manager.on_update), group=-1)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(conv)
     app.add_handler(CallbackQueryHandler(inline_handler))
@@ -185,6 +361,9 @@ def main():
     app.add_error_handler(error_handler)
 
     print("Бот запущен...")
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+        return
     # сбрасываем накопившиеся апдейты, чтобы начать «с чистого листа»
     app.run_polling(drop_pending_updates=True)
 
@@ -1,31 +1,158 @@
-# Простая in-memory корзина на пользователя
-# !!! При рестарте процесса данные обнуляются (как и раньше).
+# Простая in-memory корзина на пользователя.
+# Если включено сохранение (PERSISTENCE_PATH), корзины и последние заказы переживают рестарт.
+# В корзине лежат ссылки на Dish из снимка меню (без копий строк таблицы).
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Tuple
+from menu_snapshot import Dish
 
-_carts = {}
-_last_orders = {}  # user_id -> list of items (последняя заказанная корзина)
+CartKey = Tuple[str, str]  # (лист, ID блюда)
 
-def add_to_cart(user_id: int, item: dict):
-    _carts.setdefault(user_id, [])
-    _carts[user_id].append(item)
+class Cart:
+    """
+    Позиции корзины по (лист, ID блюда) с количеством, в порядке добавления.
+    Сумма и число порций пересчитываются при каждом изменении, а не при отрисовке.
+    """
+    __slots__ = ("_lines", "total", "units")
 
-def get_cart(user_id: int):
-    return _carts.get(user_id, []).copy()
+    def __init__(self, items: Iterable[Tuple[Dish, int]] = ()):
+        self._lines: "OrderedDict[CartKey, List]" = OrderedDict()  # key -> [dish, qty]
+        self.total = 0  # в копейках
+        self.units = 0
+        for dish, qty in items:
+            self.add(dish, qty)
 
-def remove_from_cart(user_id: int, index: int):
-    if user_id in _carts and 0 <= index < len(_carts[user_id]):
-        _carts[user_id].pop(index)
+    def add(self, dish: Dish, qty: int = 1):
+        line = self._lines.get(dish.key)
+        if line is None:
+            self._lines[dish.key] = [dish, qty]
+        else:
+            # блюдо могло прийти из более свежего снимка меню — пересчитываем по новой цене
+            self.total += (dish.price - line[0].price) * line[1]
+            line[0] = dish
+            line[1] += qty
+        self.total += dish.price * qty
+        self.units += qty
+
+    def inc(self, key: CartKey) -> int:
+        """+1 порция уже лежащего в корзине блюда; возвращает новое количество (0 — блюда нет)."""
+        line = self._lines.get(key)
+        if line is None:
+            return 0
+        line[1] += 1
+        self.total += line[0].price
+        self.units += 1
+        return line[1]
+
+    def dec(self, key: CartKey) -> int:
+        """−1 порция; последняя порция убирает позицию. Возвращает оставшееся количество."""
+        line = self._lines.get(key)
+        if line is None:
+            return 0
+        line[1] -= 1
+        self.total -= line[0].price
+        self.units -= 1
+        if line[1] <= 0:
+            del self._lines[key]
+            return 0
+        return line[1]
+
+    def remove(self, key: CartKey):
+        """Убирает позицию целиком."""
+        line = self._lines.pop(key, None)
+        if line is not None:
+            self.total -= line[0].price * line[1]
+            self.units -= line[1]
+
+    def lines(self) -> Iterator[Tuple[Dish, int]]:
+        for dish, qty in self._lines.values():
+            yield dish, qty
+
+    def snapshot(self) -> Tuple[Tuple[Dish, int], ...]:
+        """Неизменяемый слепок позиций (для «последнего заказа»)."""
+        return tuple((dish, qty) for dish, qty in self._lines.values())
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def __bool__(self) -> bool:
+        return bool(self._lines)
+
+_EMPTY = Cart()
+
+_carts: Dict[int, Cart] = {}
+_last_orders: Dict[int, Tuple[Tuple[Dish, int], ...]] = {}  # user_id -> позиции последнего заказа
+
+def add_to_cart(user_id: int, dish: Dish):
+    cart = _carts.get(user_id)
+    if cart is None:
+        cart = _carts[user_id] = Cart()
+    cart.add(dish)
+
+def get_cart(user_id: int) -> Cart:
+    """Корзина пользователя без копирования — менять её только через функции модуля."""
+    return _carts.get(user_id, _EMPTY)
+
+def inc_item(user_id: int, sheet_name: str, dish_id: str) -> int:
+    cart = _carts.get(user_id)
+    return cart.inc((sheet_name, dish_id)) if cart else 0
+
+def remove_one(user_id: int, sheet_name: str, dish_id: str) -> int:
+    """Убирает одну порцию блюда."""
+    cart = _carts.get(user_id)
+    return cart.dec((sheet_name, dish_id)) if cart else 0
+
+def remove_item(user_id: int, sheet_name: str, dish_id: str):
+    """Убирает блюдо из корзины целиком."""
+    cart = _carts.get(user_id)
+    if cart:
+        cart.remove((sheet_name, dish_id))
 
 def clear_cart(user_id: int):
-    _carts[user_id] = []
+    _carts.pop(user_id, None)
 
-def replace_cart(user_id: int, items: list):
-    _carts[user_id] = items.copy()
+def replace_cart(user_id: int, items: Iterable[Tuple[Dish, int]]):
+    _carts[user_id] = Cart(items)
 
 # --- Последний заказ ---
 
-def set_last_order(user_id: int, items: list):
-    # сохраняем копию, чтобы не зависеть от дальнейших мутаций
-    _last_orders[user_id] = [dict(x) for x in items]
+def set_last_order(user_id: int, cart: Cart):
+    # Dish неизменяемы, слепок — кортеж: отдаётся без копирования
+    _last_orders[user_id] = cart.snapshot()
+
+def get_last_order(user_id: int) -> Tuple[Tuple[Dish, int], ...]:
+    return _last_orders.get(user_id, ())
+
+# --- Сохранение на диск (persistence.py) ---
+
+def dump_user(user_id: int) -> Tuple[list, list]:
+    """Корзина и последний заказ пользователя в виде JSON-совместимых списков."""
+    cart = _carts.get(user_id)
+    cart_rows = [[list(d.as_tuple()), qty] for d, qty in cart.lines()] if cart else []
+    last_rows = [[list(d.as_tuple()), qty] for d, qty in _last_orders.get(user_id, ())]
+    return cart_rows, last_rows
+
+def restore_user(user_id: int, cart_rows: list, last_rows: list, replace: bool = False):
+    """
+    Поднимает состояние из хранилища. По умолчанию то, что уже появилось в памяти,
+    не перетирается; replace=True — хранилище главнее (общее для нескольких процессов).
+    """
+    if replace:
+        _carts.pop(user_id, None)
+        _last_orders.pop(user_id, None)
+    if cart_rows and user_id not in _carts:
+        _carts[user_id] = Cart((Dish(*d), qty) for d, qty in cart_rows)
+    if last_rows and user_id not in _last_orders:
+        _last_orders[user_id] = tuple((Dish(*d), qty) for d, qty in last_rows)
+
+def forget_user(user_id: int):
+    """Выгрузка из памяти (memory_manager); на диске состояние остаётся."""
+    _carts.pop(user_id, None)
+    _last_orders.pop(user_id, None)
+
+def user_lines(user_id: int) -> int:
+    """Сколько позиций пользователя (корзина + последний заказ) лежит в памяти."""
+    cart = _carts.get(user_id)
+    return (len(cart) if cart else 0) + len(_last_orders.get(user_id, ()))
 
-def get_last_order(user_id: int):
-    return [dict(x) for x in _last_orders.get(user_id, [])]
+def counts() -> dict:
+    return {"carts": len(_carts), "last_orders": len(_last_orders)}
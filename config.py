@@ -9,6 +9,9 @@ def _getenv(name: str, *, required: bool, cast=None, default=None):
         return default
     return cast(raw) if cast else raw
 
+def _bool(raw: str) -> bool:
+    return raw.strip().lower() in ("1", "true", "yes", "on")
+
 # === Telegram / Sheets ===
 BOT_TOKEN        = _getenv("BOT_TOKEN",        required=True)
 OPERATOR_CHAT_ID = _getenv("OPERATOR_CHAT_ID", required=True, cast=int)
@@ -18,14 +21,135 @@ SPREADSHEET_ID   = _getenv("SPREADSHEET_ID",   required=True)
 YOOKASSA_SHOP_ID = _getenv("YOOKASSA_SHOP_ID", required=False)
 YOOKASSA_API_KEY = _getenv("YOOKASSA_API_KEY", required=False)
 DOMAIN           = _getenv("DOMAIN",           required=False)
+# Другой адрес API — например, локальная заглушка ЮKassa для тестов
+YOOKASSA_API_URL = _getenv("YOOKASSA_API_URL", required=False, default="https://api.yookassa.ru/v3/")
+YOOKASSA_TIMEOUT_SECONDS = _getenv("YOOKASSA_TIMEOUT_SECONDS", required=False, cast=float, default=10)
+YOOKASSA_MAX_RETRIES     = _getenv("YOOKASSA_MAX_RETRIES",     required=False, cast=int, default=3)
+# Уведомления о платежах приходят на встроенный сервер (BOT_MODE=webhook) по DOMAIN + YOOKASSA_NOTIFY_PATH
+YOOKASSA_NOTIFY_PATH     = _getenv("YOOKASSA_NOTIFY_PATH",     required=False, default="/yookassa")
+# Адреса ЮKassa, с которых принимаются уведомления; "*" — с любых (локальная заглушка)
+YOOKASSA_NOTIFY_ALLOWLIST = _getenv("YOOKASSA_NOTIFY_ALLOWLIST", required=False, default=(
+    "185.71.76.0/27,185.71.77.0/27,77.75.153.0/25,77.75.156.11,77.75.156.35,77.75.154.128/25,2a02:5180::/32"
+))
+# Как часто сверять неоплаченные заказы списком платежей (на случай потерянных уведомлений)
+YOOKASSA_RECONCILE_SECONDS = _getenv("YOOKASSA_RECONCILE_SECONDS", required=False, cast=int, default=300)
+# Сколько ждать оплаты: старше — последняя проверка платежа и снятие с ожидания (ЮKassa к этому времени его отменяет)
+YOOKASSA_PAYMENT_TTL_SECONDS = _getenv("YOOKASSA_PAYMENT_TTL_SECONDS", required=False, cast=int, default=86400)
+PAYMENTS_DB_PATH         = _getenv("PAYMENTS_DB_PATH",         required=False, default="payments.sqlite3")
+
+# === Режим приёма апдейтов ===
+# polling — long polling (по умолчанию); webhook — встроенный HTTP-сервер, DOMAIN обязателен
+BOT_MODE         = _getenv("BOT_MODE",         required=False, default="polling")
+WEBHOOK_HOST     = _getenv("WEBHOOK_HOST",     required=False, default="0.0.0.0")
+WEBHOOK_PORT     = _getenv("WEBHOOK_PORT",     required=False, cast=int, default=_getenv("PORT", required=False, cast=int, default=8080))
+WEBHOOK_PATH     = _getenv("WEBHOOK_PATH",     required=False, default="/telegram")
+# Секрет для X-Telegram-Bot-Api-Secret-Token; у всех реплик за балансировщиком должен совпадать
+WEBHOOK_SECRET   = _getenv("WEBHOOK_SECRET",   required=False)
+WEBHOOK_MAX_CONNECTIONS = _getenv("WEBHOOK_MAX_CONNECTIONS", required=False, cast=int, default=40)
+# Балансировщики перед сервером (адреса/подсети через запятую): только от них принимается
+# X-Forwarded-For. Пусто — заголовок игнорируется; "*" — доверять любому соседу (Heroku и т.п.)
+WEBHOOK_TRUSTED_PROXIES = _getenv("WEBHOOK_TRUSTED_PROXIES", required=False, default="")
+
+# === Обработка апдейтов ===
+UPDATE_CONCURRENCY          = _getenv("UPDATE_CONCURRENCY",          required=False, cast=int, default=32)  # разных пользователей одновременно
+UPDATE_MAX_PENDING_PER_USER = _getenv("UPDATE_MAX_PENDING_PER_USER", required=False, cast=int, default=8)   # дальше нажатия кнопок отбрасываются
+
+# === Сохранение состояния пользователей (корзины, user_data, оформление заказа) ===
+# sqlite — файл PERSISTENCE_PATH (один процесс); redis — общее для нескольких процессов; memory — без сохранения
+# С redis общими становятся состояние пользователей, снимок меню и ожидающие онлайн-оплаты.
+# Журнал заказов, QR-таймеры, outbox и доска остаются у каждой реплики свои: QR-напоминание
+# срабатывает на реплике, где начато оформление, а доска видит только её заказы —
+# при нескольких репликах держите OPERATOR_BOARD_MODE=off
+STATE_BACKEND               = _getenv("STATE_BACKEND",               required=False, default="sqlite")
+REDIS_URL                   = _getenv("REDIS_URL",                   required=False, default="redis://localhost:6379/0")
+STATE_KEY_PREFIX            = _getenv("STATE_KEY_PREFIX",            required=False, default="tfb:")
+STATE_LOCK_TIMEOUT_SECONDS  = _getenv("STATE_LOCK_TIMEOUT_SECONDS",  required=False, cast=float, default=30)
+PERSISTENCE_PATH            = _getenv("PERSISTENCE_PATH",            required=False, default="bot_state.sqlite3")  # пусто — только в памяти
+PERSISTENCE_FLUSH_SECONDS   = _getenv("PERSISTENCE_FLUSH_SECONDS",   required=False, cast=float, default=5)
+
+# === Память процесса ===
+MEMORY_IDLE_TTL_SECONDS = _getenv("MEMORY_IDLE_TTL_SECONDS", required=False, cast=int, default=6 * 3600)  # выгружать простаивающих дольше
+MEMORY_BUDGET_MB        = _getenv("MEMORY_BUDGET_MB",        required=False, cast=int, default=0)  # 0 — без бюджета, только TTL
+MEMORY_SWEEP_SECONDS    = _getenv("MEMORY_SWEEP_SECONDS",    required=False, cast=int, default=60)
+MESSAGE_IDS_MAX         = _getenv("MESSAGE_IDS_MAX",         required=False, cast=int, default=100)  # id сообщений бота на пользователя
+
+# === Уведомления оператору ===
+OUTBOX_DB_PATH      = _getenv("OUTBOX_DB_PATH",      required=False, default="outbox.sqlite3")  # пусто — очередь только в памяти
+OUTBOX_MAX_ATTEMPTS = _getenv("OUTBOX_MAX_ATTEMPTS", required=False, cast=int, default=5)  # дальше — dead-letter; 5 попыток держат очередь ~25 с
+# Доска активных заказов в чате оператора: off — только сообщения о заказах; board — только доска; both — и то и другое
+OPERATOR_BOARD_MODE         = _getenv("OPERATOR_BOARD_MODE",         required=False, default="off")
+OPERATOR_BOARD_EDIT_SECONDS = _getenv("OPERATOR_BOARD_EDIT_SECONDS", required=False, cast=float, default=1.0)  # не чаще одной правки
+OPERATOR_BOARD_STATE_PATH   = _getenv("OPERATOR_BOARD_STATE_PATH",   required=False, default="operator_board.json")  # id сообщений доски
+
+# === Журнал заказов ===
+ORDER_JOURNAL_DIR            = _getenv("ORDER_JOURNAL_DIR",            required=False, default="orders")  # пусто — только в памяти
+ORDER_JOURNAL_SEGMENT_MB     = _getenv("ORDER_JOURNAL_SEGMENT_MB",     required=False, cast=int, default=8)
+ORDER_JOURNAL_MAX_SEGMENTS   = _getenv("ORDER_JOURNAL_MAX_SEGMENTS",   required=False, cast=int, default=4)  # больше — сжать старые
+ORDER_JOURNAL_RETENTION_DAYS = _getenv("ORDER_JOURNAL_RETENTION_DAYS", required=False, cast=int, default=180)  # 0 — хранить всё
+# Метка процесса в номере заказа: у нескольких реплик с общим STATE_BACKEND=redis должна различаться
+ORDER_ID_NODE                = _getenv("ORDER_ID_NODE",                required=False, default="")
+# метка идёт в номер заказа и в callback_data кнопок доски — только буквы и цифры
+if ORDER_ID_NODE and not (ORDER_ID_NODE.isascii() and ORDER_ID_NODE.isalnum() and len(ORDER_ID_NODE) <= 8):
+    raise RuntimeError("ORDER_ID_NODE must be 1-8 latin letters or digits")
 
 # === QR ===
 QR_IMAGE_URL          = _getenv("QR_IMAGE_URL",          required=True)
 QR_REMINDER_MINUTES   = _getenv("QR_REMINDER_MINUTES",   required=False, cast=int, default=10)
 QR_CANCEL_MINUTES     = _getenv("QR_CANCEL_MINUTES",     required=False, cast=int, default=30)
+TIMERS_DB_PATH        = _getenv("TIMERS_DB_PATH",        required=False, default="timers.sqlite3")  # сроки напоминаний; пусто — только в памяти
+TIMERS_FIRE_CONCURRENCY = _getenv("TIMERS_FIRE_CONCURRENCY", required=False, cast=int, default=4)  # пачек таймеров в обработке одновременно
 
 # === Кэш меню / блюд ===
 SHEETS_CACHE_TTL_SECONDS = _getenv("SHEETS_CACHE_TTL_SECONDS", required=False, cast=int, default=600)
+# Сколько устаревшее меню ещё можно отдавать, пока в фоне идёт обновление
+SHEETS_CACHE_MAX_STALE_SECONDS = _getenv("SHEETS_CACHE_MAX_STALE_SECONDS", required=False, cast=int, default=3600)
+# Последний удачный снимок меню на диске (пустое значение — не сохранять)
+MENU_SNAPSHOT_PATH = _getenv("MENU_SNAPSHOT_PATH", required=False, default="menu_snapshot.sqlite3")
+SHEETS_BREAKER_FAILURES = _getenv("SHEETS_BREAKER_FAILURES", required=False, cast=int, default=3)
+SHEETS_BREAKER_COOLDOWN_SECONDS = _getenv("SHEETS_BREAKER_COOLDOWN_SECONDS", required=False, cast=int, default=60)
+
+# === Клиент Google Sheets ===
+SHEETS_HTTP_POOL_SIZE   = _getenv("SHEETS_HTTP_POOL_SIZE",   required=False, cast=int, default=4)
+SHEETS_HTTP_TIMEOUT_SECONDS = _getenv("SHEETS_HTTP_TIMEOUT_SECONDS", required=False, cast=int, default=15)
+SHEETS_HTTP_POOL_WAIT_SECONDS = _getenv("SHEETS_HTTP_POOL_WAIT_SECONDS", required=False, cast=int, default=30)  # дольше ждать свободный сервис — ошибка
+SHEETS_TOKEN_REFRESH_MARGIN_SECONDS = _getenv("SHEETS_TOKEN_REFRESH_MARGIN_SECONDS", required=False, cast=int, default=300)
+# Большие листы читаются кусками; в один batchGet идёт не больше SHEETS_BATCH_CELLS клеток
+SHEETS_CHUNK_ROWS       = _getenv("SHEETS_CHUNK_ROWS",       required=False, cast=int, default=5000)
+SHEETS_BATCH_CELLS      = _getenv("SHEETS_BATCH_CELLS",      required=False, cast=int, default=500000)
+SHEETS_REPLAY_FILE      = _getenv("SHEETS_REPLAY_FILE",      required=False)  # записанные ответы вместо сети (офлайн-замеры)
+
+# === Выгрузка заказов в таблицу ===
+# Включение переводит доступ к Sheets с «только чтение» на чтение и запись
+SHEETS_EXPORT_ENABLED        = _getenv("SHEETS_EXPORT_ENABLED",        required=False, cast=_bool, default=False)
+SHEETS_EXPORT_SPREADSHEET_ID = _getenv("SHEETS_EXPORT_SPREADSHEET_ID", required=False, default=SPREADSHEET_ID)
+SHEETS_EXPORT_SHEET          = _getenv("SHEETS_EXPORT_SHEET",          required=False, default="Заказы")
+SHEETS_EXPORT_BATCH          = _getenv("SHEETS_EXPORT_BATCH",          required=False, cast=int, default=50)  # строк в одном values.append
+SHEETS_EXPORT_FLUSH_SECONDS  = _getenv("SHEETS_EXPORT_FLUSH_SECONDS",  required=False, cast=float, default=10)  # не дольше ждать добора пачки
+# Очередь на диске на время недоступности Sheets (пусто — только в памяти)
+SHEETS_EXPORT_SPOOL_PATH     = _getenv("SHEETS_EXPORT_SPOOL_PATH",     required=False, default="sheets_export.jsonl")
+
+# === Показ категорий ===
+# cards — каждое блюдо отдельным сообщением; pager — одна карточка с ◀️/▶️, правится на месте
+MENU_BROWSE_MODE = _getenv("MENU_BROWSE_MODE", required=False, default="cards")
+
+# === Корзина ===
+CART_EDIT_DEBOUNCE_MS = _getenv("CART_EDIT_DEBOUNCE_MS", required=False, cast=int, default=300)  # окно схлопывания нажатий
+
+# === Кэш file_id фотографий блюд ===
+PHOTO_CACHE_PATH = _getenv("PHOTO_CACHE_PATH", required=False, default="photo_cache.sqlite3")
+PHOTO_PREWARM    = _getenv("PHOTO_PREWARM",    required=False, cast=_bool, default=False)  # загрузить все фото в чат оператора при старте
+
+# === Очистка чата ===
+DELETE_CONCURRENCY = _getenv("DELETE_CONCURRENCY", required=False, cast=int, default=8)  # одиночные delete_message одновременно
+
+# === Лимиты отправки Telegram (сообщений в секунду / размер всплеска) ===
+SEND_GLOBAL_RATE    = _getenv("SEND_GLOBAL_RATE",    required=False, cast=float, default=30.0)
+SEND_GLOBAL_BURST   = _getenv("SEND_GLOBAL_BURST",   required=False, cast=int,   default=30)
+SEND_PER_CHAT_RATE  = _getenv("SEND_PER_CHAT_RATE",  required=False, cast=float, default=1.0)
+SEND_PER_CHAT_BURST = _getenv("SEND_PER_CHAT_BURST", required=False, cast=int,   default=30)
+SEND_PIPELINE_DEPTH = _getenv("SEND_PIPELINE_DEPTH", required=False, cast=int,   default=3)  # запросов в полёте на чат
+SEND_STAGGER_MS     = _getenv("SEND_STAGGER_MS",     required=False, cast=int,   default=80)  # зазор между стартами запросов в чат
+SEND_MAX_RETRIES    = _getenv("SEND_MAX_RETRIES",    required=False, cast=int,   default=3)
 
 # === Ограничения оплаты по времени (МСК) ===
 MSK_TZ            = _getenv("MSK_TZ",            required=False, default="Europe/Moscow")
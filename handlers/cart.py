@@ -1,6 +1,14 @@
+import json
+import time
+import asyncio
+from typing import Dict
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-from cart_manager import get_cart, remove_from_cart, clear_cart
-from ui import base_reply_markup, delete_all_bot_messages
+from telegram.error import BadRequest
+from config import CART_EDIT_DEBOUNCE_MS
+from cart_manager import get_cart, inc_item, remove_one, remove_item, clear_cart
+from ui import base_reply_markup, delete_all_bot_messages, track_message
+from menu_snapshot import format_price
+from persistence import user_session
 
 def build_cart_view(user_id: int):
     """
@@ -10,25 +18,17 @@ def build_cart_view(user_id: int):
     if not cart:
         return "🛒 Ваша корзина пуста.", None
 
-    # Группируем по листу и ID блюда
-    grouped = {}
-    for item in cart:
-        sheet = item.get("sheet_name")
-        d_id = str(item.get("dish_id"))
-        name = item.get("Название блюда", "Без названия")
-        price = int(item.get("Цена", 0))
-        key = (sheet, d_id, name, price)
-        grouped.setdefault(key, 0)
-        grouped[key] += 1
-
     lines = []
     buttons = []
-    for (sheet, d_id, name, price), count in grouped.items():
-        total = count * price
-        lines.append(f"{count} X {name} — {price}₽ = {total}₽")
+    for dish, count in cart.lines():
+        lines.append(f"{count} X {dish.name} — {format_price(dish.price)}₽ = {format_price(count * dish.price)}₽")
+        key = f"{dish.sheet}:{dish.id}"
         buttons.append([
-            InlineKeyboardButton(f"❌ Удалить {name}", callback_data=f"del:{sheet}:{d_id}")
+            InlineKeyboardButton("➖", callback_data=f"dec:{key}"),
+            InlineKeyboardButton(f"❌ {dish.name}", callback_data=f"del:{key}"),
+            InlineKeyboardButton("➕", callback_data=f"inc:{key}"),
         ])
+    lines.append(f"\n💰 Итого: {format_price(cart.total)}₽")
 
     # Очистка/Оформление/Назад
     buttons.append([
@@ -41,21 +41,88 @@ def build_cart_view(user_id: int):
 
     return "\n".join(lines), InlineKeyboardMarkup(buttons)
 
+def _render_key(text: str, markup) -> tuple:
+    """Отпечаток отрисованной корзины: если он не изменился, править сообщение незачем."""
+    return (text, json.dumps(markup.to_dict(), sort_keys=True, ensure_ascii=False) if markup else None)
+
 async def show_cart_message(update, context):
     """
     Удобный помощник — очищает чат и показывает корзину.
     """
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    await delete_all_bot_messages(context, chat_id)
+    await delete_all_bot_messages(context, chat_id, background=True)
 
     text, markup = build_cart_view(user_id)
     sent = await update.message.reply_text(text, reply_markup=markup or base_reply_markup(), parse_mode="HTML")
-    context.user_data.setdefault("message_ids", []).append(sent.message_id)
+    track_message(context.user_data, sent)
+    # дальше эта корзина правится на месте
+    context.user_data["cart_message_id"] = sent.message_id
+    context.user_data["cart_render"] = list(_render_key(text, markup))
+
+async def _refresh_cart_message(bot, ud: dict, chat_id: int, user_id: int, message_id: int):
+    """
+    Правит сообщение корзины под текущее состояние одним вызовом API (или ни одним,
+    если отрисовка не изменилась). Если сообщения уже нет — присылает новое.
+    """
+    text, markup = build_cart_view(user_id)
+    key = _render_key(text, markup)
+    old = ud.get("cart_render")
+    if ud.get("cart_message_id") == message_id and old is not None and tuple(old) == key:
+        return
+    try:
+        if old is not None and old[0] == text and ud.get("cart_message_id") == message_id:
+            await bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
+        else:
+            await bot.edit_message_text(text, chat_id, message_id, reply_markup=markup, parse_mode="HTML")
+    except BadRequest as e:
+        err = str(e).lower()
+        if "not modified" not in err:
+            if "not found" not in err and "can't be edited" not in err:
+                raise
+            sent = await bot.send_message(chat_id, text, reply_markup=markup or base_reply_markup(), parse_mode="HTML")
+            track_message(ud, sent)
+            message_id = sent.message_id
+    ud["cart_message_id"] = message_id
+    ud["cart_render"] = list(key)
+
+# Частые нажатия схлопываются: первое правит корзину сразу, а все нажатия в течение
+# CART_EDIT_DEBOUNCE_MS после правки — одной отложенной правкой в конце окна
+_last_edit: Dict[int, float] = {}  # user_id -> time.monotonic() последней правки
+_pending_refresh: Dict[int, "asyncio.Task"] = {}
+
+async def _trailing_refresh(app, chat_id: int, user_id: int, message_id: int, delay: float):
+    try:
+        await asyncio.sleep(delay)
+    finally:
+        _pending_refresh.pop(user_id, None)
+    _last_edit[user_id] = time.monotonic()
+    # вне апдейта: cart_message_id/cart_render сохраняются так же, как после обработчика
+    async with user_session(app, user_id) as ud:
+        await _refresh_cart_message(app.bot, ud, chat_id, user_id, message_id)
+
+async def _refresh(context, chat_id: int, user_id: int, message_id: int):
+    """Правка корзины после нажатия: сразу, если окно свободно, иначе — в конце окна."""
+    if user_id in _pending_refresh:
+        return  # отложенная правка отрисует состояние после всех нажатий
+    window = CART_EDIT_DEBOUNCE_MS / 1000
+    now = time.monotonic()
+    wait = _last_edit.get(user_id, 0.0) + window - now
+    if wait > 0:
+        _pending_refresh[user_id] = context.application.create_task(
+            _trailing_refresh(context.application, chat_id, user_id, message_id, wait)
+        )
+        return
+    if len(_last_edit) > 10000:
+        # давние правки ничего не ограничивают — их можно забыть
+        for uid in [u for u, ts in _last_edit.items() if ts + window <= now]:
+            del _last_edit[uid]
+    _last_edit[user_id] = now
+    await _refresh_cart_message(context.bot, context.user_data, chat_id, user_id, message_id)
 
 async def inline_cart_handler(update, context):
     """
-    Обрабатывает inline-кнопки корзины: del:/clear/back.
+    Обрабатывает inline-кнопки корзины: inc:/dec:/del:/clear/back.
     """
     query = update.callback_query
     await query.answer()
@@ -64,25 +131,23 @@ async def inline_cart_handler(update, context):
     data = query.data
 
     # Подкорректировать состав
-    if data.startswith("del:"):
-        _, sheet_name, dish_id = data.split(":", 2)
-        cart = get_cart(user_id)
-        for idx, item in enumerate(cart):
-            if item.get("sheet_name") == sheet_name and str(item.get("dish_id")) == dish_id:
-                remove_from_cart(user_id, idx)
-                break
+    if data.startswith(("inc:", "dec:", "del:")):
+        op, sheet_name, dish_id = data.split(":", 2)
+        if op == "inc":
+            inc_item(user_id, sheet_name, dish_id)
+        elif op == "dec":
+            remove_one(user_id, sheet_name, dish_id)
+        else:
+            remove_item(user_id, sheet_name, dish_id)
 
     elif data == "clear":
         clear_cart(user_id)
 
     elif data == "back":
-        await delete_all_bot_messages(context, chat_id)
+        await delete_all_bot_messages(context, chat_id, background=True)
         sent = await context.bot.send_message(chat_id, "Выберите действие:", reply_markup=base_reply_markup())
-        context.user_data.setdefault("message_ids", []).append(sent.message_id)
+        track_message(context.user_data, sent)
         return
 
-    # Показать актуальную корзину
-    await delete_all_bot_messages(context, chat_id)
-    text, markup = build_cart_view(user_id)
-    sent = await context.bot.send_message(chat_id, text, reply_markup=markup or base_reply_markup(), parse_mode="HTML")
-    context.user_data.setdefault("message_ids", []).append(sent.message_id)
+    # Показать актуальную корзину — правкой того же сообщения, а не удалением и новой отправкой
+    await _refresh(context, chat_id, user_id, query.message.message_id)
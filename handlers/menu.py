@@ -1,60 +1,149 @@
-from telegram import ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
-from ui import delete_all_bot_messages
-from sheets_async import get_sheet_names, get_dishes_by_sheet
+from functools import partial
+from telegram import ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from telegram.error import BadRequest
+from config import MENU_BROWSE_MODE
+from ui import delete_all_bot_messages, track_message
+from sheets_async import get_menu
+from menu_snapshot import format_price
+from sender import send_ordered
+import photo_cache
 
 async def show_categories(update, context):
     chat_id = update.effective_chat.id
-    await delete_all_bot_messages(context, chat_id)
+    await delete_all_bot_messages(context, chat_id, background=True)
 
-    cats = await get_sheet_names()
-    rows = [cats[i:i+2] for i in range(0, len(cats), 2)]
+    cats = (await get_menu()).categories
+    rows = [list(cats[i:i+2]) for i in range(0, len(cats), 2)]
     rows.append(["⬅️ Назад"])
     sent = await update.message.reply_text(
         "Выберите категорию:",
         reply_markup=ReplyKeyboardMarkup(rows, resize_keyboard=True)
     )
-    context.user_data["message_ids"].append(sent.message_id)
+    track_message(context.user_data, sent)
     context.user_data['in_categories'] = True
     context.user_data['in_dishes'] = False
 
+def _dish_caption(d) -> str:
+    return f"<b>{d.name}</b> — {format_price(d.price)} ₽\n{d.grams}\n{d.description}"
+
+def _has_photo(d) -> bool:
+    return d.photo.startswith("http")
+
+def _dish_card_request(bot, chat_id: int, sheet_name: str, d):
+    """Отложенный запрос на отправку карточки блюда (для конвейерной отправки)."""
+    caption = _dish_caption(d)
+    cb_data = f"add:{sheet_name}:{d.id}"
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("➕ Добавить в корзину", callback_data=cb_data)]])
+    if _has_photo(d):
+        # повторные показы уходят по file_id из кэша — Telegram не качает картинку заново
+        return partial(photo_cache.send_photo, bot, chat_id, d.photo, d.photo_version,
+                       caption=caption, parse_mode="HTML", reply_markup=kb)
+    return partial(bot.send_message, chat_id, caption, parse_mode="HTML", reply_markup=kb)
+
 async def show_dishes_for_text(update, context, text):
     """
     Реакция на выбор категории (текстом) — ищем лист, показываем блюда.
     """
     chat_id = update.effective_chat.id
-    sheet_names = await get_sheet_names()
-
-    if text in sheet_names:
-        sheet_name = text
-    else:
-        matches = [name for name in sheet_names if name.endswith(text)]
-        sheet_name = matches[0] if matches else None
+    menu = await get_menu()
+    sheet_name = menu.resolve_category(text)
 
     if not sheet_name:
         return  # игнорируем незнакомый текст
 
-    await delete_all_bot_messages(context, chat_id)
+    await delete_all_bot_messages(context, chat_id, background=True)
     context.user_data['in_categories'] = False
     context.user_data['in_dishes'] = True
 
-    dishes = await get_dishes_by_sheet(sheet_name)
-    for d in dishes:
-        dish_id = d.get("ID")
-        name = d.get("Название блюда", "Без названия")
-        price = d.get("Цена", "0")
-        grams = d.get("Граммы", "")
-        desc = d.get("Описание", "")
-        photo = d.get("Ссылка на изображение", "")
-        caption = f"<b>{name}</b> — {price} ₽\n{grams}\n{desc}"
-        cb_data = f"add:{sheet_name}:{dish_id}"
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("➕ Добавить в корзину", callback_data=cb_data)]])
-        if str(photo).startswith("http"):
-            sent = await context.bot.send_photo(chat_id, photo=photo, caption=caption, parse_mode="HTML", reply_markup=kb)
-        else:
-            sent = await context.bot.send_message(chat_id, caption, parse_mode="HTML", reply_markup=kb)
-        context.user_data["message_ids"].append(sent.message_id)
+    if MENU_BROWSE_MODE == "pager":
+        return await _show_pager(context, chat_id, sheet_name, menu)
 
+    requests = [_dish_card_request(context.bot, chat_id, sheet_name, d) for d in menu.dishes(sheet_name)]
     # Показать Reply-клавиатуру «Назад/Корзина» в конце
     back_markup = ReplyKeyboardMarkup([["⬅️ Назад", "🛒 Корзина"]], resize_keyboard=True)
-    tail = await context.bot.send_message(chat_id, "⬇️", reply_markup=back_markup)
-    context.user_data["message_ids"].append(tail.message_id)
+    requests.append(partial(context.bot.send_message, chat_id, "⬇️", reply_markup=back_markup))
+
+    # карточки уходят конвейером в пределах лимитов Telegram, порядок на экране сохраняется
+    for sent in await send_ordered(chat_id, requests, label=f"category {sheet_name!r}"):
+        if sent is not None:
+            track_message(context.user_data, sent)
+
+# ---------- Режим «листалки»: одна карточка на категорию, правки на месте ----------
+
+def _pager_markup(sheet_name: str, idx: int, total: int, d) -> InlineKeyboardMarkup:
+    """◀️ i/N ▶️ и «Добавить». callback pg:<индекс>:<лист> — индекс первым, имя листа может содержать «:»."""
+    prev_idx = (idx - 1) % total
+    next_idx = (idx + 1) % total
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("◀️", callback_data=f"pg:{prev_idx}:{sheet_name}"),
+            InlineKeyboardButton(f"{idx + 1}/{total}", callback_data="pg:noop"),
+            InlineKeyboardButton("▶️", callback_data=f"pg:{next_idx}:{sheet_name}"),
+        ],
+        [InlineKeyboardButton("➕ Добавить в корзину", callback_data=f"add:{sheet_name}:{d.id}")],
+    ])
+
+async def _send_pager_card(bot, chat_id: int, sheet_name: str, dishes, idx: int):
+    d = dishes[idx]
+    kb = _pager_markup(sheet_name, idx, len(dishes), d)
+    if _has_photo(d):
+        return await photo_cache.send_photo(bot, chat_id, d.photo, d.photo_version,
+                                            caption=_dish_caption(d), parse_mode="HTML", reply_markup=kb)
+    return await bot.send_message(chat_id, _dish_caption(d), parse_mode="HTML", reply_markup=kb)
+
+async def _show_pager(context, chat_id: int, sheet_name: str, menu):
+    """Категория одной карточкой: два сообщения на открытие вместо N карточек."""
+    dishes = menu.dishes(sheet_name)
+    back_markup = ReplyKeyboardMarkup([["⬅️ Назад", "🛒 Корзина"]], resize_keyboard=True)
+    head = await context.bot.send_message(chat_id, f"📂 {sheet_name}", reply_markup=back_markup)
+    track_message(context.user_data, head)
+    if not dishes:
+        return
+    card = await _send_pager_card(context.bot, chat_id, sheet_name, dishes, 0)
+    track_message(context.user_data, card)
+
+async def pager_callback(update, context):
+    """◀️/▶️ в листалке: правим ту же карточку (edit_message_media/caption/text) — один вызов API."""
+    query = update.callback_query
+    await query.answer()
+    if query.data == "pg:noop":
+        return
+    _, idx, sheet_name = query.data.split(":", 2)
+    dishes = (await get_menu()).dishes(sheet_name)
+    if not dishes:
+        return
+    idx = int(idx) % len(dishes)  # меню могло поменяться между нажатиями
+    d = dishes[idx]
+    msg = query.message
+    kb = _pager_markup(sheet_name, idx, len(dishes), d)
+    caption = _dish_caption(d)
+    try:
+        if msg.photo and _has_photo(d):
+            media = photo_cache.get(d.photo, d.photo_version) or d.photo
+            try:
+                edited = await msg.edit_media(InputMediaPhoto(media, caption=caption, parse_mode="HTML"), reply_markup=kb)
+            except BadRequest as e:
+                if media == d.photo or not photo_cache.file_id_rejected(e):
+                    raise
+                # закэшированный file_id не принят — загружаем фото по URL заново
+                await photo_cache.invalidate(d.photo)
+                media = d.photo
+                edited = await msg.edit_media(InputMediaPhoto(media, caption=caption, parse_mode="HTML"), reply_markup=kb)
+            if media == d.photo and getattr(edited, "photo", None):
+                await photo_cache.put(d.photo, d.photo_version, edited.photo[-1].file_id)
+            return
+        if not msg.photo and not _has_photo(d):
+            await msg.edit_text(caption, parse_mode="HTML", reply_markup=kb)
+            return
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return
+        raise
+    # Фото ↔ текст правкой не превратить: заменяем карточку новой
+    chat_id = msg.chat_id
+    try:
+        await msg.delete()
+    except Exception:
+        pass
+    card = await _send_pager_card(context.bot, chat_id, sheet_name, dishes, idx)
+    track_message(context.user_data, card)
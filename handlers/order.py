@@ -1,4 +1,5 @@
 import re
+import asyncio
 import logging
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
@@ -8,12 +9,21 @@ from telegram import (
 )
 from telegram.ext import ConversationHandler
 from config import (
-    OPERATOR_CHAT_ID, QR_IMAGE_URL, QR_REMINDER_MINUTES, QR_CANCEL_MINUTES,
+    QR_IMAGE_URL, QR_REMINDER_MINUTES, QR_CANCEL_MINUTES,
     MSK_TZ, EARLY_PAYMENT_HOUR, LATE_PAYMENT_HOUR
 )
-from ui import base_reply_markup, delete_all_bot_messages
+from ui import base_reply_markup, delete_all_bot_messages, track_message
 from cart_manager import get_cart, clear_cart, set_last_order
-from payment import create_payment
+from payment import create_payment, PaymentError
+import payment_tracker
+import timers
+import order_journal
+import sheets_export
+import operator_board
+import sender
+import memory_manager
+from persistence import user_session
+from menu_snapshot import format_price
 
 ASK_NAME, ASK_PHONE, ASK_ADDRESS, ASK_COMMENT, ASK_PAYMENT = range(5)
 
@@ -42,85 +52,86 @@ def _is_qr_only_now() -> bool:
     now = _msk_now()
     return (now.hour >= LATE_PAYMENT_HOUR) or (now.hour < EARLY_PAYMENT_HOUR)
 
-# ---------- QR reminder/timeout jobs ----------
+# ---------- QR reminder/timeout (timers) ----------
 
-async def _qr_reminder_job(context):
-    data = context.job.data or {}
-    chat_id = data.get("chat_id")
-    user_id = data.get("user_id")
-    if chat_id is None or user_id is None:
-        return
-    ud = context.application.user_data.get(user_id, {})
-    if not ud or not ud.get("awaiting_qr_confirm"):
-        return
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Я отправил подтверждение оплаты!", callback_data="qr_confirm")],
-        [InlineKeyboardButton("🔁 Показать QR ещё раз", callback_data="qr_repeat"),
-         InlineKeyboardButton("❌ Отменить оплату", callback_data="qr_cancel")]
-    ])
-    sent = await context.bot.send_message(
-        chat_id,
-        "⏰ Напоминание: после оплаты нажмите кнопку ниже, чтобы отправить заказ оператору.",
-        reply_markup=kb
-    )
-    ud.setdefault("message_ids", []).append(sent.message_id)
+def _qr_keys(user_id: int):
+    return f"qr_reminder:{user_id}", f"qr_timeout:{user_id}"
 
-async def _qr_timeout_job(context):
-    data = context.job.data or {}
-    chat_id = data.get("chat_id")
-    user_id = data.get("user_id")
-    if chat_id is None or user_id is None:
-        return
-    ud = context.application.user_data.get(user_id, {})
-    if not ud or not ud.get("awaiting_qr_confirm"):
+async def _qr_reminder_one(app, chat_id: int, user_id: int):
+    # авто-отмена уже сработала (оба срока прошли за время простоя) — напоминать поздно;
+    # пачки обрабатываются параллельно, и напоминание не должно прийти после отмены
+    if not timers.pending(_qr_keys(user_id)[1]):
         return
-    qr_msg_id = ud.get("qr_message_id")
-    if qr_msg_id:
-        try:
-            await context.bot.delete_message(chat_id, qr_msg_id)
-        except Exception:
-            pass
-    ud["awaiting_qr_confirm"] = False
-    ud.pop("pending_order_text", None)
-    ud.pop("qr_message_id", None)
-    for j in ud.get("qr_jobs", []):
-        try:
-            j.schedule_removal()
-        except Exception:
-            pass
-    ud["qr_jobs"] = []
-    sent = await context.bot.send_message(
-        chat_id,
-        "⏳ Время на подтверждение оплаты истекло. Сессия оплаты отменена. "
-        "Вы можете оформить заказ заново из меню.",
-        reply_markup=base_reply_markup()
-    )
-    ud.setdefault("message_ids", []).append(sent.message_id)
+    async with user_session(app, user_id) as ud:
+        if not ud.get("awaiting_qr_confirm"):
+            return
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Я отправил подтверждение оплаты!", callback_data="qr_confirm")],
+            [InlineKeyboardButton("🔁 Показать QR ещё раз", callback_data="qr_repeat"),
+             InlineKeyboardButton("❌ Отменить оплату", callback_data="qr_cancel")]
+        ])
+        sent = await sender.call(chat_id, lambda: app.bot.send_message(
+            chat_id,
+            "⏰ Напоминание: после оплаты нажмите кнопку ниже, чтобы отправить заказ оператору.",
+            reply_markup=kb
+        ))
+        track_message(ud, sent)
 
-def _schedule_qr_jobs(context, chat_id: int, user_id: int):
+async def _qr_timeout_one(app, chat_id: int, user_id: int):
+    async with user_session(app, user_id) as ud:
+        if not ud.get("awaiting_qr_confirm"):
+            return
+        qr_msg_id = ud.get("qr_message_id")
+        if qr_msg_id:
+            try:
+                await sender.call(chat_id, lambda: app.bot.delete_message(chat_id, qr_msg_id))
+            except Exception:
+                pass
+        ud["awaiting_qr_confirm"] = False
+        ud.pop("pending_order_text", None)
+        ud.pop("qr_message_id", None)
+        _cancel_qr_timers(user_id)
+        order_id = ud.pop("order_id", None)
+        if order_id:
+            await order_journal.append(order_id, status="expired")
+        sent = await sender.call(chat_id, lambda: app.bot.send_message(
+            chat_id,
+            "⏳ Время на подтверждение оплаты истекло. Сессия оплаты отменена. "
+            "Вы можете оформить заказ заново из меню.",
+            reply_markup=base_reply_markup()
+        ))
+        track_message(ud, sent)
+
+def _qr_batch(one):
     """
-    Ставит напоминание и авто-отмену через JobQueue.
-    Если JobQueue недоступен (например, PTB без extras) — тихо пропускаем (без падения).
+    Обработчик пачки таймеров: сработавшие одновременно сессии обслуживаются параллельно.
+    Через sender (лимиты, повтор при RetryAfter) идут только запросы к Telegram внутри one:
+    смена состояния сессии выполняется один раз и при повторе отправки не повторяется.
     """
-    q = getattr(context, "job_queue", None)
-    if not q:
-        logging.warning("JobQueue is not available; QR reminder/timeout will not be scheduled.")
-        context.user_data["qr_jobs"] = []
-        return
-    reminder = q.run_once(_qr_reminder_job, when=QR_REMINDER_MINUTES * 60,
-                          data={"chat_id": chat_id, "user_id": user_id})
-    cancel = q.run_once(_qr_timeout_job, when=QR_CANCEL_MINUTES * 60,
-                        data={"chat_id": chat_id, "user_id": user_id})
-    ud = context.user_data
-    ud["qr_jobs"] = [reminder, cancel]
+    async def handler(app, batch):
+        for t in batch:
+            memory_manager.touch(t.payload["user_id"])  # поднятые с диска — под учёт памяти
+        results = await asyncio.gather(
+            *(one(app, t.payload["chat_id"], t.payload["user_id"]) for t in batch),
+            return_exceptions=True
+        )
+        for t, res in zip(batch, results):
+            if isinstance(res, Exception):
+                logging.error("QR timer %s failed: %r", t.key, res)
+    return handler
+
+timers.register("qr_reminder", _qr_batch(_qr_reminder_one))
+timers.register("qr_timeout", _qr_batch(_qr_timeout_one))
 
-def _cancel_qr_jobs(ud: dict):
-    for j in ud.get("qr_jobs", []):
-        try:
-            j.schedule_removal()
-        except Exception:
-            pass
-    ud["qr_jobs"] = []
+def _schedule_qr_timers(chat_id: int, user_id: int):
+    """Напоминание и авто-отмена QR-оплаты; сроки переживают рестарт."""
+    reminder, timeout = _qr_keys(user_id)
+    payload = {"chat_id": chat_id, "user_id": user_id}
+    timers.schedule(reminder, "qr_reminder", QR_REMINDER_MINUTES * 60, payload)
+    timers.schedule(timeout, "qr_timeout", QR_CANCEL_MINUTES * 60, payload)
+
+def _cancel_qr_timers(user_id: int):
+    timers.cancel(*_qr_keys(user_id))
 
 # ---------- Conversation entry ----------
 
@@ -134,7 +145,7 @@ async def start_checkout(update, context):
     sent = await context.bot.send_message(
         chat_id, "👤 Введите ваше имя:", reply_markup=_cancel_only_kb()
     )
-    context.user_data.setdefault("message_ids", []).append(sent.message_id)
+    track_message(context.user_data, sent)
     return ASK_NAME
 
 # ---------- Conversation: ask_* ----------
@@ -144,12 +155,12 @@ async def ask_name(update, context):
     if text == "❌ Отмена":
         return await cancel_checkout_msg(update, context)
     if "order_id" not in context.user_data:
-        context.user_data["order_id"] = datetime.now().strftime("%y%m%d-%H%M%S")
+        context.user_data["order_id"] = await order_journal.next_order_id()
     context.user_data["name"] = text
     sent = await update.message.reply_text(
         "📞 Введите номер телефона в формате +7XXXXXXXXXX:", reply_markup=_cancel_only_kb()
     )
-    context.user_data.setdefault("message_ids", []).append(sent.message_id)
+    track_message(context.user_data, sent)
     return ASK_PHONE
 
 async def ask_phone(update, context):
@@ -161,13 +172,13 @@ async def ask_phone(update, context):
             "❗ Неверный формат. Введите телефон вида +7XXXXXXXXXX:",
             reply_markup=_cancel_only_kb()
         )
-        context.user_data.setdefault("message_ids", []).append(sent.message_id)
+        track_message(context.user_data, sent)
         return ASK_PHONE
     context.user_data["phone"] = text
     sent = await update.message.reply_text(
         "📍 Введите адрес доставки (доставка осуществляется только в пределах г.Керчь):", reply_markup=_cancel_only_kb()
     )
-    context.user_data.setdefault("message_ids", []).append(sent.message_id)
+    track_message(context.user_data, sent)
     return ASK_ADDRESS
 
 async def ask_address(update, context):
@@ -183,7 +194,7 @@ async def ask_address(update, context):
     sent = await update.message.reply_text(
         "💬 Комментарий к заказу (опционально):", reply_markup=skip_kb
     )
-    context.user_data.setdefault("message_ids", []).append(sent.message_id)
+    track_message(context.user_data, sent)
     return ASK_COMMENT
 
 async def ask_comment(update, context):
@@ -211,7 +222,7 @@ async def ask_comment(update, context):
         text_msg = f"💳 Выберите способ оплаты:\n{note}"
 
     sent = await update.message.reply_text(text_msg, reply_markup=kb)
-    context.user_data.setdefault("message_ids", []).append(sent.message_id)
+    track_message(context.user_data, sent)
     return ASK_PAYMENT
 
 async def ask_payment(update, context):
@@ -231,30 +242,23 @@ async def ask_payment(update, context):
             "Пожалуйста, выберите QR-оплату.",
             reply_markup=kb
         )
-        context.user_data.setdefault("message_ids", []).append(sent.message_id)
+        track_message(context.user_data, sent)
         return ASK_PAYMENT
 
     name = context.user_data.get("name", "")
     phone = context.user_data.get("phone", "")
     address = context.user_data.get("address", "")
     comment = context.user_data.get("comment", "")
-    order_id = context.user_data.get("order_id", datetime.now().strftime("%y%m%d-%H%M%S"))
+    order_id = context.user_data.get("order_id")
+    if not order_id:
+        order_id = context.user_data["order_id"] = await order_journal.next_order_id()
 
     cart = get_cart(user_id)
-    total = sum(int(i.get("Цена", 0)) for i in cart)
-
-    # группируем позиции
-    grouped = {}
-    for item in cart:
-        dish = item["Название блюда"]
-        price = int(item.get("Цена", 0))
-        grouped.setdefault((dish, price), 0)
-        grouped[(dish, price)] += 1
+    total = cart.total  # в копейках
 
     order_items = []
-    for (dish, price), cnt in grouped.items():
-        sum_price = cnt * price
-        order_items.append(f"- {cnt} X {dish} — {price}₽ = {sum_price}₽")
+    for dish, cnt in cart.lines():
+        order_items.append(f"- {cnt} X {dish.name} — {format_price(dish.price)}₽ = {format_price(cnt * dish.price)}₽")
 
     base_order_text = (
         f"🧾 Заказ #{order_id}\n"
@@ -264,27 +268,33 @@ async def ask_payment(update, context):
         + (f"💬 {comment}\n" if comment else "")
         + "🛒 Позиции:\n"
         + "\n".join(order_items)
-        + f"\n💰 Итого: {total}₽"
+        + f"\n💰 Итого: {format_price(total)}₽"
     )
 
     now_str = _msk_now().strftime("%d.%m %H:%M МСК")
+    order_fields = dict(
+        method=method, name=name, phone=phone, address=address, comment=comment, total=total,
+        items=[{"name": dish.name, "qty": cnt, "price": dish.price} for dish, cnt in cart.lines()],
+    )
 
     if method == "cash":
+        await order_journal.append(order_id, user_id, status="new", **order_fields)
+        sheets_export.enqueue(order_journal.get(order_id))
         await query.message.reply_text("✅ Ваш заказ принят!", reply_markup=base_reply_markup())
-        await context.bot.send_message(
-            OPERATOR_CHAT_ID, f"📦 Новый заказ (Наличные)\n{base_order_text}\n⏱ {now_str}"
-        )
+        operator_board.announce(f"📦 Новый заказ (Наличные)\n{base_order_text}\n⏱ {now_str}")
         set_last_order(user_id, cart)
         clear_cart(user_id)
         context.user_data['in_checkout'] = False
+        context.user_data.pop("order_id", None)
         return ConversationHandler.END
 
     if method == "qr":
+        await order_journal.append(order_id, user_id, status="awaiting_payment", **order_fields)
         context.user_data["pending_order_text"] = base_order_text
         context.user_data["awaiting_qr_confirm"] = True
 
         caption = (
-            f"Отсканируйте QR-код для оплаты на сумму {total}₽.\n"
+            f"Отсканируйте QR-код для оплаты на сумму {format_price(total)}₽.\n"
             f"Сделайте скриншот или фото с оплатой и отправьте его оператору @ВАШ ОПЕРАТОР.\n"
             f"После отправки скриншота нажмите кнопку ниже, чтобы отправить заказ оператору."
         )
@@ -300,19 +310,31 @@ async def ask_payment(update, context):
             )
 
         context.user_data["qr_message_id"] = sent.message_id
-        context.user_data.setdefault("message_ids", []).append(sent.message_id)
-        _schedule_qr_jobs(context, chat_id, user_id)
+        track_message(context.user_data, sent)
+        _schedule_qr_timers(chat_id, user_id)
         return ConversationHandler.END
 
-    # Онлайн-оплата
-    url, _ = create_payment(total, user_id)
-    await query.message.reply_text(f"✅ Перейдите для оплаты:\n{url}", reply_markup=base_reply_markup())
-    await context.bot.send_message(
-        OPERATOR_CHAT_ID, f"📦 Новый заказ (Онлайн)\n{base_order_text}\n🔗 {url}\n⏱ {now_str}"
+    # Онлайн-оплата: ключ идемпотентности из order_id — повторное нажатие не создаст второй платёж
+    try:
+        url, payment_id = await create_payment(total, user_id, order_id)
+    except PaymentError:
+        logging.exception("Online payment for order %s failed", order_id)
+        sent = await query.message.reply_text(
+            "⚠️ Не удалось создать онлайн-платёж. Попробуйте ещё раз или выберите другой способ оплаты."
+        )
+        track_message(context.user_data, sent)
+        return ASK_PAYMENT
+    # оператору заказ уйдёт, когда ЮKassa подтвердит оплату (payment_tracker)
+    await order_journal.append(order_id, user_id, status="awaiting_payment", payment_id=payment_id, **order_fields)
+    await payment_tracker.register(payment_id, order_id, user_id, chat_id, total, f"{base_order_text}\n⏱ {now_str}")
+    await query.message.reply_text(
+        f"✅ Перейдите для оплаты:\n{url}\nПосле оплаты заказ автоматически уйдёт оператору.",
+        reply_markup=base_reply_markup()
     )
     set_last_order(user_id, cart)
     clear_cart(user_id)
     context.user_data['in_checkout'] = False
+    context.user_data.pop("order_id", None)  # следующий заказ — новый платёж
     return ConversationHandler.END
 
 # ---------- inline: qr_confirm / qr_repeat / qr_cancel ----------
@@ -332,7 +354,7 @@ async def qr_inline_callbacks(update, context):
             sent = await query.message.reply_text(
                 "Кажется, активного заказа для подтверждения нет.", reply_markup=base_reply_markup()
             )
-            ud.setdefault("message_ids", []).append(sent.message_id)
+            track_message(ud, sent)
             return
 
         username = ("@" + query.from_user.username) if query.from_user.username else "—"
@@ -344,7 +366,7 @@ async def qr_inline_callbacks(update, context):
             + f"\n⏱ {now_str}"
             + f"\n👤 Telegram: {username} (id {user_id})"
         )
-        await context.bot.send_message(OPERATOR_CHAT_ID, operator_text)
+        operator_board.announce(operator_text)
 
         # удалить QR
         if qr_msg_id:
@@ -359,18 +381,17 @@ async def qr_inline_callbacks(update, context):
         ud["awaiting_qr_confirm"] = False
         ud.pop("pending_order_text", None)
         ud.pop("qr_message_id", None)
-        for j in ud.get("qr_jobs", []):
-            try:
-                j.schedule_removal()
-            except Exception:
-                pass
-        ud["qr_jobs"] = []
+        _cancel_qr_timers(user_id)
+        order_id = ud.pop("order_id", None)
+        if order_id:
+            await order_journal.append(order_id, status="payment_claimed")
+            sheets_export.enqueue(order_journal.get(order_id))
 
         sent = await query.message.reply_text(
             "✅ Спасибо! Подтверждение получено. Заказ отправлен оператору. Ожидайте звонка.",
             reply_markup=base_reply_markup()
         )
-        ud.setdefault("message_ids", []).append(sent.message_id)
+        track_message(ud, sent)
         return
 
     if data == "qr_repeat":
@@ -391,7 +412,7 @@ async def qr_inline_callbacks(update, context):
         else:
             sent = await query.message.reply_text("QR_IMAGE_URL не задан. Укажите ссылку в config.py", reply_markup=kb)
         ud["qr_message_id"] = sent.message_id
-        ud.setdefault("message_ids", []).append(sent.message_id)
+        track_message(ud, sent)
         return
 
     if data == "qr_cancel":
@@ -404,29 +425,27 @@ async def qr_inline_callbacks(update, context):
         ud["awaiting_qr_confirm"] = False
         ud.pop("pending_order_text", None)
         ud.pop("qr_message_id", None)
-        for j in ud.get("qr_jobs", []):
-            try:
-                j.schedule_removal()
-            except Exception:
-                pass
-        ud["qr_jobs"] = []
+        _cancel_qr_timers(user_id)
+        order_id = ud.pop("order_id", None)
+        if order_id:
+            await order_journal.append(order_id, status="canceled")
         sent = await query.message.reply_text(
             "❌ Оплата по QR отменена. Вы можете выбрать другой способ оплаты или оформить заказ заново.",
             reply_markup=base_reply_markup()
         )
-        ud.setdefault("message_ids", []).append(sent.message_id)
+        track_message(ud, sent)
         return
 
 # ---------- cancel ----------
 
 async def cancel_checkout_msg(update, context):
     chat_id = update.effective_chat.id
-    await delete_all_bot_messages(context, chat_id)
+    await delete_all_bot_messages(context, chat_id, background=True)
     context.user_data['in_checkout'] = False
     sent = await update.message.reply_text(
         "Оформление заказа отменено.", reply_markup=base_reply_markup()
     )
-    context.user_data.setdefault("message_ids", []).append(sent.message_id)
+    track_message(context.user_data, sent)
     return ConversationHandler.END
 
 
@@ -0,0 +1,125 @@
+# Ограничение памяти процесса: состояние пользователей, простаивающих дольше
+# MEMORY_IDLE_TTL_SECONDS (или самых давних — при превышении MEMORY_BUDGET_MB),
+# выгружается из памяти. Если включено сохранение, оно сначала пишется на диск
+# и поднимется обратно при следующем апдейте пользователя. С STATE_BACKEND=memory
+# выгружать некуда — хранилище живёт в той же памяти, и выгрузка отключается.
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+from config import MEMORY_IDLE_TTL_SECONDS, MEMORY_BUDGET_MB, MEMORY_SWEEP_SECONDS
+import cart_manager
+from persistence import StatePersistence
+from state_store import MemoryStore
+
+# Уже неактивных не трогаем: выгрузка во время обработки апдейта потеряла бы изменения
+_MIN_IDLE_SECONDS = 60
+# Объекты Python занимают в памяти в несколько раз больше своего JSON
+_PY_OVERHEAD = 4
+# Позиция корзины: список, ключ-кортеж и ссылка на общий Dish из меню
+_LINE_BYTES = 200
+
+_last_seen: "OrderedDict[int, float]" = OrderedDict()  # от самых давних к свежим
+_sizes: Dict[int, int] = {}
+_dirty: Set[int] = set()
+_total_bytes = 0
+evicted_total = 0
+
+def touch(user_id: int):
+    _last_seen[user_id] = time.monotonic()
+    _last_seen.move_to_end(user_id)
+    _dirty.add(user_id)
+
+async def on_update(update, context):
+    """TypeHandler в группе -1: отмечает активность пользователя перед обработкой апдейта."""
+    if update.effective_user:
+        touch(update.effective_user.id)
+
+def _estimate(app, user_id: int) -> int:
+    data = app.user_data.get(user_id)
+    size = len(json.dumps(data, default=str, ensure_ascii=False)) if data else 0
+    return size * _PY_OVERHEAD + cart_manager.user_lines(user_id) * _LINE_BYTES
+
+def _refresh_sizes(app):
+    """Пересчитывает оценку только для пользователей с апдейтами после прошлого прохода."""
+    global _total_bytes
+    for user_id in _dirty:
+        size = _estimate(app, user_id)
+        _total_bytes += size - _sizes.get(user_id, 0)
+        _sizes[user_id] = size
+    _dirty.clear()
+
+def _pick_victims(app, now: float) -> List[int]:
+    victims = []
+    budget = MEMORY_BUDGET_MB * 1024 * 1024
+    excess = _total_bytes - int(budget * 0.9) if budget and _total_bytes > budget else 0
+    for user_id, seen in _last_seen.items():
+        idle = now - seen
+        if idle < MEMORY_IDLE_TTL_SECONDS and (excess <= 0 or idle < _MIN_IDLE_SECONDS):
+            break
+        if (app.user_data.get(user_id) or {}).get("awaiting_qr_confirm"):
+            continue  # идёт QR-оплата: её таймеры скоро понадобятся user_data
+        victims.append(user_id)
+        excess -= _sizes.get(user_id, 0)
+    return victims
+
+async def _evict(app, user_ids: List[int]):
+    global _total_bytes, evicted_total
+    if isinstance(app.persistence, StatePersistence):
+        user_ids = await app.persistence.evict({uid: app.user_data.get(uid) or {} for uid in user_ids})
+    for user_id in user_ids:
+        if _last_seen.get(user_id, 0) > time.monotonic() - _MIN_IDLE_SECONDS:
+            # пользователь вернулся, пока шла запись на диск
+            if isinstance(app.persistence, StatePersistence):
+                app.persistence.unevict(user_id)
+            continue
+        cart_manager.forget_user(user_id)
+        if user_id in app.user_data:
+            app.drop_user_data(user_id)
+        _last_seen.pop(user_id, None)
+        _dirty.discard(user_id)
+        _total_bytes -= _sizes.pop(user_id, 0)
+        evicted_total += 1
+
+async def sweep(app) -> int:
+    _refresh_sizes(app)
+    victims = _pick_victims(app, time.monotonic())
+    if victims:
+        await _evict(app, victims)
+        logging.info("Memory: evicted %d idle users, %s", len(victims), stats(app))
+    return len(victims)
+
+async def sweep_loop(app):
+    if isinstance(app.persistence, StatePersistence) and isinstance(app.persistence.store, MemoryStore):
+        logging.warning("Memory eviction disabled: STATE_BACKEND=memory would keep evicted users in this process")
+        return
+    while True:
+        await asyncio.sleep(MEMORY_SWEEP_SECONDS)
+        try:
+            await sweep(app)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Memory sweep failed")
+
+def _rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def stats(app) -> dict:
+    """Для подбора размера инстанса: сколько пользователей в памяти и примерный объём."""
+    return {
+        "users": len(_last_seen),
+        "user_data": len(app.user_data),
+        **cart_manager.counts(),
+        "est_bytes": _total_bytes,
+        "evicted": evicted_total,
+        "rss_bytes": _rss_bytes(),
+    }
@@ -0,0 +1,129 @@
+# Снимок меню: все категории и блюда в одной неизменяемой структуре.
+# Обновление меню = подмена объекта целиком, поэтому читатели никогда
+# не увидят «половину» старого и «половину» нового меню.
+import re
+import time
+import hashlib
+from types import MappingProxyType
+from typing import Dict, Tuple, Optional, Sequence, Mapping, Iterable
+
+# Заголовок колонки в таблице → поле Dish
+COLUMNS = {
+    "ID": "id",
+    "Название блюда": "name",
+    "Цена": "price",
+    "Граммы": "grams",
+    "Описание": "description",
+    "Ссылка на изображение": "photo",
+    "Версия фото": "photo_version",  # необязательная: поменять, если картинку заменили по тому же URL
+}
+
+class Dish:
+    """
+    Блюдо из таблицы. Поля разобраны и проверены один раз при загрузке меню;
+    цена хранится целым числом в копейках.
+    Корзины держат ссылки на эти объекты, а не копии строк таблицы.
+    """
+    __slots__ = ("sheet", "id", "name", "price", "grams", "description", "photo", "photo_version")
+
+    def __init__(self, sheet: str, id: str, name: str, price: int,
+                 grams: str = "", description: str = "", photo: str = "", photo_version: str = ""):
+        object.__setattr__(self, "sheet", sheet)
+        object.__setattr__(self, "id", id)
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "price", price)
+        object.__setattr__(self, "grams", grams)
+        object.__setattr__(self, "description", description)
+        object.__setattr__(self, "photo", photo)
+        object.__setattr__(self, "photo_version", photo_version)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Dish is immutable")
+
+    def __repr__(self) -> str:
+        return f"<Dish {self.sheet}:{self.id} {self.name!r} {format_price(self.price)}₽>"
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return (self.sheet, self.id)
+
+    def as_tuple(self) -> tuple:
+        return (self.sheet, self.id, self.name, self.price, self.grams, self.description,
+                self.photo, self.photo_version)
+
+def parse_price(raw: str) -> int:
+    """
+    '450', '450.50', '450,5', '1 200 ₽' → копейки. ValueError, если это не цена.
+    """
+    text = re.sub(r"[\s ₽]|руб\.?|р\.?", "", str(raw), flags=re.IGNORECASE).replace(",", ".")
+    if not re.fullmatch(r"\d+(\.\d{1,2})?", text):
+        raise ValueError(f"bad price {raw!r}")
+    rub, _, kop = text.partition(".")
+    return int(rub) * 100 + int(kop.ljust(2, "0") or 0)
+
+def format_price(kopecks: int) -> str:
+    """Копейки → строка для чата: 45000 → '450', 45050 → '450,50'."""
+    rub, kop = divmod(kopecks, 100)
+    return f"{rub}" if kop == 0 else f"{rub},{kop:02d}"
+
+class Menu:
+    """Неизменяемый версионированный снимок меню."""
+    __slots__ = ("version", "loaded_at", "categories", "problems", "_by_sheet", "_by_key", "_by_text")
+
+    def __init__(self, sheets: Iterable[Tuple[str, Iterable[Dish]]], loaded_at: Optional[float] = None,
+                 problems: Sequence[str] = ()):
+        # sheets и блюда внутри могут быть генераторами: всё строится за один проход
+        by_sheet = {}
+        digest = hashlib.sha1()
+        for title, dishes in sheets:
+            by_sheet[title] = tuple(dishes)
+            digest.update(repr((title, [d.as_tuple() for d in by_sheet[title]])).encode("utf-8"))
+        object.__setattr__(self, "version", digest.hexdigest()[:12])
+        object.__setattr__(self, "loaded_at", time.time() if loaded_at is None else loaded_at)
+        object.__setattr__(self, "categories", tuple(by_sheet))
+        # строки таблицы, которые не удалось разобрать (для оператора/логов)
+        object.__setattr__(self, "problems", tuple(problems))
+        object.__setattr__(self, "_by_sheet", MappingProxyType(by_sheet))
+        object.__setattr__(self, "_by_key", MappingProxyType(_dish_index(by_sheet)))
+        object.__setattr__(self, "_by_text", MappingProxyType(_category_aliases(self.categories)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Menu is immutable")
+
+    def __repr__(self) -> str:
+        return f"<Menu {self.version}: {len(self.categories)} categories>"
+
+    def dishes(self, sheet_name: str) -> Tuple[Dish, ...]:
+        """Блюда категории в порядке строк таблицы (пустой кортеж, если листа нет)."""
+        return self._by_sheet.get(sheet_name, ())
+
+    def find_dish(self, sheet_name: str, dish_id: str) -> Optional[Dish]:
+        """Блюдо по (лист, ID) за один поиск в словаре — для add:/del: колбэков."""
+        return self._by_key.get((sheet_name, str(dish_id)))
+
+    def resolve_category(self, text: str) -> Optional[str]:
+        """
+        Находит лист по тексту кнопки: точное совпадение или совпадение по окончанию
+        (кнопка может прийти без эмодзи-префикса).
+        """
+        return self._by_text.get(text)
+
+def _dish_index(by_sheet: Mapping[str, Sequence[Dish]]) -> Dict[Tuple[str, str], Dish]:
+    """Индекс «(лист, ID) → блюдо». При повторяющихся ID выигрывает первая строка."""
+    index: Dict[Tuple[str, str], Dish] = {}
+    for dishes in by_sheet.values():
+        for d in dishes:
+            index.setdefault(d.key, d)
+    return index
+
+def _category_aliases(categories: Sequence[str]) -> Dict[str, str]:
+    """Индекс «текст кнопки → лист», строится один раз на снимок."""
+    aliases: Dict[str, str] = {}
+    # Суффиксы: первый лист, оканчивающийся на текст, выигрывает (как раньше в handlers/menu)
+    for name in categories:
+        for i in range(len(name)):
+            aliases.setdefault(name[i:], name)
+    # Точные совпадения имеют приоритет над суффиксами
+    for name in categories:
+        aliases[name] = name
+    return aliases
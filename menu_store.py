@@ -0,0 +1,104 @@
+# Последний удачный снимок меню на диске (SQLite).
+# Нужен для мгновенного старта после деплоя и работы при недоступном Google Sheets.
+import os
+import json
+import zlib
+import sqlite3
+import logging
+import tempfile
+from typing import Optional
+
+from menu_snapshot import Menu, Dish
+
+# Меняется при изменении формата строк dishes: старый файл тогда просто игнорируется
+_FORMAT = "3"
+
+_SCHEMA = """
+CREATE TABLE meta   (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE sheets (pos INTEGER PRIMARY KEY, title TEXT NOT NULL);
+CREATE TABLE dishes (sheet_pos INTEGER NOT NULL, pos INTEGER NOT NULL, data TEXT NOT NULL,
+                     PRIMARY KEY (sheet_pos, pos)) WITHOUT ROWID;
+"""
+
+def save(menu: Menu, path: str):
+    """
+    Атомарная запись: собираем базу во временном файле рядом и подменяем через os.replace,
+    так что читатель (или рестарт посреди записи) видит либо старый, либо новый снимок.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".menu-", suffix=".tmp", dir=directory)
+    os.close(fd)
+    try:
+        con = sqlite3.connect(tmp)
+        try:
+            con.executescript(_SCHEMA)
+            con.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ("format", _FORMAT),
+                ("version", menu.version),
+                ("loaded_at", repr(menu.loaded_at)),
+            ])
+            for sheet_pos, title in enumerate(menu.categories):
+                con.execute("INSERT INTO sheets VALUES (?, ?)", (sheet_pos, title))
+                con.executemany("INSERT INTO dishes VALUES (?, ?, ?)", [
+                    (sheet_pos, pos, json.dumps(list(d.as_tuple()[1:]), ensure_ascii=False, separators=(",", ":")))
+                    for pos, d in enumerate(menu.dishes(title))
+                ])
+            con.commit()
+        finally:
+            con.close()
+        with open(tmp, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def load(path: str) -> Optional[Menu]:
+    """Читает снимок с диска; None, если файла нет или он повреждён."""
+    if not os.path.exists(path):
+        return None
+    try:
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            meta = dict(con.execute("SELECT key, value FROM meta"))
+            if meta.get("format") != _FORMAT:
+                logging.info("Menu snapshot %s has an old format, ignoring it", path)
+                return None
+            titles = [t for (t,) in con.execute("SELECT title FROM sheets ORDER BY pos")]
+            dishes = {i: [] for i in range(len(titles))}
+            for sheet_pos, data in con.execute("SELECT sheet_pos, data FROM dishes ORDER BY sheet_pos, pos"):
+                dishes[sheet_pos].append(Dish(titles[sheet_pos], *json.loads(data)))
+        finally:
+            con.close()
+    except (sqlite3.Error, ValueError, KeyError, TypeError):
+        logging.exception("Menu snapshot %s is unreadable, ignoring it", path)
+        return None
+    return Menu([(t, dishes[i]) for i, t in enumerate(titles)], loaded_at=float(meta["loaded_at"]))
+
+# ---------- Снимок для общего хранилища (несколько процессов бота) ----------
+
+def dumps(menu: Menu) -> bytes:
+    payload = {
+        "format": _FORMAT,
+        "version": menu.version,
+        "loaded_at": menu.loaded_at,
+        "sheets": [[title, [list(d.as_tuple()[1:]) for d in menu.dishes(title)]] for title in menu.categories],
+    }
+    return zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+def loads(blob: bytes) -> Optional[Menu]:
+    """None, если снимок в старом формате или повреждён."""
+    try:
+        payload = json.loads(zlib.decompress(blob).decode("utf-8"))
+        if payload.get("format") != _FORMAT:
+            return None
+        return Menu(
+            ((title, (Dish(title, *row) for row in rows)) for title, rows in payload["sheets"]),
+            loaded_at=float(payload["loaded_at"]),
+        )
+    except (zlib.error, ValueError, KeyError, TypeError):
+        logging.exception("Shared menu snapshot is unreadable, ignoring it")
+        return None
@@ -0,0 +1,228 @@
+# Доска заказов в чате оператора: одно закреплённое сообщение (или несколько страниц)
+# со списком активных заказов и кнопками смены статуса. Доска правится через
+# edit_message_text не чаще раза в OPERATOR_BOARD_EDIT_SECONDS: всплеск из N заказов
+# стоит одной правки, а не N сообщений. Заказы и их статусы берутся из order_journal.
+import os
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+from config import OPERATOR_CHAT_ID, OPERATOR_BOARD_MODE, OPERATOR_BOARD_EDIT_SECONDS, OPERATOR_BOARD_STATE_PATH
+from menu_snapshot import format_price
+import order_journal
+import operator_outbox
+import sender
+
+STATUS_LABELS = {
+    "new": "🆕 Новый",
+    "payment_claimed": "💳 QR: клиент оплатил, проверить",
+    "paid": "💳 Оплачен онлайн",
+    "accepted": "👨‍🍳 Готовится",
+    "delivering": "🚚 В пути",
+    "done": "✅ Выполнен",
+    "canceled": "❌ Отменён",
+}
+# Статусы на доске и следующий шаг для кнопки
+_NEXT = {
+    "new": "accepted",
+    "payment_claimed": "accepted",
+    "paid": "accepted",
+    "accepted": "delivering",
+    "delivering": "done",
+}
+_METHODS = {"cash": "Наличные", "qr": "QR", "online": "Онлайн"}
+
+# Telegram: до 4096 символов в сообщении; кнопок на страницу держим с запасом
+_PAGE_CHARS = 3900
+_PAGE_ORDERS = 15
+
+_active: "OrderedDict[str, dict]" = OrderedDict()  # номер -> состояние, в порядке создания
+_message_ids: List[int] = []  # страницы доски в чате оператора; первая закреплена
+_rendered: List[Tuple[str, str]] = []  # (текст, кнопки) каждой страницы — не правим без изменений
+_dirty: Optional[asyncio.Event] = None
+_bot = None
+edits = 0
+
+def enabled() -> bool:
+    return OPERATOR_BOARD_MODE in ("board", "both")
+
+def announce(text: str):
+    """Уведомление о новом заказе отдельным сообщением — если доска не заменяет их совсем."""
+    if OPERATOR_BOARD_MODE != "board":
+        operator_outbox.send(text)
+
+# ---------- Состояние ----------
+
+def _on_order_change(order: dict):
+    order_id = order["order_id"]
+    if order.get("status") in _NEXT:
+        _active[order_id] = order
+    elif _active.pop(order_id, None) is None:
+        return  # на доске его не было и не будет
+    if _dirty is not None:
+        _dirty.set()
+
+def _load_state():
+    global _message_ids
+    try:
+        with open(OPERATOR_BOARD_STATE_PATH, encoding="utf-8") as f:
+            _message_ids = [int(i) for i in json.load(f).get("message_ids", [])]
+    except (FileNotFoundError, ValueError, TypeError):
+        _message_ids = []
+
+def _save_state():
+    if not OPERATOR_BOARD_STATE_PATH:
+        return
+    tmp = OPERATOR_BOARD_STATE_PATH + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"message_ids": _message_ids}, f)
+        os.replace(tmp, OPERATOR_BOARD_STATE_PATH)
+    except OSError:
+        logging.exception("Operator board state write failed")
+
+# ---------- Отрисовка ----------
+
+def _block(order: dict) -> str:
+    items = ", ".join(f"{i['qty']}×{i['name']}" for i in order.get("items", []))
+    lines = [
+        f"#{order['order_id']} · {STATUS_LABELS.get(order.get('status'), order.get('status'))}",
+        f"💳 {_METHODS.get(order.get('method'), order.get('method', ''))} · 💰 {format_price(order.get('total', 0))}₽",
+        f"👤 {order.get('name', '')} · 📞 {order.get('phone', '')}",
+        f"📍 {order.get('address', '')}",
+    ]
+    if items:
+        lines.append(f"🛒 {items}")
+    if order.get("comment"):
+        lines.append(f"💬 {order['comment']}")
+    return "\n".join(lines)
+
+def _buttons(order: dict) -> List[InlineKeyboardButton]:
+    order_id = order["order_id"]
+    nxt = _NEXT[order["status"]]
+    return [
+        InlineKeyboardButton(f"#{order_id} → {STATUS_LABELS[nxt]}", callback_data=f"board:{order_id}:{nxt}"),
+        InlineKeyboardButton("❌", callback_data=f"board:{order_id}:canceled"),
+    ]
+
+def _pages() -> List[Tuple[str, List[List[InlineKeyboardButton]]]]:
+    """Страницы доски: не длиннее _PAGE_CHARS символов и _PAGE_ORDERS заказов."""
+    pages = []
+    blocks, rows, size = [], [], 0
+    for order in _active.values():
+        block = _block(order)[:_PAGE_CHARS - 100]
+        if blocks and (size + len(block) + 2 > _PAGE_CHARS - 100 or len(blocks) >= _PAGE_ORDERS):
+            pages.append((blocks, rows))
+            blocks, rows, size = [], [], 0
+        blocks.append(block)
+        rows.append(_buttons(order))
+        size += len(block) + 2
+    pages.append((blocks, rows))
+    out = []
+    for i, (blocks, rows) in enumerate(pages):
+        header = f"📋 Активные заказы: {len(_active)}" + (f" (стр. {i + 1}/{len(pages)})" if len(pages) > 1 else "")
+        body = "\n\n".join(blocks) if blocks else "Активных заказов нет."
+        out.append((f"{header}\n\n{body}", rows))
+    return out
+
+async def _call(make_request):
+    return await sender.call(OPERATOR_CHAT_ID, make_request)
+
+async def _send_page(i: int, text: str, markup) -> int:
+    msg = await _call(lambda: _bot.send_message(OPERATOR_CHAT_ID, text, reply_markup=markup,
+                                                disable_notification=True))
+    if i == 0:
+        try:
+            await _call(lambda: _bot.pin_chat_message(OPERATOR_CHAT_ID, msg.message_id, disable_notification=True))
+        except Exception:
+            logging.warning("Failed to pin the operator board (is the bot an admin?)")
+    return msg.message_id
+
+async def render():
+    """Приводит сообщения доски к текущему списку: правит изменившиеся страницы, добавляет и удаляет лишние."""
+    global edits
+    pages = _pages()
+    changed = False
+    for i, (text, rows) in enumerate(pages):
+        markup = InlineKeyboardMarkup(rows) if rows else None
+        key = (text, json.dumps([[b.callback_data for b in row] for row in rows]))
+        if i < len(_rendered) and _rendered[i] == key:
+            continue
+        if i < len(_message_ids):
+            try:
+                await _call(lambda: _bot.edit_message_text(text, OPERATOR_CHAT_ID, _message_ids[i], reply_markup=markup))
+                edits += 1
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    # сообщение удалили из чата — выкладываем страницу заново
+                    logging.warning("Operator board page %d is gone (%s), reposting", i + 1, e)
+                    _message_ids[i] = await _send_page(i, text, markup)
+                    changed = True
+        else:
+            _message_ids.append(await _send_page(i, text, markup))
+            changed = True
+        _rendered[i:i + 1] = [key]
+    for message_id in _message_ids[len(pages):]:
+        try:
+            await _call(lambda: _bot.delete_message(OPERATOR_CHAT_ID, message_id))
+        except Exception:
+            pass
+        changed = True
+    del _message_ids[len(pages):]
+    del _rendered[len(pages):]
+    if changed:
+        _save_state()
+
+async def run(app):
+    """Фоновая задача доски: правка не чаще раза в OPERATOR_BOARD_EDIT_SECONDS."""
+    global _dirty, _bot
+    _bot = app.bot
+    _dirty = asyncio.Event()
+    _dirty.set()  # первая отрисовка после старта
+    while True:
+        await _dirty.wait()
+        _dirty.clear()
+        try:
+            await render()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Operator board update failed")
+            _dirty.set()
+        await asyncio.sleep(OPERATOR_BOARD_EDIT_SECONDS)
+
+def load():
+    """Активные заказы из журнала и сообщения доски с прошлого запуска."""
+    if not enabled():
+        return
+    for order in order_journal.all_orders():
+        if order.get("status") in _NEXT:
+            _active[order["order_id"]] = order
+    _load_state()
+    order_journal.on_change(_on_order_change)
+
+# ---------- Кнопки ----------
+
+async def on_callback(update, context):
+    """board:<номер>:<статус> — смена статуса заказа с доски."""
+    query = update.callback_query
+    if query.message is None or query.message.chat_id != OPERATOR_CHAT_ID:
+        await query.answer()
+        return
+    _, order_id, status = query.data.split(":", 2)
+    order = order_journal.get(order_id)
+    current = (order or {}).get("status")
+    if current not in _NEXT or (status != "canceled" and _NEXT[current] != status):
+        await query.answer("Статус уже изменён")
+        return
+    who = query.from_user.username or query.from_user.id
+    await order_journal.append(order_id, status=status, status_by=str(who))
+    await query.answer(f"#{order_id}: {STATUS_LABELS[status]}")
+
+def stats() -> Dict[str, int]:
+    return {"active": len(_active), "pages": len(_message_ids), "edits": edits}
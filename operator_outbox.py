@@ -0,0 +1,214 @@
+# Исходящие уведомления оператору (outbox).
+# Оформление заказа не ждёт чат оператора: сообщение ставится в очередь, а одна фоновая
+# задача доставляет их строго по порядку — через sender (лимиты Telegram, RetryAfter),
+# с повторами на сетевых ошибках. Что доставить не удалось — уходит в dead-letter
+# (таблица на диске + короткий отчёт оператору). Очередь пишется в SQLite и после
+# рестарта доставляется дальше.
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from telegram.error import BadRequest, Forbidden
+
+from config import OPERATOR_CHAT_ID, OUTBOX_DB_PATH, OUTBOX_MAX_ATTEMPTS
+import sender
+
+# Пока голова очереди повторяется, остальные ждут: паузы короткие, чтобы одно
+# недоставляемое сообщение не задерживало следующие заказы дольше ~25 с
+_MAX_BACKOFF = 10
+_FLUSH_DELAY = 0.2
+
+class Message:
+    __slots__ = ("id", "chat_id", "text", "created_at", "attempts", "report", "error")
+
+    def __init__(self, id: int, chat_id: int, text: str, created_at: float, attempts: int = 0, report: bool = False):
+        self.id = id
+        self.chat_id = chat_id
+        self.text = text
+        self.created_at = created_at
+        self.attempts = attempts
+        self.report = report  # отчёт о недоставке: сам в dead-letter не уходит
+        self.error: Optional[str] = None  # задано — сообщение уходит в dead-letter
+
+_queue: Deque[Message] = deque()
+_next_id = 1
+_bot = None
+_wakeup: Optional[asyncio.Event] = None
+_latency_ms: deque = deque(maxlen=500)
+delivered = 0
+retries = 0
+dead = 0
+
+_db: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()
+# id -> сообщение для записи (с error — перенос в dead-letter) или None для удаления.
+# Все изменения пишет одна задача _flush по очереди, поэтому более старая запись
+# не может вернуть в outbox сообщение, уже перенесённое в dead-letter.
+_dirty: Dict[int, Optional[Message]] = {}
+_flush_task: Optional[asyncio.Task] = None
+
+# ---------- Хранение ----------
+
+def _connect() -> Optional[sqlite3.Connection]:
+    global _db
+    if _db is None and OUTBOX_DB_PATH:
+        _db = sqlite3.connect(OUTBOX_DB_PATH, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, text TEXT NOT NULL,"
+            " created_at REAL NOT NULL, attempts INTEGER NOT NULL)"
+        )
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letters ("
+            " id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, text TEXT NOT NULL,"
+            " created_at REAL NOT NULL, failed_at REAL NOT NULL, error TEXT NOT NULL)"
+        )
+    return _db
+
+def load():
+    """Недоставленные до остановки уведомления — в начало очереди, в исходном порядке."""
+    global _next_id
+    try:
+        db = _connect()
+        if db is None:
+            return
+        with _db_lock:
+            rows = db.execute("SELECT id, chat_id, text, created_at, attempts FROM outbox ORDER BY id").fetchall()
+            top = db.execute("SELECT MAX(id) FROM (SELECT id FROM outbox UNION ALL SELECT id FROM dead_letters)").fetchone()[0]
+    except sqlite3.Error:
+        logging.exception("Outbox DB %s is unreadable, starting empty", OUTBOX_DB_PATH)
+        return
+    _queue.extend(Message(*row) for row in rows)
+    _next_id = (top or 0) + 1
+    if rows:
+        logging.info("Outbox: %d undelivered operator messages restored", len(rows))
+
+def _write(changes: Dict[int, Optional[Message]]):
+    db = _connect()
+    if db is None:
+        return
+    now = time.time()
+    with _db_lock, db:
+        db.executemany(
+            "INSERT OR REPLACE INTO outbox VALUES (?, ?, ?, ?, ?)",
+            [(m.id, m.chat_id, m.text, m.created_at, m.attempts) for m in changes.values()
+             if m is not None and m.error is None],
+        )
+        db.executemany(
+            "INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?, ?, ?)",
+            [(m.id, m.chat_id, m.text, m.created_at, now, m.error) for m in changes.values()
+             if m is not None and m.error is not None],
+        )
+        db.executemany("DELETE FROM outbox WHERE id = ?",
+                       [(i,) for i, m in changes.items() if m is None or m.error is not None])
+
+async def _flush():
+    global _dirty
+    await asyncio.sleep(_FLUSH_DELAY)
+    while _dirty:
+        changes, _dirty = _dirty, {}
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, _write, changes)
+        except sqlite3.Error:
+            logging.exception("Outbox DB write failed, will retry")
+            for key, m in changes.items():
+                _dirty.setdefault(key, m)
+            await asyncio.sleep(5)
+
+def _mark(msg_id: int, msg: Optional[Message]):
+    global _flush_task
+    if not OUTBOX_DB_PATH:
+        return
+    _dirty[msg_id] = msg
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.get_running_loop().create_task(_flush())
+
+# ---------- Очередь ----------
+
+def send(text: str, chat_id: int = OPERATOR_CHAT_ID, report: bool = False):
+    """Ставит уведомление в очередь; не ждёт Telegram."""
+    global _next_id
+    msg = Message(_next_id, chat_id, text, time.time(), report=report)
+    _next_id += 1
+    _queue.append(msg)
+    if not report:
+        _mark(msg.id, msg)
+    if _wakeup is not None:
+        _wakeup.set()
+
+def _backoff(attempt: int) -> float:
+    return min(_MAX_BACKOFF, 2 ** attempt)
+
+async def _deliver(msg: Message):
+    """Доставляет голову очереди: возвращается, когда сообщение доставлено или ушло в dead-letter."""
+    global delivered, retries, dead
+    while True:
+        msg.attempts += 1
+        try:
+            await sender.call(msg.chat_id, lambda: _bot.send_message(msg.chat_id, msg.text))
+        except (BadRequest, Forbidden) as e:
+            error = repr(e)  # повтор не поможет: неверный текст, бот удалён из чата и т.п.
+        except Exception as e:  # сеть, таймауты, RetryAfter сверх SEND_MAX_RETRIES
+            if msg.attempts < OUTBOX_MAX_ATTEMPTS and not msg.report:
+                retries += 1
+                logging.warning("Operator message %d failed (%r), attempt %d", msg.id, e, msg.attempts)
+                _mark(msg.id, msg)
+                await asyncio.sleep(_backoff(msg.attempts))
+                continue
+            error = repr(e)
+        else:
+            delivered += 1
+            _latency_ms.append(int((time.time() - msg.created_at) * 1000))
+            if not msg.report:
+                _mark(msg.id, None)
+            return
+        if msg.report:
+            logging.error("Dead-letter report could not be delivered: %s", error)
+            return
+        dead += 1
+        logging.error("Operator message %d moved to dead-letter after %d attempts: %s\n%s",
+                      msg.id, msg.attempts, error, msg.text)
+        msg.error = error
+        _mark(msg.id, msg)  # перенос в dead-letter — той же транзакцией, что удаление из outbox
+        head = msg.text.split("\n", 2)[:2]
+        send("⚠️ Не удалось доставить уведомление оператору:\n" + "\n".join(head) + f"\n({error[:200]})",
+             chat_id=msg.chat_id, report=True)
+        return
+
+async def run(app):
+    """Фоновый доставщик; сообщения уходят строго по одному и по порядку."""
+    global _bot, _wakeup
+    _bot = app.bot
+    _wakeup = asyncio.Event()
+    while True:
+        _wakeup.clear()
+        if not _queue:
+            await _wakeup.wait()
+            continue
+        msg = _queue[0]
+        await _deliver(msg)
+        _queue.popleft()
+
+async def stop():
+    if _flush_task is not None:
+        await asyncio.gather(_flush_task, return_exceptions=True)
+
+def stats() -> dict:
+    """Длина очереди, возраст самого старого и задержка доставки (мс) по последним 500."""
+    data = sorted(_latency_ms)
+    return {
+        "backlog": len(_queue),
+        "oldest_age_s": round(time.time() - _queue[0].created_at, 1) if _queue else 0,
+        "delivered": delivered,
+        "retries": retries,
+        "dead": dead,
+        "p50_ms": data[len(data) // 2] if data else None,
+        "p95_ms": data[min(len(data) - 1, int(len(data) * 0.95))] if data else None,
+        "max_ms": data[-1] if data else None,
+    }
@@ -0,0 +1,296 @@
+# Журнал заказов: номера заказов и неизменяемый журнал событий (JSONL, только дозапись).
+# Запись — групповая: пока идёт fsync одной пачки, новые события копятся и уходят
+# следующей пачкой одним fsync, поэтому одновременные оформления не ждут друг друга.
+# Файлы журнала режутся на сегменты; старые сегменты сжимаются в снимок «последнее
+# состояние каждого заказа» без заказов старше ORDER_JOURNAL_RETENTION_DAYS.
+# Индексы по номеру заказа и по пользователю держатся в памяти и строятся при старте.
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import (
+    ORDER_JOURNAL_DIR, ORDER_JOURNAL_SEGMENT_MB, ORDER_JOURNAL_MAX_SEGMENTS,
+    ORDER_JOURNAL_RETENTION_DAYS, ORDER_ID_NODE
+)
+
+# Номера выдаются из блока, зарезервированного на диске: после рестарта счёт
+# продолжается с конца блока, и уже выданный номер (например, в незаконченном
+# оформлении) повториться не может
+_ID_BLOCK = 100
+_SEQ_FILE = "order_seq"
+_PREFIX, _SUFFIX = "orders-", ".jsonl"
+
+_orders: Dict[str, dict] = {}           # номер -> текущее состояние заказа
+_by_user: Dict[int, List[str]] = {}     # пользователь -> его номера, от старых к новым
+_listeners: List[Callable[[dict], None]] = []
+_next_seq = 0
+_reserved = 0
+_id_lock = asyncio.Lock()
+
+_file = None
+_segment = 0
+_io_lock = threading.Lock()
+_queue: List[Tuple[bytes, asyncio.Future]] = []
+_writer: Optional[asyncio.Task] = None
+_compacting = False
+commits = 0
+appended = 0
+
+def _path(name: str) -> str:
+    return os.path.join(ORDER_JOURNAL_DIR, name)
+
+def _segment_name(n: int) -> str:
+    return f"{_PREFIX}{n:06d}{_SUFFIX}"
+
+def _segments() -> List[int]:
+    try:
+        names = os.listdir(ORDER_JOURNAL_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(int(n[len(_PREFIX):-len(_SUFFIX)]) for n in names
+                  if n.startswith(_PREFIX) and n.endswith(_SUFFIX) and n[len(_PREFIX):-len(_SUFFIX)].isdigit())
+
+def _fsync_dir():
+    fd = os.open(ORDER_JOURNAL_DIR, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _replace_durably(tmp: str, dst: str):
+    with open(tmp, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, dst)
+    _fsync_dir()
+
+# ---------- Индексы ----------
+
+def _apply(record: dict):
+    order_id = record["order_id"]
+    state = _orders.get(order_id)
+    if state is None:
+        state = _orders[order_id] = {}
+        user_id = record.get("user_id")
+        if user_id is not None:
+            _by_user.setdefault(user_id, []).append(order_id)
+    state.update(record)
+
+def on_change(listener: Callable[[dict], None]):
+    """Подписка на новые события заказов (при чтении журнала на старте не вызывается)."""
+    _listeners.append(listener)
+
+def all_orders() -> List[dict]:
+    """Все заказы в порядке создания."""
+    return list(_orders.values())
+
+def get(order_id: str) -> Optional[dict]:
+    return _orders.get(order_id)
+
+def orders_of(user_id: int) -> List[dict]:
+    """Заказы пользователя, от новых к старым."""
+    return [_orders[oid] for oid in reversed(_by_user.get(user_id, ())) if oid in _orders]
+
+def _read_segment(n: int):
+    with open(_path(_segment_name(n)), encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.endswith("\n"):
+                break  # оборванная при сбое запись — последняя в файле
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logging.warning("Order journal %s:%d is corrupted, skipped", _segment_name(n), lineno)
+
+def _repair_tail(n: int):
+    # запись, оборванная сбоем, иначе склеилась бы со следующей дозаписью
+    path = _path(_segment_name(n))
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            logging.warning("Order journal %s: torn last record truncated", _segment_name(n))
+
+def load():
+    """Строит индексы по журналу и восстанавливает счётчик номеров."""
+    global _next_seq, _reserved, _segment
+    if not ORDER_JOURNAL_DIR:
+        return
+    os.makedirs(ORDER_JOURNAL_DIR, exist_ok=True)
+    segments = _segments()
+    if segments:
+        _repair_tail(segments[-1])
+    for n in segments:
+        for record in _read_segment(n):
+            _apply(record)
+    _segment = segments[-1] if segments else 1
+    try:
+        with open(_path(_SEQ_FILE)) as f:
+            _reserved = int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        _reserved = 0
+    _next_seq = _reserved
+    logging.info("Order journal: %d orders in %d segments", len(_orders), len(segments))
+
+# ---------- Номера заказов ----------
+
+def _reserve(upto: int):
+    os.makedirs(ORDER_JOURNAL_DIR, exist_ok=True)
+    tmp = _path(_SEQ_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        f.write(str(upto))
+    _replace_durably(tmp, _path(_SEQ_FILE))
+
+async def next_order_id() -> str:
+    """
+    Монотонный номер вида ГГММДД-N (или ГГММДД-метка-N при ORDER_ID_NODE): без совпадений
+    ни между пользователями, ни после рестарта, ни между репликами.
+    """
+    global _next_seq, _reserved
+    async with _id_lock:
+        if _next_seq >= _reserved:
+            upto = _next_seq + _ID_BLOCK
+            if ORDER_JOURNAL_DIR:
+                await asyncio.get_running_loop().run_in_executor(None, _reserve, upto)
+            _reserved = upto
+        _next_seq += 1
+        seq = _next_seq
+    date = datetime.now().strftime('%y%m%d')
+    # метка отделена от счётчика: иначе "1"+"23" и "12"+"3" дали бы один номер
+    return f"{date}-{ORDER_ID_NODE}-{seq}" if ORDER_ID_NODE else f"{date}-{seq}"
+
+# ---------- Запись ----------
+
+def _open_segment():
+    global _file, _segment
+    if not _segment:  # load() не вызывался — журнал пуст
+        os.makedirs(ORDER_JOURNAL_DIR, exist_ok=True)
+        _segment = 1
+    _file = open(_path(_segment_name(_segment)), "ab")
+
+def _write_batch(lines: List[bytes]) -> bool:
+    """Одна пачка — одна запись и один fsync. True — сегмент закрыт, пора сжимать."""
+    global _segment
+    with _io_lock:
+        if _file is None:
+            _open_segment()
+        _file.write(b"".join(lines))
+        _file.flush()
+        os.fsync(_file.fileno())
+        if _file.tell() < ORDER_JOURNAL_SEGMENT_MB * 1024 * 1024:
+            return False
+        _file.close()
+        _segment += 1
+        _open_segment()
+        _fsync_dir()
+        return True
+
+async def _write_loop():
+    global commits
+    loop = asyncio.get_running_loop()
+    while _queue:
+        batch = _queue[:]
+        del _queue[:]
+        try:
+            rotated = await loop.run_in_executor(None, _write_batch, [line for line, _ in batch])
+        except OSError as e:
+            logging.exception("Order journal write failed for %d records", len(batch))
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+        commits += 1
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_result(None)
+        if rotated and len(_segments()) > ORDER_JOURNAL_MAX_SEGMENTS:
+            loop.create_task(compact())
+
+async def append(order_id: str, user_id: Optional[int] = None, **fields):
+    """
+    Дописывает событие заказа (поля сливаются с уже известными) и ждёт, пока оно
+    окажется на диске. Ошибка записи только логируется: оформление она не останавливает.
+    """
+    global _writer, appended
+    record = {"order_id": order_id, "ts": time.time(), **fields}
+    if user_id is not None:
+        record["user_id"] = user_id
+    _apply(record)
+    appended += 1
+    for listener in _listeners:
+        try:
+            listener(_orders[order_id])
+        except Exception:
+            logging.exception("Order journal listener failed")
+    if not ORDER_JOURNAL_DIR:
+        return
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    _queue.append(((json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8"), fut))
+    if _writer is None or _writer.done():
+        _writer = loop.create_task(_write_loop())
+    try:
+        await fut
+    except OSError:
+        pass  # уже залогировано в _write_loop
+
+# ---------- Сжатие ----------
+
+def _compact_closed(closed: List[int], cutoff: float) -> List[str]:
+    """Закрытые сегменты -> один снимок на месте последнего из них. Возвращает выброшенные номера."""
+    state: Dict[str, dict] = {}
+    for n in closed:
+        for record in _read_segment(n):
+            state.setdefault(record["order_id"], {}).update(record)
+    dropped = [oid for oid, s in state.items() if s.get("ts", 0) < cutoff]
+    target = _path(_segment_name(closed[-1]))
+    tmp = target + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for oid, s in state.items():
+            if s.get("ts", 0) >= cutoff:
+                f.write(json.dumps(s, ensure_ascii=False, separators=(",", ":")) + "\n")
+    _replace_durably(tmp, target)
+    # снимок уже на месте: если упадём тут, старые сегменты просто переиграются перед ним
+    for n in closed[:-1]:
+        os.remove(_path(_segment_name(n)))
+    _fsync_dir()
+    return dropped
+
+async def compact():
+    global _compacting
+    if _compacting or not ORDER_JOURNAL_DIR:
+        return
+    closed = [n for n in _segments() if n < _segment]
+    if not closed or (len(closed) < 2 and not ORDER_JOURNAL_RETENTION_DAYS):
+        return
+    _compacting = True
+    try:
+        cutoff = time.time() - ORDER_JOURNAL_RETENTION_DAYS * 86400 if ORDER_JOURNAL_RETENTION_DAYS else 0
+        dropped = await asyncio.get_running_loop().run_in_executor(None, _compact_closed, closed, cutoff)
+        for oid in dropped:
+            state = _orders.get(oid)
+            if state is not None and state.get("ts", 0) < cutoff:
+                del _orders[oid]
+                ids = _by_user.get(state.get("user_id"), [])
+                if oid in ids:
+                    ids.remove(oid)
+        logging.info("Order journal compacted %d segments, %d old orders dropped", len(closed), len(dropped))
+    except OSError:
+        logging.exception("Order journal compaction failed")
+    finally:
+        _compacting = False
+
+async def close():
+    global _file
+    if _writer is not None:
+        await asyncio.gather(_writer, return_exceptions=True)
+    with _io_lock:
+        if _file is not None:
+            _file.close()
+            _file = None
+
+def stats() -> dict:
+    return {"orders": len(_orders), "appended": appended, "commits": commits, "segment": _segment}
@@ -1,18 +1,79 @@
-# payment.py
+# payment.py — асинхронный клиент API ЮKassa.
+# Один пул keep-alive соединений (httpx) на процесс, жёсткие таймауты и повторы с
+# экспоненциальной задержкой. Ключ идемпотентности выводится из заказа, поэтому повтор
+# запроса (или повторное нажатие) не создаёт второй платёж.
+import random
+import asyncio
+import hashlib
+import logging
+from typing import Optional, Tuple
 
-from yookassa import Configuration, Payment
-from config import YOOKASSA_SHOP_ID, YOOKASSA_API_KEY, DOMAIN
-import uuid
+import httpx
 
-# Настройка ЮKassa SDK
-Configuration.account_id = YOOKASSA_SHOP_ID
-Configuration.secret_key = YOOKASSA_API_KEY
+from config import (
+    YOOKASSA_SHOP_ID, YOOKASSA_API_KEY, DOMAIN,
+    YOOKASSA_API_URL, YOOKASSA_TIMEOUT_SECONDS, YOOKASSA_MAX_RETRIES
+)
+
+class PaymentError(Exception):
+    """ЮKassa отклонила запрос или недоступна после всех повторов."""
+
+_client: Optional[httpx.AsyncClient] = None
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=YOOKASSA_API_URL,
+            auth=(YOOKASSA_SHOP_ID or "", YOOKASSA_API_KEY or ""),
+            timeout=httpx.Timeout(YOOKASSA_TIMEOUT_SECONDS, connect=5),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60),
+        )
+    return _client
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def idempotence_key(user_id: int, order_id: str, amount: int) -> str:
+    # сумма входит в ключ: изменил корзину и оформил снова — это уже другой платёж
+    return hashlib.sha1(f"{user_id}:{order_id}:{amount}".encode()).hexdigest()
+
+def _backoff(attempt: int) -> float:
+    return min(8.0, 0.5 * 2 ** attempt) * (0.5 + random.random())
+
+async def _request(method: str, path: str, *, json: Optional[dict] = None,
+                   params: Optional[dict] = None, key: Optional[str] = None) -> dict:
+    headers = {"Idempotence-Key": key} if key else None
+    for attempt in range(YOOKASSA_MAX_RETRIES + 1):
+        try:
+            resp = await _get_client().request(method, path, json=json, params=params, headers=headers)
+        except httpx.TransportError as e:
+            # таймауты и обрывы: POST безопасно повторять с тем же ключом идемпотентности
+            if attempt >= YOOKASSA_MAX_RETRIES:
+                raise PaymentError(f"YooKassa is unreachable: {e!r}") from e
+            logging.warning("YooKassa %s %s failed (%r), retrying", method, path, e)
+        else:
+            if resp.status_code < 400:
+                return resp.json()
+            if resp.status_code != 429 and resp.status_code < 500:
+                raise PaymentError(f"YooKassa {resp.status_code}: {resp.text[:300]}")
+            if attempt >= YOOKASSA_MAX_RETRIES:
+                raise PaymentError(f"YooKassa {resp.status_code} after {attempt + 1} attempts")
+            logging.warning("YooKassa %s %s answered %d, retrying", method, path, resp.status_code)
+        await asyncio.sleep(_backoff(attempt))
+
+def _amount(kopecks: int) -> str:
+    return f"{kopecks // 100}.{kopecks % 100:02d}"
 
 # Создание платежа
-def create_payment(total_amount, user_id):
-    payment = Payment.create({
+async def create_payment(amount: int, user_id: int, order_id: str) -> Tuple[str, str]:
+    """Платёж на amount копеек; возвращает (ссылка на оплату, id платежа)."""
+    payment = await _request("POST", "payments", key=idempotence_key(user_id, order_id, amount), json={
         "amount": {
-            "value": f"{total_amount:.2f}",
+            "value": _amount(amount),
             "currency": "RUB"
         },
         "confirmation": {
@@ -20,10 +81,18 @@ def create_payment(total_amount, user_id):
             "return_url": f"{DOMAIN}/success"
         },
         "capture": True,
-        "description": f"Заказ от Telegram user {user_id}",
+        "description": f"Заказ #{order_id} от Telegram user {user_id}",
         "metadata": {
-            "tg_user_id": user_id
+            "tg_user_id": user_id,
+            "order_id": order_id
         }
-    }, uuid.uuid4())
+    })
+    return payment["confirmation"]["confirmation_url"], str(payment["id"])
+
+async def get_payment(payment_id: str) -> dict:
+    """Текущее состояние платежа — источник правды для уведомлений."""
+    return await _request("GET", f"payments/{payment_id}")
 
-    return payment.confirmation.confirmation_url, str(payment.id)
+async def list_payments(params: dict) -> dict:
+    """Одна страница списка платежей (фильтры created_at.*, cursor, limit ≤ 100)."""
+    return await _request("GET", "payments", params=params)
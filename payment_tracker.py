@@ -0,0 +1,328 @@
+# Онлайн-заказы ждут оплаты: оператор получает заказ только когда ЮKassa подтвердит платёж.
+# Статус приходит уведомлением ЮKassa на встроенный сервер; уведомлению не доверяем —
+# проверяем адрес отправителя и перечитываем платёж через API. Заказы, по которым
+# уведомление не пришло, раз в YOOKASSA_RECONCILE_SECONDS сверяются одним списком
+# платежей за окно времени, а не запросом на каждый заказ. Ожидающие дольше
+# YOOKASSA_PAYMENT_TTL_SECONDS проверяются в последний раз и снимаются с ожидания.
+# С общим хранилищем (STATE_BACKEND=redis) ожидающие платежи лежат в нём: уведомление,
+# пришедшее на любую реплику, закрывает заказ, а снимает его с ожидания ровно одна.
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import ipaddress
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set
+
+from config import (
+    PAYMENTS_DB_PATH, YOOKASSA_NOTIFY_PATH, YOOKASSA_NOTIFY_ALLOWLIST,
+    YOOKASSA_RECONCILE_SECONDS, YOOKASSA_PAYMENT_TTL_SECONDS
+)
+from ui import base_reply_markup
+import payment
+import sender
+import order_journal
+import sheets_export
+import operator_board
+import webhook_server
+
+_FINAL = ("succeeded", "canceled")
+_PAGE_LIMIT = 100
+
+class PendingPayment:
+    __slots__ = ("payment_id", "order_id", "user_id", "chat_id", "amount", "text", "created_at", "order")
+
+    def __init__(self, payment_id: str, order_id: str, user_id: int, chat_id: int,
+                 amount: int, text: str, created_at: float, order: Optional[dict] = None):
+        self.payment_id = payment_id
+        self.order_id = order_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.amount = amount
+        self.text = text
+        self.created_at = created_at
+        self.order = order  # состояние заказа из журнала — для реплики, которая его не оформляла
+
+    def dumps(self) -> str:
+        return json.dumps({name: getattr(self, name) for name in self.__slots__}, ensure_ascii=False)
+
+    @classmethod
+    def loads(cls, blob: str) -> "PendingPayment":
+        return cls(**json.loads(blob))
+
+_pending: Dict[str, PendingPayment] = {}
+_bot = None
+_notify_tasks: Set[asyncio.Task] = set()  # ссылки держим, чтобы задачи не собрал GC
+_db: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()
+_shared_store = None  # RedisStore: ожидающие платежи общие для всех реплик
+
+def set_shared_store(store):
+    global _shared_store
+    _shared_store = store
+
+# ---------- Хранение ----------
+
+def _connect() -> Optional[sqlite3.Connection]:
+    global _db
+    if _db is None and PAYMENTS_DB_PATH:
+        _db = sqlite3.connect(PAYMENTS_DB_PATH, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS payments ("
+            " payment_id TEXT PRIMARY KEY, order_id TEXT NOT NULL, user_id INTEGER NOT NULL,"
+            " chat_id INTEGER NOT NULL, amount INTEGER NOT NULL, text TEXT NOT NULL,"
+            " created_at REAL NOT NULL, status TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        _db.execute("CREATE INDEX IF NOT EXISTS payments_pending ON payments (status, created_at)")
+    return _db
+
+def load():
+    """Неоплаченные заказы с прошлых запусков: их статус ещё может прийти."""
+    try:
+        db = _connect()
+        if db is None:
+            return
+        with _db_lock:
+            rows = db.execute(
+                "SELECT payment_id, order_id, user_id, chat_id, amount, text, created_at"
+                " FROM payments WHERE status = 'pending'"
+            ).fetchall()
+        _pending.update({row[0]: PendingPayment(*row) for row in rows})
+        logging.info("Payments: %d awaiting confirmation", len(_pending))
+    except sqlite3.Error:
+        logging.exception("Payments DB %s is unreadable", PAYMENTS_DB_PATH)
+
+def _write(sql: str, args):
+    db = _connect()
+    if db is None:
+        return
+    with _db_lock:
+        db.execute(sql, args)
+        db.commit()
+
+async def _persist(sql: str, args):
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, _write, sql, args)
+    except sqlite3.Error:
+        logging.exception("Payments DB write failed")
+
+async def register(payment_id: str, order_id: str, user_id: int, chat_id: int, amount: int, text: str):
+    """Онлайн-заказ создан: ждём от ЮKassa succeeded или canceled."""
+    p = PendingPayment(payment_id, order_id, user_id, chat_id, amount, text, time.time(),
+                       dict(order_journal.get(order_id) or {}))
+    if _shared_store is not None:
+        await _shared_store.save_payment(payment_id, p.dumps())
+    _pending[payment_id] = p
+    await _persist(
+        "INSERT OR REPLACE INTO payments VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?)",
+        (payment_id, order_id, user_id, chat_id, amount, text, p.created_at, p.created_at),
+    )
+
+# ---------- Смена статуса ----------
+
+def attach(app):
+    global _bot
+    _bot = app.bot
+
+async def _claim(payment_id: str) -> Optional[PendingPayment]:
+    """
+    Снимает платёж с ожидания; None — его нет или уже снял другой обработчик.
+    Локально — до первого await, поэтому уведомление и сверка, пришедшие одновременно,
+    не известят дважды; между репликами то же обеспечивает атомарное снятие в хранилище.
+    """
+    p = _pending.pop(payment_id, None)
+    if _shared_store is None:
+        return p
+    try:
+        blob = await _shared_store.claim_payment(payment_id)
+    except Exception:
+        logging.exception("Failed to claim payment %s in the shared store", payment_id)
+        if p is not None:
+            _pending[payment_id] = p  # закроем при следующем уведомлении или сверке
+        return None
+    if blob is None:
+        return None  # закрыт другой репликой
+    return p or PendingPayment.loads(blob)
+
+async def _is_pending(payment_id: str) -> bool:
+    if payment_id in _pending:
+        return True
+    if _shared_store is None:
+        return False
+    return await _shared_store.load_payment(payment_id) is not None
+
+async def _journal(p: PendingPayment, status: str):
+    fields = {}
+    if order_journal.get(p.order_id) is None and p.order:
+        # заказ оформлен на другой реплике — переносим его состояние в свой журнал
+        fields = {k: v for k, v in p.order.items() if k not in ("order_id", "ts", "user_id")}
+    fields["status"] = status
+    await order_journal.append(p.order_id, p.user_id, **fields)
+
+async def settle(obj: dict) -> bool:
+    """Применяет состояние платежа, полученное из API ЮKassa. Повторы безопасны."""
+    status = obj.get("status")
+    if status not in _FINAL:
+        return False
+    p = await _claim(obj.get("id"))
+    if p is None:
+        return False
+    await _persist("UPDATE payments SET status = ?, updated_at = ? WHERE payment_id = ?",
+                   (status, time.time(), p.payment_id))
+    await _journal(p, "paid" if status == "succeeded" else "canceled")
+    if status == "succeeded":
+        sheets_export.enqueue(order_journal.get(p.order_id))
+    if _bot is not None:
+        task = asyncio.create_task(_notify(p, status, obj))
+        _notify_tasks.add(task)
+        task.add_done_callback(_notify_tasks.discard)
+    logging.info("Payment %s of order %s: %s", p.payment_id, p.order_id, status)
+    return True
+
+async def expire(p: PendingPayment):
+    """Платёж так и не завершился: заказ снимается с ожидания и больше не сверяется."""
+    p = await _claim(p.payment_id)
+    if p is None:
+        return
+    await _persist("UPDATE payments SET status = 'expired', updated_at = ? WHERE payment_id = ?",
+                   (time.time(), p.payment_id))
+    await _journal(p, "expired")
+    if _bot is not None:
+        task = asyncio.create_task(_send(
+            p.chat_id, f"⏳ Время на оплату заказа #{p.order_id} истекло. Вы можете оформить заказ заново из меню.",
+            reply_markup=base_reply_markup()))
+        _notify_tasks.add(task)
+        task.add_done_callback(_notify_tasks.discard)
+    logging.info("Payment %s of order %s expired unpaid", p.payment_id, p.order_id)
+
+async def _send(chat_id: int, text: str, **kwargs):
+    try:
+        await sender.call(chat_id, lambda: _bot.send_message(chat_id, text, **kwargs))
+    except Exception:
+        logging.exception("Failed to notify chat %s about payment", chat_id)
+
+async def _notify(p: PendingPayment, status: str, obj: dict):
+    if status == "succeeded":
+        operator_board.announce(f"📦 Новый заказ (Онлайн, оплачен)\n{p.text}\n💳 Платёж {p.payment_id}")
+        await _send(p.chat_id, f"✅ Оплата заказа #{p.order_id} получена! Заказ передан оператору, ожидайте звонка.",
+                    reply_markup=base_reply_markup())
+        return
+    reason = (obj.get("cancellation_details") or {}).get("reason", "—")
+    operator_board.announce(f"⚠️ Онлайн-оплата заказа #{p.order_id} отменена ({reason}), заказ не выполняется")
+    await _send(p.chat_id, f"❌ Оплата заказа #{p.order_id} не прошла. Вы можете оформить заказ заново из меню.",
+                reply_markup=base_reply_markup())
+
+# ---------- Уведомления ЮKassa ----------
+
+def _networks(spec: str):
+    if spec.strip() == "*":
+        return None
+    return [ipaddress.ip_network(part.strip()) for part in spec.split(",") if part.strip()]
+
+_allowed_networks = _networks(YOOKASSA_NOTIFY_ALLOWLIST)
+
+def _allowed(remote: str) -> bool:
+    if _allowed_networks is None:
+        return True
+    try:
+        addr = ipaddress.ip_address(remote)
+    except ValueError:
+        return False
+    return any(addr in net for net in _allowed_networks)
+
+async def _notification(request: webhook_server.Request) -> webhook_server.Response:
+    if not _allowed(request.remote):
+        logging.warning("YooKassa notification from untrusted address %s", request.remote)
+        return webhook_server.json_response(403, {"error": "forbidden"})
+    try:
+        payment_id = request.json()["object"]["id"]
+    except (ValueError, KeyError, TypeError):
+        return webhook_server.json_response(400, {"error": "bad notification"})
+    if not await _is_pending(payment_id):
+        return webhook_server.json_response(200, {"ok": True})  # не наш или уже обработан
+    try:
+        # статус берём из API, а не из тела: так поддельное уведомление ничего не изменит
+        obj = await payment.get_payment(payment_id)
+    except payment.PaymentError:
+        logging.exception("Failed to verify payment %s", payment_id)
+        return webhook_server.json_response(502, {"error": "retry later"})  # ЮKassa повторит
+    await settle(obj)
+    return webhook_server.json_response(200, {"ok": True})
+
+def install_routes():
+    webhook_server.add_route("POST", YOOKASSA_NOTIFY_PATH, _notification)
+
+# ---------- Сверка ----------
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+async def _sync_shared():
+    """Сверяет все ожидающие платежи, в том числе созданные на других репликах."""
+    started = time.time()
+    shared = {pid: PendingPayment.loads(blob) for pid, blob in (await _shared_store.load_payments()).items()}
+    for pid, p in list(_pending.items()):
+        # нет в хранилище — закрыт другой репликой (созданные во время чтения не трогаем)
+        if pid not in shared and p.created_at < started:
+            del _pending[pid]
+    for pid, p in shared.items():
+        _pending.setdefault(pid, p)
+
+async def reconcile() -> int:
+    """
+    Заказы без уведомления дольше интервала сверки: одним проходом по списку платежей,
+    созданных с момента самого давнего из них. Просроченные (старше
+    YOOKASSA_PAYMENT_TTL_SECONDS) проверяются поштучно и снимаются с ожидания, поэтому
+    окно сверки не растёт бесконечно. Возвращает число закрытых заказов.
+    """
+    if _shared_store is not None:
+        await _sync_shared()
+    now = time.time()
+    settled = 0
+    for p in [p for p in _pending.values() if now - p.created_at >= YOOKASSA_PAYMENT_TTL_SECONDS]:
+        try:
+            obj = await payment.get_payment(p.payment_id)
+        except payment.PaymentError:
+            if now - p.created_at < 2 * YOOKASSA_PAYMENT_TTL_SECONDS:
+                logging.warning("Failed to check stale payment %s, will retry", p.payment_id)
+                continue
+            logging.exception("Stale payment %s still cannot be checked, giving up", p.payment_id)
+            obj = {}
+        if await settle(obj):
+            settled += 1
+        else:
+            await expire(p)
+    # просроченные в окно списка не берём — иначе одна непроверяемая запись растянет его на всю историю
+    overdue: List[PendingPayment] = [p for p in _pending.values()
+                                     if YOOKASSA_RECONCILE_SECONDS <= now - p.created_at < YOOKASSA_PAYMENT_TTL_SECONDS]
+    if not overdue:
+        return settled
+    params = {"created_at.gte": _iso(min(p.created_at for p in overdue) - 60), "limit": _PAGE_LIMIT}
+    while True:
+        page = await payment.list_payments(params)
+        for obj in page.get("items", []):
+            if await settle(obj):
+                settled += 1
+        cursor = page.get("next_cursor")
+        if not cursor or not _pending:
+            break
+        params = {**params, "cursor": cursor}
+    if settled:
+        logging.info("Payments reconciled: %d settled, %d still pending", settled, len(_pending))
+    return settled
+
+async def reconcile_loop():
+    while True:
+        await asyncio.sleep(YOOKASSA_RECONCILE_SECONDS)
+        try:
+            await reconcile()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Payment reconciliation failed")
+
+def stats() -> dict:
+    return {"pending": len(_pending)}
@@ -0,0 +1,342 @@
+# Сохранение состояния пользователей: user_data, корзина, последний заказ и шаги
+# оформления заказа (ConversationHandler) — поверх хранилища из state_store.
+# Локальное хранилище (SQLite): пользователь читается лениво при первом апдейте, изменения
+# копятся и пишутся пачкой в фоне. Общее (Redis): состояние читается и пишется на каждом
+# апдейте под блокировкой пользователя, чтобы несколько процессов не мешали друг другу.
+import json
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import cart_manager
+from state_store import StateStore, UserRow, ConvRef
+
+# Значения, которые нельзя или незачем переносить через рестарт
+# (qr_jobs — из старых версий, где задачи JobQueue лежали в user_data)
+_TRANSIENT_KEYS = {"qr_jobs"}
+
+_MISSING = object()
+
+def _serializable(data: dict) -> dict:
+    """Копия user_data без служебных и не сериализуемых в JSON значений."""
+    out = {}
+    for k, v in data.items():
+        if k in _TRANSIENT_KEYS:
+            continue
+        try:
+            json.dumps(v)
+        except (TypeError, ValueError):
+            continue
+        out[k] = v
+    return out
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+class StatePersistence(BasePersistence):
+    """
+    BasePersistence только для user_data и диалогов (chat_data/bot_data не используются).
+    PTB раз в update_interval вызывает update_user_data для пользователей с апдейтами;
+    изменившиеся строки копятся и записываются одной пачкой в фоне.
+    """
+
+    def __init__(self, store: StateStore, update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self._app = None
+        self._hydrated = set()
+        self._evicted = set()  # выгружены из памяти (memory_manager), но не удалены
+        self._written: Dict[int, int] = {}  # user_id -> хэш последней записанной строки
+        self._pending_users: Dict[int, UserRow] = {}
+        self._pending_convs: Dict[ConvRef, Optional[str]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        # только для общего хранилища: состояние текущего апдейта
+        self._prefetched: Dict[int, Optional[UserRow]] = {}
+        self._live: Dict[int, dict] = {}
+        self.rows_written = 0
+
+    @property
+    def shared(self) -> bool:
+        return self.store.shared
+
+    def attach(self, app):
+        """Через приложение подменяются состояния диалогов и берётся user_data вне апдейтов."""
+        self._app = app
+
+    def _row(self, user_id: int, data: dict) -> UserRow:
+        cart_rows, last_rows = cart_manager.dump_user(user_id)
+        return _dumps(_serializable(data)), _dumps(cart_rows), _dumps(last_rows)
+
+    # ---------- Фоновая запись (локальное хранилище) ----------
+
+    async def _flush_pending(self, retry: bool = True):
+        while self._pending_users or self._pending_convs:
+            users, self._pending_users = self._pending_users, {}
+            convs, self._pending_convs = self._pending_convs, {}
+            try:
+                if users:
+                    await self.store.save_users(users)
+                if convs:
+                    await self.store.save_conversations(convs)
+                self.rows_written += len(users) + len(convs)
+            except Exception:
+                logging.exception("State write failed for %d users, will retry", len(users))
+                # не теряем: более свежие значения, пришедшие за время записи, важнее
+                for uid, row in users.items():
+                    self._pending_users.setdefault(uid, row)
+                    self._written.pop(uid, None)
+                for key, state in convs.items():
+                    self._pending_convs.setdefault(key, state)
+                if not retry:
+                    return
+                await asyncio.sleep(self.update_interval)
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        await asyncio.sleep(0)  # дать PTB поставить в очередь всех пользователей этого прохода
+        await self._flush_pending()
+
+    # ---------- Общее хранилище: апдейт под блокировкой ----------
+
+    def _conversations(self) -> Dict[str, Any]:
+        # у PTB нет публичного способа перечитать состояние диалога — берём его словари
+        return getattr(self._app, "_conversation_handler_conversations", {}) if self._app else {}
+
+    def _conv_refs(self, update) -> List[Tuple[ConvRef, tuple]]:
+        # ключ диалога для per_chat=True, per_user=True (как у оформления заказа)
+        if update.effective_chat is None:
+            return []
+        key = (update.effective_chat.id, update.effective_user.id)
+        return [((name, _dumps(list(key))), key) for name in self._conversations()]
+
+    @asynccontextmanager
+    async def guard(self, update):
+        """
+        Обёртка обработки апдейта для общего хранилища: блокировка пользователя, чтение
+        его состояния и диалогов одним запросом, после обработки — запись одним запросом.
+        """
+        if not self.shared or update.effective_user is None:
+            yield
+            return
+        user_id = update.effective_user.id
+        refs = self._conv_refs(update)
+        async with self.store.lock(user_id):
+            row, states = await self.store.load_session(user_id, [ref for ref, _ in refs])
+            self._prefetched[user_id] = row
+            # записываем только user_data, которую PTB передал в refresh_user_data на этом апдейте
+            self._live.pop(user_id, None)
+            convs = self._conversations()
+            for (name, ref_key), key in refs:
+                state = states.get((name, ref_key))
+                if state is None:
+                    convs[name].pop(key, None)
+                else:
+                    convs[name][key] = json.loads(state)
+            try:
+                yield
+            finally:
+                self._prefetched.pop(user_id, None)
+                await self._write_through(user_id, refs, row, states)
+
+    async def _write_through(self, user_id: int, refs, loaded_row, loaded_states):
+        data = self._live.get(user_id)
+        row = self._row(user_id, data) if data is not None else None
+        if row == loaded_row:
+            row = None
+        convs = self._conversations()
+        changed = {}
+        for (name, ref_key), key in refs:
+            state = convs[name].get(key)
+            state = None if state is None else _dumps(state)
+            if state != loaded_states.get((name, ref_key)):
+                changed[(name, ref_key)] = state
+        if row is not None or changed:
+            await self.store.save_session(user_id, row, changed)
+
+    @asynccontextmanager
+    async def session(self, user_id: int):
+        """
+        user_data пользователя вне апдейта (таймеры, фоновые задачи): поднимается из
+        хранилища, как на апдейте, а изменения сохраняются так же, как после него.
+        """
+        user_data = self._app._user_data[user_id]  # у PTB нет публичного доступа на запись
+        if not self.shared:
+            await self.refresh_user_data(user_id, user_data)
+            try:
+                yield user_data
+            finally:
+                self._app.mark_data_for_update_persistence(user_ids=user_id)
+            return
+        async with self.store.lock(user_id):
+            row = await self.store.load_user(user_id)
+            self._prefetched[user_id] = row
+            self._live.pop(user_id, None)
+            await self.refresh_user_data(user_id, user_data)
+            try:
+                yield user_data
+            finally:
+                await self._write_through(user_id, [], row, {})
+
+    # ---------- user_data ----------
+
+    async def get_user_data(self) -> Dict[int, Any]:
+        # ничего не читаем при старте: пользователь поднимается с диска при первом апдейте
+        return {}
+
+    def unevict(self, user_id: int):
+        """
+        Пользователь снова активен после выгрузки: drop_user_data опять удаляет его строку,
+        а удаление, которое PTB поставил при выгрузке, отменяется — иначе оно сотрёт
+        только что поднятое состояние.
+        """
+        if user_id in self._evicted:
+            self._evicted.discard(user_id)
+            self._app._user_ids_to_be_deleted_in_persistence.discard(user_id)  # у PTB нет публичной отмены
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self.unevict(user_id)
+        if self.shared:
+            # другой процесс мог изменить состояние — берём прочитанное под блокировкой
+            row = self._prefetched.pop(user_id, _MISSING)
+            if row is _MISSING:
+                row = await self.store.load_user(user_id)
+            self._live[user_id] = user_data
+            user_data.clear()
+            cart_rows, last_rows = [], []
+            if row is not None:
+                user_data.update(json.loads(row[0]))
+                cart_rows, last_rows = json.loads(row[1]), json.loads(row[2])
+            cart_manager.restore_user(user_id, cart_rows, last_rows, replace=True)
+            return
+        if user_id in self._hydrated:
+            return
+        self._hydrated.add(user_id)
+        try:
+            row = await self.store.load_user(user_id)
+        except Exception:
+            logging.exception("Failed to load state of user %s", user_id)
+            self._hydrated.discard(user_id)  # не перезаписываем диск пустым состоянием
+            return
+        if row is None:
+            return
+        data, cart, last = row
+        for k, v in json.loads(data).items():
+            user_data.setdefault(k, v)
+        cart_manager.restore_user(user_id, json.loads(cart), json.loads(last))
+        self._written[user_id] = hash(row)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if self.shared or user_id not in self._hydrated:
+            return  # общее хранилище уже записано в guard()
+        row = self._row(user_id, data)
+        digest = hash(row)
+        if self._written.get(user_id) == digest:
+            return
+        self._written[user_id] = digest
+        self._pending_users[user_id] = row
+        self._schedule_flush()
+
+    async def evict(self, users: Dict[int, dict]) -> List[int]:
+        """
+        Выгрузка простаивающих пользователей из памяти: их строки пишутся на диск сразу,
+        а при следующем апдейте пользователь поднимется с диска, как после рестарта.
+        Возвращает тех, кого можно забыть (у кого запись не удалась — остаются в памяти).
+        """
+        if self.shared:
+            for user_id in users:
+                self._live.pop(user_id, None)
+                self._evicted.add(user_id)
+            return list(users)
+        for user_id, data in users.items():
+            await self.update_user_data(user_id, data)
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._flush_pending(retry=False)
+        evicted = [uid for uid in users if uid not in self._pending_users]
+        for user_id in evicted:
+            self._hydrated.discard(user_id)
+            self._written.pop(user_id, None)
+            self._evicted.add(user_id)
+        return evicted
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicted:
+            # Application.drop_user_data после выгрузки: строку на диске сохраняем
+            self._evicted.discard(user_id)
+            return
+        self._pending_users.pop(user_id, None)
+        self._written.pop(user_id, None)
+        self._hydrated.discard(user_id)
+        self._live.pop(user_id, None)
+        await self.store.delete_user(user_id)
+
+    # ---------- ConversationHandler ----------
+
+    async def get_conversations(self, name: str) -> Dict[tuple, object]:
+        if self.shared:
+            return {}  # состояние диалога подгружается в guard() на каждом апдейте
+        # незавершённых оформлений немного — их читаем сразу
+        rows = await self.store.load_conversations(name)
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows.items()}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        if self.shared:
+            return
+        state = None if new_state is None else _dumps(new_state)
+        self._pending_convs[(name, _dumps(list(key)))] = state
+        self._schedule_flush()
+
+    # ---------- не используется ----------
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    # ---------- остановка ----------
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._flush_pending(retry=False)
+        await self.store.close()
+
+@asynccontextmanager
+async def user_session(app, user_id: int):
+    """user_data пользователя вне апдейта — с сохранением, если оно включено."""
+    if isinstance(app.persistence, StatePersistence):
+        async with app.persistence.session(user_id) as user_data:
+            yield user_data
+    else:
+        yield app._user_data[user_id]
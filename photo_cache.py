@@ -0,0 +1,142 @@
+# Кэш file_id фотографий блюд.
+# Первая отправка фото по URL заставляет Telegram скачать и обработать картинку;
+# дальше отправляем полученный file_id — это мгновенно и не нагружает сервер картинок.
+# Ключ — URL + версия фото (колонка «Версия фото»), кэш переживает рестарт (SQLite).
+import asyncio
+import sqlite3
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+from telegram.error import BadRequest
+
+from config import PHOTO_CACHE_PATH, OPERATOR_CHAT_ID
+from menu_snapshot import Menu
+import sender
+
+_entries: Dict[str, Tuple[str, str]] = {}  # url -> (версия, file_id)
+_db: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()
+
+def _connect() -> Optional[sqlite3.Connection]:
+    global _db
+    if _db is None and PHOTO_CACHE_PATH:
+        _db = sqlite3.connect(PHOTO_CACHE_PATH, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("CREATE TABLE IF NOT EXISTS photos (url TEXT PRIMARY KEY, stamp TEXT NOT NULL, file_id TEXT NOT NULL)")
+    return _db
+
+def load():
+    """Читает кэш с диска при старте."""
+    try:
+        db = _connect()
+        if db is None:
+            return
+        with _db_lock:
+            rows = db.execute("SELECT url, stamp, file_id FROM photos").fetchall()
+        _entries.update({url: (stamp, file_id) for url, stamp, file_id in rows})
+        logging.info("Photo cache: %d file_ids loaded", len(_entries))
+    except sqlite3.Error:
+        logging.exception("Photo cache %s is unreadable, starting empty", PHOTO_CACHE_PATH)
+
+def _write(sql: str, args):
+    db = _connect()
+    if db is None:
+        return
+    with _db_lock:
+        db.executemany(sql, args)
+        db.commit()
+
+async def _persist(sql: str, args):
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, _write, sql, args)
+    except sqlite3.Error:
+        logging.exception("Photo cache write failed")
+
+def get(url: str, stamp: str = "") -> Optional[str]:
+    entry = _entries.get(url)
+    if entry and entry[0] == stamp:
+        return entry[1]
+    return None
+
+async def put(url: str, stamp: str, file_id: str):
+    if _entries.get(url) == (stamp, file_id):
+        return
+    _entries[url] = (stamp, file_id)
+    await _persist("INSERT OR REPLACE INTO photos VALUES (?, ?, ?)", [(url, stamp, file_id)])
+
+async def invalidate(url: str):
+    if _entries.pop(url, None) is not None:
+        await _persist("DELETE FROM photos WHERE url = ?", [(url,)])
+
+def sync_with_menu(menu: Menu):
+    """
+    Новая версия меню: выбрасываем file_id для URL, которых больше нет в меню
+    или у которых сменилась версия фото.
+    """
+    current = {d.photo: d.photo_version for c in menu.categories for d in menu.dishes(c) if d.photo}
+    stale = [url for url, (stamp, _) in _entries.items() if current.get(url) != stamp]
+    if not stale:
+        return
+    for url in stale:
+        _entries.pop(url, None)
+    logging.info("Photo cache: %d stale file_ids dropped", len(stale))
+    try:
+        asyncio.get_running_loop().create_task(_persist("DELETE FROM photos WHERE url = ?", [(u,) for u in stale]))
+    except RuntimeError:
+        _write("DELETE FROM photos WHERE url = ?", [(u,) for u in stale])
+
+def file_id_rejected(e: BadRequest) -> bool:
+    """Ошибка именно из-за file_id (протух, чужой бот), а не из-за подписи или кнопок."""
+    text = str(e).lower()
+    return "file identifier" in text or "file reference" in text or "file_reference" in text
+
+def _file_id_of(message) -> Optional[str]:
+    photos = getattr(message, "photo", None)
+    return photos[-1].file_id if photos else None
+
+async def send_photo(bot, chat_id: int, url: str, stamp: str = "", **kwargs):
+    """send_photo с подстановкой file_id из кэша; file_id с первой удачной отправки запоминается."""
+    file_id = get(url, stamp)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            if not file_id_rejected(e):
+                raise  # подпись, разметка и т.п. — повторная загрузка фото не поможет
+            # file_id больше не принимается — отправим по URL и запомним новый
+            await invalidate(url)
+    sent = await bot.send_photo(chat_id, photo=url, **kwargs)
+    new_id = _file_id_of(sent)
+    if new_id:
+        await put(url, stamp, new_id)
+    return sent
+
+async def prewarm(bot, menu: Menu):
+    """
+    Загружает все ещё не закэшированные фото меню в чат оператора (без звука),
+    запоминает file_id и сразу удаляет служебные сообщения.
+    """
+    todo = {}
+    for c in menu.categories:
+        for d in menu.dishes(c):
+            if d.photo.startswith("http") and get(d.photo, d.photo_version) is None:
+                todo[d.photo] = d.photo_version
+    if not todo:
+        return
+    logging.info("Photo cache: pre-warming %d images", len(todo))
+    for url, stamp in todo.items():
+        try:
+            sent = await sender.call(OPERATOR_CHAT_ID, lambda: bot.send_photo(
+                OPERATOR_CHAT_ID, photo=url, disable_notification=True
+            ))
+        except Exception as e:
+            logging.warning("Photo pre-warm failed for %s: %r", url, e)
+            continue
+        new_id = _file_id_of(sent)
+        if new_id:
+            await put(url, stamp, new_id)
+        try:
+            await bot.delete_message(OPERATOR_CHAT_ID, sent.message_id)
+        except Exception:
+            pass
@@ -0,0 +1,147 @@
+# Исходящая отправка с учётом лимитов Telegram.
+# Token bucket на чат и общий на бота: запросы идут конвейером в пределах квот,
+# а на RetryAfter бакет ставится на паузу и запрос повторяется.
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Any
+
+from telegram.error import RetryAfter
+
+from config import (
+    SEND_GLOBAL_RATE, SEND_GLOBAL_BURST, SEND_PER_CHAT_RATE, SEND_PER_CHAT_BURST,
+    SEND_PIPELINE_DEPTH, SEND_STAGGER_MS, SEND_MAX_RETRIES
+)
+
+class TokenBucket:
+    """Классический token bucket; ожидающие обслуживаются по очереди (FIFO)."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._ts = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self._ts) * self.rate)
+        self._ts = now
+
+    def pause(self, seconds: float):
+        """Telegram попросил подождать (RetryAfter) — не тратим токены до этого момента."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    @property
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst and not self._lock.locked()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+_global = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_BURST)
+_per_chat: Dict[int, TokenBucket] = {}
+
+def _chat_bucket(chat_id: int) -> TokenBucket:
+    bucket = _per_chat.get(chat_id)
+    if bucket is None:
+        if len(_per_chat) > 10000:
+            # полные и свободные бакеты ничего не помнят — их можно выбросить
+            for cid in [c for c, b in _per_chat.items() if b.idle]:
+                del _per_chat[cid]
+        bucket = _per_chat[chat_id] = TokenBucket(SEND_PER_CHAT_RATE, SEND_PER_CHAT_BURST)
+    return bucket
+
+async def acquire(chat_id: int):
+    """Разрешение на один запрос в чат: сначала квота чата, потом общая."""
+    await _chat_bucket(chat_id).acquire()
+    await _global.acquire()
+
+def _retry_delay(e: RetryAfter) -> float:
+    # retry_after — int в PTB 20.x и timedelta в новых версиях
+    ra = e.retry_after
+    return float(ra.total_seconds() if hasattr(ra, "total_seconds") else ra)
+
+async def call(chat_id: int, make_request: Callable[[], Awaitable[Any]], acquired: bool = False):
+    """
+    Один запрос к Bot API в пределах квот, с повтором на RetryAfter.
+    acquired=True — токен на первую попытку уже получен вызывающим.
+    """
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        if not acquired:
+            await acquire(chat_id)
+        acquired = False
+        try:
+            return await make_request()
+        except RetryAfter as e:
+            if attempt >= SEND_MAX_RETRIES:
+                raise
+            delay = _retry_delay(e)
+            logging.warning("Flood limit in chat %s, retry after %.1fs", chat_id, delay)
+            _chat_bucket(chat_id).pause(delay)
+
+# ---------- Метрики отрисовки страниц ----------
+
+_render_ms: deque = deque(maxlen=500)
+
+def render_stats() -> dict:
+    """Латентность отрисовки страниц (мс) по последним 500 страницам."""
+    if not _render_ms:
+        return {"pages": 0}
+    data = sorted(_render_ms)
+    return {
+        "pages": len(data),
+        "p50_ms": data[len(data) // 2],
+        "p95_ms": data[min(len(data) - 1, int(len(data) * 0.95))],
+        "max_ms": data[-1],
+    }
+
+async def send_ordered(chat_id: int, requests: List[Callable[[], Awaitable[Any]]],
+                       label: str = "page") -> List[Optional[Any]]:
+    """
+    Отправляет пачку сообщений в один чат конвейером: до SEND_PIPELINE_DEPTH запросов
+    одновременно. Запросы стартуют строго по порядку, и следующий стартует не раньше,
+    чем предыдущий завершится или пробудет в полёте SEND_STAGGER_MS — этого зазора
+    хватает, чтобы сообщения дошли до Telegram в исходном порядке. Жёсткую гарантию
+    порядка (при любых сетевых задержках и повторах) даёт SEND_PIPELINE_DEPTH=1.
+    Возвращает результаты в исходном порядке; None — сообщение отправить не удалось.
+    """
+    started = time.monotonic()
+    results: List[Optional[Any]] = [None] * len(requests)
+    window = asyncio.Semaphore(max(1, SEND_PIPELINE_DEPTH))
+
+    async def run(i: int, make_request):
+        try:
+            results[i] = await call(chat_id, make_request, acquired=True)
+        except Exception:
+            logging.exception("Failed to send %s item %d to chat %s", label, i, chat_id)
+        finally:
+            window.release()
+
+    tasks = []
+    for i, make_request in enumerate(requests):
+        await window.acquire()
+        await acquire(chat_id)
+        task = asyncio.create_task(run(i, make_request))
+        tasks.append(task)
+        if i + 1 < len(requests):
+            await asyncio.wait({task}, timeout=SEND_STAGGER_MS / 1000)
+    await asyncio.gather(*tasks)
+
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+    _render_ms.append(elapsed_ms)
+    logging.info("Rendered %s: %d messages to chat %s in %d ms", label, len(requests), chat_id, elapsed_ms)
+    return results
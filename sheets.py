@@ -1,50 +1,191 @@
-import os
-import json
-from typing import List, Dict
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from config import SPREADSHEET_ID
+import logging
+from typing import List, Dict, Tuple, Iterator, Iterable
+from config import SPREADSHEET_ID, SHEETS_CHUNK_ROWS, SHEETS_BATCH_CELLS
+from sheets_client import borrow, SCOPES
+from menu_snapshot import Menu, Dish, COLUMNS, parse_price
 
-SCOPES = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
-
-def _load_credentials() -> Credentials:
-
-    json_str = os.getenv("GOOGLE_CREDENTIALS_JSON")
-    if json_str:
-        try:
-            data = json.loads(json_str)
-            return Credentials.from_service_account_info(data, scopes=SCOPES)
-        except Exception:
-            pass  # попробуем другие варианты
-
-def _service():
-    creds = _load_credentials()
-    # cache_discovery=False — чтобы клиент не пытался писать в файловую систему контейнера
-    return build("sheets", "v4", credentials=creds, cache_discovery=False)
+# Если метаданные не прислали размер листа — старый диапазон A1:Z1000
+_DEFAULT_ROWS, _DEFAULT_COLS = 1000, 26
 
 def get_sheet_names() -> List[str]:
     """Возвращает список названий листов таблицы."""
-    svc = _service()
-    meta = svc.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
+    with borrow() as svc:
+        meta = svc.spreadsheets().get(spreadsheetId=SPREADSHEET_ID, fields="sheets.properties.title").execute()
     return [s["properties"]["title"] for s in meta.get("sheets", [])]
 
-def get_dishes_by_sheet(sheet_name: str) -> List[Dict[str, str]]:
+def _column_letter(n: int) -> str:
+    """1 → A, 26 → Z, 27 → AA."""
+    letters = ""
+    while n > 0:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+def _a1(sheet_name: str, cells: str) -> str:
+    """A1-диапазон с экранированием имени листа (пробелы, кавычки, эмодзи)."""
+    return "'" + sheet_name.replace("'", "''") + "'!" + cells
+
+def _plan_chunks(sheet_props: dict) -> List[Tuple[str, int, int]]:
+    """
+    Разбивает лист на куски по SHEETS_CHUNK_ROWS строк по его реальному размеру
+    (gridProperties.rowCount/columnCount). Возвращает [(A1-диапазон, первая строка, клеток), ...].
+    """
+    title = sheet_props["title"]
+    grid = sheet_props.get("gridProperties", {})
+    rows = grid.get("rowCount") or _DEFAULT_ROWS
+    cols = grid.get("columnCount") or _DEFAULT_COLS
+    last_col = _column_letter(cols)
+    chunks = []
+    for first in range(1, rows + 1, SHEETS_CHUNK_ROWS):
+        last = min(first + SHEETS_CHUNK_ROWS - 1, rows)
+        chunks.append((_a1(title, f"A{first}:{last_col}{last}"), first, (last - first + 1) * cols))
+    return chunks
+
+class _ChunkFetcher:
+    """
+    Лениво выбирает куски листов через values.batchGet: в один запрос попадает столько
+    кусков подряд, сколько влезает в SHEETS_BATCH_CELLS. Обычное меню — один запрос;
+    огромный каталог — несколько, и в памяти одновременно лежит только один ответ.
+    """
+
+    def __init__(self, svc, chunks: List[Tuple[str, int, int]]):
+        self._svc = svc
+        self._chunks = chunks
+        self._loaded: Dict[int, List[List[str]]] = {}
+        self.requests = 0
+
+    def take(self, i: int) -> List[List[str]]:
+        if i not in self._loaded:
+            self._fetch_from(i)
+        return self._loaded.pop(i)
+
+    def _fetch_from(self, i: int):
+        batch, cells = [], 0
+        j = i
+        while j < len(self._chunks) and (not batch or cells + self._chunks[j][2] <= SHEETS_BATCH_CELLS):
+            batch.append(j)
+            cells += self._chunks[j][2]
+            j += 1
+        res = self._svc.spreadsheets().values().batchGet(
+            spreadsheetId=SPREADSHEET_ID, ranges=[self._chunks[k][0] for k in batch]
+        ).execute()
+        self.requests += 1
+        # valueRanges приходят в том же порядке, что и ranges в запросе
+        for k, vr in zip(batch, res.get("valueRanges", [])):
+            self._loaded[k] = vr.get("values", [])
+
+def _iter_rows(fetcher: _ChunkFetcher, chunk_ids: Iterable[int], first_rows: List[int]) -> Iterator[Tuple[int, List[str]]]:
+    """(номер строки в таблице, значения) по всем кускам листа, без склейки в один список."""
+    for i in chunk_ids:
+        values = fetcher.take(i)
+        for offset, row in enumerate(values):
+            yield first_rows[i] + offset, row
+        del values
+
+def _iter_dishes(sheet_name: str, rows: Iterator[Tuple[int, List[str]]], problems: List[str]) -> Iterator[Dish]:
     """
-    Возвращает строки листа как список словарей.
+    Разбирает строки листа в Dish по одной: сопоставление заголовков и проверка — один раз, здесь.
     Первая строка — заголовки. Если колонки 'ID' нет — генерируем её как номер строки.
+    Пустые строки пропускаются, битые (нет названия, нечитаемая цена) — пропускаются
+    и попадают в problems, чтобы не ронять корзину и оформление заказа.
+    """
+    header = next(rows, None)
+    if header is None:
+        return
+    headers = [str(h).strip() for h in header[1]]
+    # позиция колонки для каждого известного поля
+    cols = {COLUMNS[h]: i for i, h in enumerate(headers) if h in COLUMNS}
+
+    def cell(row, field):
+        i = cols.get(field)
+        return str(row[i]).strip() if i is not None and i < len(row) else ""
+
+    for row_no, row in rows:
+        if not any(str(v).strip() for v in row):
+            continue
+        name = cell(row, "name")
+        raw_price = cell(row, "price")
+        try:
+            if not name:
+                raise ValueError("no name")
+            price = parse_price(raw_price)
+        except ValueError as e:
+            problems.append(f"{sheet_name}, строка {row_no}: {e}")
+            continue
+        yield Dish(
+            sheet=sheet_name,
+            id=cell(row, "id") or str(row_no - 1),
+            name=name,
+            price=price,
+            grams=cell(row, "grams"),
+            description=cell(row, "description"),
+            photo=cell(row, "photo"),
+            photo_version=cell(row, "photo_version"),
+        )
+
+def get_dishes_by_sheet(sheet_name: str) -> List[Dish]:
+    """Возвращает блюда одного листа."""
+    with borrow() as svc:
+        meta = svc.spreadsheets().get(
+            spreadsheetId=SPREADSHEET_ID, ranges=[_a1(sheet_name, "A1")],
+            fields="sheets.properties(title,gridProperties(rowCount,columnCount))"
+        ).execute()
+        props = [s["properties"] for s in meta.get("sheets", [])]
+        if not props:
+            return []
+        chunks = _plan_chunks(props[0])
+        fetcher = _ChunkFetcher(svc, chunks)
+        problems: List[str] = []
+        dishes = list(_iter_dishes(sheet_name, _iter_rows(fetcher, range(len(chunks)), [c[1] for c in chunks]), problems))
+    for p in problems:
+        logging.warning("Menu row skipped: %s", p)
+    return dishes
+
+def load_menu() -> Menu:
+    """
+    Всё меню: метаданные (названия и размеры листов) и values.batchGet по всем листам —
+    для обычного меню это один запрос. Диапазоны берутся из размеров листов, а строки
+    разбираются потоково и сразу попадают в индексы снимка Menu.
+    """
+    with borrow() as svc:
+        meta = svc.spreadsheets().get(
+            spreadsheetId=SPREADSHEET_ID,
+            fields="sheets.properties(title,gridProperties(rowCount,columnCount))"
+        ).execute()
+        sheets_props = [s["properties"] for s in meta.get("sheets", [])]
+        if not sheets_props:
+            return Menu([])
+
+        chunks: List[Tuple[str, int, int]] = []
+        per_sheet: List[Tuple[str, range]] = []
+        for props in sheets_props:
+            planned = _plan_chunks(props)
+            per_sheet.append((props["title"], range(len(chunks), len(chunks) + len(planned))))
+            chunks.extend(planned)
+
+        fetcher = _ChunkFetcher(svc, chunks)
+        first_rows = [c[1] for c in chunks]
+        problems: List[str] = []
+        # Menu потребляет генераторы по очереди: куски запрашиваются по мере надобности
+        menu = Menu(
+            ((title, _iter_dishes(title, _iter_rows(fetcher, ids, first_rows), problems))
+             for title, ids in per_sheet),
+            problems=problems,
+        )
+    for p in menu.problems:
+        logging.warning("Menu row skipped: %s", p)
+    if fetcher.requests > 1:
+        logging.info("Menu loaded with %d batchGet requests (%d chunks)", fetcher.requests, len(chunks))
+    return menu
+
+def append_rows(spreadsheet_id: str, sheet_name: str, rows: List[List[str]]) -> int:
+    """
+    Дописывает строки в конец листа одним values.append; возвращает число записанных.
+    RAW — текст от пользователей не превращается в формулы.
     """
-    svc = _service()
-    rng = f"{sheet_name}!A1:Z1000"
-    res = svc.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range=rng).execute()
-    values = res.get("values", [])
-    if not values:
-        return []
-
-    headers = [h.strip() for h in values[0]]
-    data: List[Dict[str, str]] = []
-    for idx, row in enumerate(values[1:], start=1):
-        item = {headers[i]: (row[i] if i < len(row) else "") for i in range(len(headers))}
-        if not item.get("ID"):
-            item["ID"] = str(idx)
-        data.append(item)
-    return data
+    with borrow() as svc:
+        res = svc.spreadsheets().values().append(
+            spreadsheetId=spreadsheet_id, range=_a1(sheet_name, "A1"),
+            valueInputOption="RAW", insertDataOption="INSERT_ROWS", body={"values": rows},
+        ).execute()
+    return (res.get("updates") or {}).get("updatedRows", len(rows))
@@ -1,39 +1,215 @@
 import time
 import asyncio
-from typing import Dict, Tuple, List
-from config import SHEETS_CACHE_TTL_SECONDS
-from sheets import get_sheet_names as _sync_get_sheet_names, get_dishes_by_sheet as _sync_get_dishes_by_sheet
+import logging
+from typing import Dict, Tuple, List, Callable, Awaitable, Optional
+from config import (
+    SHEETS_CACHE_TTL_SECONDS, SHEETS_CACHE_MAX_STALE_SECONDS, MENU_SNAPSHOT_PATH,
+    SHEETS_BREAKER_FAILURES, SHEETS_BREAKER_COOLDOWN_SECONDS
+)
+from sheets import load_menu as _sync_load_menu
+from menu_snapshot import Menu, Dish
+import menu_store
 
-# Простой кэш в памяти
+# Простой кэш в памяти. Всё меню хранится одним снимком под ключом _MENU_KEY:
+# одна выборка из Sheets на весь TTL вместо запроса на каждую категорию.
 _cache: Dict[Tuple[str, str], Tuple[float, object]] = {}
 _lock = asyncio.Lock()
+_MENU_KEY = ("menu", "snapshot")
+
+_menu_listeners: List[Callable[[Menu], None]] = []
+
+# Не больше одной выборки на ключ: остальные ждут ту же задачу (без «стада» при истечении TTL)
+_inflight: Dict[Tuple[str, str], "asyncio.Task"] = {}
+
+class _CircuitBreaker:
+    """
+    После N неудач подряд перестаём ходить в Sheets на время cooldown и отдаём
+    последний снимок (из памяти или с диска). По истечении cooldown пропускаем одну
+    пробную выборку: удалась — цепь замыкается, нет — снова ждём cooldown.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.time() - self.opened_at >= self.cooldown:
+            self.opened_at = time.time()  # полуоткрыто: одна попытка на cooldown
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logging.warning("Sheets circuit breaker opened after %d failures", self.failures)
+            self.opened_at = time.time()
+
+_breaker = _CircuitBreaker(SHEETS_BREAKER_FAILURES, SHEETS_BREAKER_COOLDOWN_SECONDS)
 
 def _is_fresh(ts: float) -> bool:
     return (time.time() - ts) < SHEETS_CACHE_TTL_SECONDS
 
-async def get_sheet_names() -> List[str]:
-    """Асинхронно с кэшированием."""
-    key = ("sheets", "names")
+def _is_servable(ts: float) -> bool:
+    """Устаревшую запись ещё можно отдать, пока в фоне идёт обновление."""
+    return (time.time() - ts) < SHEETS_CACHE_MAX_STALE_SECONDS
+
+async def _refresh(key, fetch: Callable[[], Awaitable[object]]):
+    try:
+        try:
+            data = await fetch()
+        except Exception:
+            _breaker.failure()
+            raise
+        _breaker.success()
+        async with _lock:
+            # снимок другого процесса уже постарел: его TTL отсчитывается от выборки из Sheets
+            _cache[key] = (getattr(data, "loaded_at", None) or time.time(), data)
+        return data
+    finally:
+        _inflight.pop(key, None)
+
+def _log_refresh_error(task: "asyncio.Task"):
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning("Sheets cache refresh failed: %r", task.exception())
+
+def _start_refresh(key, fetch) -> "asyncio.Task":
+    """Запускает обновление ключа, если оно ещё не идёт. Вызывать под _lock."""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_refresh(key, fetch))
+        task.add_done_callback(_log_refresh_error)
+        _inflight[key] = task
+    return task
+
+async def _cached(key, fetch):
+    """
+    Свежая запись — отдаём сразу. Устаревшая, но в пределах max-stale — тоже отдаём сразу
+    и запускаем фоновое обновление. Иначе ждём единственную общую выборку.
+    """
     async with _lock:
-        if key in _cache and _is_fresh(_cache[key][0]):
-            return _cache[key][1]
+        entry = _cache.get(key)
+        if entry is not None:
+            if _is_fresh(entry[0]):
+                return entry[1]
+            if key not in _inflight and not _breaker.allow():
+                return entry[1]  # Sheets недоступен — живём на последнем снимке
+            if _is_servable(entry[0]):
+                _start_refresh(key, fetch)
+                return entry[1]
+        task = _start_refresh(key, fetch)
+    # shield: отмена одного ожидающего не должна отменять общую выборку
+    try:
+        return await asyncio.shield(task)
+    except Exception:
+        if entry is None:
+            raise
+        logging.warning("Serving menu older than max-stale: Sheets refresh failed")
+        return entry[1]
+
+# Общее хранилище (STATE_BACKEND=redis): одна выборка из Sheets на все процессы бота
+_shared_store = None
+
+def set_shared_store(store):
+    global _shared_store
+    _shared_store = store
+
+async def _load_shared() -> Optional[Menu]:
+    """Снимок, который недавно выбрал другой процесс, — вместо своего запроса к Sheets."""
+    try:
+        blob = await _shared_store.load_menu()
+    except Exception:
+        logging.warning("Shared menu snapshot is unavailable", exc_info=True)
+        return None
+    menu = menu_store.loads(blob) if blob else None
+    return menu if menu is not None and _is_fresh(menu.loaded_at) else None
+
+async def _fetch_menu() -> Menu:
     loop = asyncio.get_running_loop()
-    data = await loop.run_in_executor(None, _sync_get_sheet_names)
-    async with _lock:
-        _cache[key] = (time.time(), data)
-    return data
+    menu = await _load_shared() if _shared_store is not None else None
+    if menu is None:
+        menu = await loop.run_in_executor(None, _sync_load_menu)
+        if _shared_store is not None:
+            try:
+                await _shared_store.save_menu(menu_store.dumps(menu))
+            except Exception:
+                logging.warning("Failed to share menu snapshot", exc_info=True)
+    current = _cache.get(_MENU_KEY)
+    if current is None or current[1].version != menu.version:
+        if MENU_SNAPSHOT_PATH:
+            try:
+                await loop.run_in_executor(None, menu_store.save, menu, MENU_SNAPSHOT_PATH)
+            except Exception:
+                logging.exception("Failed to persist menu snapshot to %s", MENU_SNAPSHOT_PATH)
+        for listener in _menu_listeners:
+            try:
+                listener(menu)
+            except Exception:
+                logging.exception("Menu change listener %r failed", listener)
+    return menu
+
+def on_menu_change(listener: Callable[[Menu], None]):
+    """Подписка на смену версии меню (например, чтобы сбросить устаревшие file_id фото)."""
+    _menu_listeners.append(listener)
+
+def load_snapshot() -> Optional[Menu]:
+    """
+    Синхронно поднимает снимок с диска при старте (до начала polling).
+    Он считается устаревшим: отдаётся сразу, а обновление из Sheets идёт в фоне.
+    """
+    if not MENU_SNAPSHOT_PATH:
+        return None
+    menu = menu_store.load(MENU_SNAPSHOT_PATH)
+    if menu is not None:
+        _cache[_MENU_KEY] = (time.time() - SHEETS_CACHE_TTL_SECONDS, menu)
+        logging.info("Menu snapshot %s loaded from %s", menu.version, MENU_SNAPSHOT_PATH)
+    return menu
+
+async def get_menu() -> Menu:
+    """Актуальный снимок меню (с кэшированием)."""
+    # снимок подменяется целиком — читатели видят либо старое, либо новое меню
+    return await _cached(_MENU_KEY, _fetch_menu)
+
+def cached_menu() -> Optional[Menu]:
+    """Снимок из памяти без обращения к Sheets (для /health и метрик)."""
+    entry = _cache.get(_MENU_KEY)
+    return entry[1] if entry else None
 
-async def get_dishes_by_sheet(sheet_name: str) -> List[dict]:
+async def get_sheet_names() -> List[str]:
+    """Асинхронно с кэшированием."""
+    return list((await get_menu()).categories)
+
+async def get_dishes_by_sheet(sheet_name: str) -> List[Dish]:
     """Асинхронно с кэшированием по имени листа."""
-    key = ("sheet", sheet_name)
-    async with _lock:
-        if key in _cache and _is_fresh(_cache[key][0]):
-            return _cache[key][1]
-    loop = asyncio.get_running_loop()
-    data = await loop.run_in_executor(None, _sync_get_dishes_by_sheet, sheet_name)
-    async with _lock:
-        _cache[key] = (time.time(), data)
-    return data
+    return list((await get_menu()).dishes(sheet_name))
+
+async def refresh_loop():
+    """
+    Фоновый прогрев: обновляет меню раньше истечения TTL, чтобы пользователь
+    никогда не ждал Sheets — даже после долгого простоя.
+    """
+    interval = max(SHEETS_CACHE_TTL_SECONDS * 0.8, 5)
+    while True:
+        try:
+            async with _lock:
+                task = _inflight.get(_MENU_KEY)
+                if task is None and _breaker.allow():
+                    task = _start_refresh(_MENU_KEY, _fetch_menu)
+            if task is not None:
+                await asyncio.shield(task)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass  # уже залогировано в _log_refresh_error; отдаём устаревший снимок
+        await asyncio.sleep(interval)
 
 async def bust_cache():
     async with _lock:
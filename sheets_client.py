@@ -0,0 +1,171 @@
+# Долгоживущий клиент Google Sheets API.
+# Учётные данные читаются один раз, discovery-документ лежит в репозитории
+# (discovery/sheets_v4.json), а готовые сервисы с собственным HTTP-транспортом
+# живут в ограниченном пуле: поток-исполнитель берёт сервис, делает запрос и возвращает.
+import os
+import json
+import queue
+import logging
+import threading
+import urllib.parse
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from typing import Optional, List, Dict
+
+import httplib2
+import google_auth_httplib2
+from google.oauth2.service_account import Credentials
+from googleapiclient.discovery import build_from_document
+
+from config import (
+    SHEETS_HTTP_POOL_SIZE, SHEETS_HTTP_TIMEOUT_SECONDS, SHEETS_HTTP_POOL_WAIT_SECONDS,
+    SHEETS_TOKEN_REFRESH_MARGIN_SECONDS, SHEETS_REPLAY_FILE, SHEETS_EXPORT_ENABLED
+)
+
+# Запись нужна только выгрузке заказов; без неё ключу достаточно чтения
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets" if SHEETS_EXPORT_ENABLED
+          else "https://www.googleapis.com/auth/spreadsheets.readonly"]
+
+_DISCOVERY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "discovery", "sheets_v4.json")
+
+_creds: Optional[Credentials] = None
+_creds_lock = threading.Lock()
+_discovery: Optional[dict] = None
+
+_pool: "queue.LifoQueue" = queue.LifoQueue(maxsize=SHEETS_HTTP_POOL_SIZE)
+_pool_created = 0
+_pool_lock = threading.Lock()
+
+def _load_credentials() -> Optional[Credentials]:
+    """Ключ сервисного аккаунта: из GOOGLE_CREDENTIALS_JSON или из файла GOOGLE_APPLICATION_CREDENTIALS."""
+    json_str = os.getenv("GOOGLE_CREDENTIALS_JSON")
+    if json_str:
+        try:
+            data = json.loads(json_str)
+            return Credentials.from_service_account_info(data, scopes=SCOPES)
+        except Exception:
+            pass  # попробуем другие варианты
+    path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+    if path and os.path.exists(path):
+        return Credentials.from_service_account_file(path, scopes=SCOPES)
+    return None
+
+def _credentials() -> Optional[Credentials]:
+    """Учётные данные процесса; токен обновляется заранее, до истечения срока."""
+    global _creds
+    with _creds_lock:
+        if _creds is None:
+            _creds = _load_credentials()
+        creds = _creds
+        if creds is None:
+            return None
+        margin = timedelta(seconds=SHEETS_TOKEN_REFRESH_MARGIN_SECONDS)
+        # expiry у google-auth — наивное время в UTC
+        if not creds.token or creds.expiry is None or creds.expiry - margin <= datetime.utcnow():
+            creds.refresh(google_auth_httplib2.Request(httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT_SECONDS)))
+        return creds
+
+def _discovery_document() -> dict:
+    global _discovery
+    if _discovery is None:
+        with open(_DISCOVERY_PATH, encoding="utf-8") as f:
+            _discovery = json.load(f)
+    return _discovery
+
+def _new_service():
+    """Сервис со своим транспортом: httplib2.Http не потокобезопасен, делить его нельзя."""
+    if SHEETS_REPLAY_FILE:
+        http = ReplayHttp(SHEETS_REPLAY_FILE)
+    else:
+        http = google_auth_httplib2.AuthorizedHttp(
+            _credentials(), http=httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT_SECONDS)
+        )
+    return build_from_document(_discovery_document(), http=http)
+
+@contextmanager
+def borrow():
+    """
+    Берёт сервис из пула (или создаёт новый, пока пул не заполнен) и возвращает его после запроса.
+    Если все сервисы заняты — ждём освобождения, но не дольше SHEETS_HTTP_POOL_WAIT_SECONDS.
+    """
+    global _pool_created
+    svc = None
+    try:
+        svc = _pool.get_nowait()
+    except queue.Empty:
+        with _pool_lock:
+            if _pool_created < SHEETS_HTTP_POOL_SIZE:
+                _pool_created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                svc = _new_service()
+            except Exception:
+                with _pool_lock:
+                    _pool_created -= 1
+                raise
+        else:
+            try:
+                svc = _pool.get(timeout=SHEETS_HTTP_POOL_WAIT_SECONDS)
+            except queue.Empty:
+                raise TimeoutError(
+                    f"Sheets: all {SHEETS_HTTP_POOL_SIZE} pooled services busy for {SHEETS_HTTP_POOL_WAIT_SECONDS}s"
+                ) from None
+    broken = False
+    try:
+        # слот уже занят: если продление токена упадёт, finally всё равно вернёт сервис в пул
+        if not SHEETS_REPLAY_FILE:
+            _credentials()  # проактивно продлеваем токен, общий для всех транспортов пула
+        yield svc
+    except (httplib2.HttpLib2Error, OSError):
+        broken = True  # соединение могло остаться в неопределённом состоянии — не возвращаем его
+        raise
+    finally:
+        if broken:
+            with _pool_lock:
+                _pool_created -= 1
+        else:
+            _pool.put_nowait(svc)
+
+def warm_up():
+    """Загружает ключ и discovery заранее (при старте), чтобы первый запрос не платил за это."""
+    _discovery_document()
+    if not SHEETS_REPLAY_FILE:
+        try:
+            _credentials()
+        except Exception:
+            logging.exception("Sheets credentials warm-up failed")
+
+# ---------- Транспорт-заглушка с записанными ответами ----------
+
+class ReplayHttp:
+    """
+    Отдаёт заранее записанные ответы вместо похода в сеть — для офлайн-замеров и отладки.
+    Формат файла: JSON-список {"method", "path", "status", "body"}; path — путь URL без query.
+    Если для пути записано несколько ответов, они отдаются по кругу.
+    """
+
+    def __init__(self, path: str):
+        with open(path, encoding="utf-8") as f:
+            records: List[dict] = json.load(f)
+        self._responses: Dict[tuple, List[dict]] = {}
+        for rec in records:
+            key = (rec.get("method", "GET").upper(), rec["path"])
+            self._responses.setdefault(key, []).append(rec)
+        self._cursor: Dict[tuple, int] = {}
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        path = urllib.parse.urlsplit(uri).path
+        key = (method.upper(), urllib.parse.unquote(path))
+        recs = self._responses.get(key)
+        if not recs:
+            return httplib2.Response({"status": "404"}), b'{"error": {"code": 404, "message": "not recorded"}}'
+        i = self._cursor.get(key, 0)
+        self._cursor[key] = i + 1
+        rec = recs[i % len(recs)]
+        body_out = rec.get("body", {})
+        content = body_out if isinstance(body_out, str) else json.dumps(body_out, ensure_ascii=False)
+        resp = httplib2.Response({"status": str(rec.get("status", 200)), "content-type": "application/json"})
+        return resp, content.encode("utf-8")
@@ -0,0 +1,162 @@
+# Выгрузка принятых заказов в Google Sheets (лист SHEETS_EXPORT_SHEET).
+# Оформление только ставит строку в очередь и ничего не ждёт; фоновая задача дописывает
+# строки пачками через values.append — по SHEETS_EXPORT_BATCH строк или не реже раза
+# в SHEETS_EXPORT_FLUSH_SECONDS, чтобы в час пик не упереться в квоту Sheets.
+# Пока Sheets недоступен — повторы с растущей паузой, а очередь сбрасывается на диск
+# (SHEETS_EXPORT_SPOOL_PATH) и поднимается при старте. Один заказ — одна строка:
+# выгруженные отмечаются в журнале заказов и повторно не ставятся.
+import os
+import json
+import random
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from config import (
+    SHEETS_EXPORT_ENABLED, SHEETS_EXPORT_SPREADSHEET_ID, SHEETS_EXPORT_SHEET,
+    SHEETS_EXPORT_BATCH, SHEETS_EXPORT_FLUSH_SECONDS, SHEETS_EXPORT_SPOOL_PATH
+)
+from menu_snapshot import format_price
+import order_journal
+import sheets
+
+# В Москве нет сезонных переводов — время строки без tzdata
+_MSK = timezone(timedelta(hours=3))
+_METHODS = {"cash": "Наличные", "qr": "QR", "online": "Онлайн"}
+_MAX_BACKOFF = 300
+
+_queue: "OrderedDict[str, List[str]]" = OrderedDict()  # номер заказа -> строка
+_wakeup: Optional[asyncio.Event] = None
+_spilled = False  # на диске лежит очередь, которую надо переписать после успешной выгрузки
+exported_total = 0
+failures = 0
+
+def _row(order: dict) -> List[str]:
+    items = "; ".join(f"{i['qty']} x {i['name']}" for i in order.get("items", []))
+    return [
+        order["order_id"],
+        datetime.now(_MSK).strftime("%d.%m.%Y %H:%M"),
+        _METHODS.get(order.get("method"), order.get("method", "")),
+        order.get("status", ""),
+        order.get("name", ""),
+        order.get("phone", ""),
+        order.get("address", ""),
+        order.get("comment", ""),
+        items,
+        format_price(order.get("total", 0)),
+        str(order.get("user_id", "")),
+    ]
+
+def enqueue(order: Optional[dict]):
+    """Ставит заказ (состояние из order_journal) в очередь выгрузки; не блокирует."""
+    if not SHEETS_EXPORT_ENABLED or not order or order.get("exported"):
+        return
+    order_id = order["order_id"]
+    if order_id in _queue:
+        return
+    _queue[order_id] = _row(order)
+    # первая строка запускает отсчёт SHEETS_EXPORT_FLUSH_SECONDS, полная пачка — выгрузку сразу
+    if _wakeup is not None and (len(_queue) == 1 or len(_queue) >= SHEETS_EXPORT_BATCH):
+        _wakeup.set()
+
+# ---------- Очередь на диске ----------
+
+def _write_spool(entries: List[tuple]):
+    if not entries:
+        if os.path.exists(SHEETS_EXPORT_SPOOL_PATH):
+            os.remove(SHEETS_EXPORT_SPOOL_PATH)
+        return
+    tmp = SHEETS_EXPORT_SPOOL_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for order_id, row in entries:
+            f.write(json.dumps({"order_id": order_id, "row": row}, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, SHEETS_EXPORT_SPOOL_PATH)
+
+async def _spill():
+    global _spilled
+    if not SHEETS_EXPORT_SPOOL_PATH:
+        return
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, _write_spool, list(_queue.items()))
+        _spilled = bool(_queue)
+    except OSError:
+        logging.exception("Sheets export spool write failed")
+
+def load():
+    """Строки, не выгруженные до остановки."""
+    global _spilled
+    if not SHEETS_EXPORT_ENABLED or not SHEETS_EXPORT_SPOOL_PATH:
+        return
+    try:
+        with open(SHEETS_EXPORT_SPOOL_PATH, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if not (order_journal.get(entry["order_id"]) or {}).get("exported"):
+                    _queue[entry["order_id"]] = entry["row"]
+    except FileNotFoundError:
+        return
+    _spilled = True
+    logging.info("Sheets export: %d rows restored from spool", len(_queue))
+
+# ---------- Выгрузка ----------
+
+async def flush_once() -> int:
+    """Одна пачка в один values.append. Исключение — Sheets недоступен, строки остаются в очереди."""
+    global exported_total
+    ids = list(_queue)[:SHEETS_EXPORT_BATCH]
+    if not ids:
+        return 0
+    rows = [_queue[order_id] for order_id in ids]
+    await asyncio.get_running_loop().run_in_executor(
+        None, sheets.append_rows, SHEETS_EXPORT_SPREADSHEET_ID, SHEETS_EXPORT_SHEET, rows
+    )
+    for order_id in ids:
+        _queue.pop(order_id, None)
+    exported_total += len(ids)
+    # отметки попадают в журнал одной групповой записью
+    await asyncio.gather(*(order_journal.append(order_id, exported=True) for order_id in ids))
+    if _spilled:
+        await _spill()
+    return len(ids)
+
+async def run():
+    """Фоновый выгрузчик; запускается из post_init, если выгрузка включена."""
+    global _wakeup, failures
+    _wakeup = asyncio.Event()
+    backoff = 0.0
+    while True:
+        _wakeup.clear()
+        if not _queue:
+            await _wakeup.wait()  # первая строка — отсчёт начинается с неё
+            continue
+        if len(_queue) < SHEETS_EXPORT_BATCH:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), SHEETS_EXPORT_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        try:
+            await flush_once()
+            backoff = 0.0
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            failures += 1
+            backoff = min(_MAX_BACKOFF, max(5.0, backoff * 2))
+            logging.warning("Sheets export failed (%r), %d rows queued, retry in ~%.0fs", e, len(_queue), backoff)
+            await _spill()
+            await asyncio.sleep(backoff * (0.5 + random.random()))
+
+async def stop():
+    """При остановке невыгруженное уходит на диск и поднимется при следующем старте."""
+    if _queue:
+        await _spill()
+
+def stats() -> dict:
+    return {"queued": len(_queue), "exported": exported_total, "failures": failures}
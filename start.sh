@@ -11,5 +11,5 @@ fi
 python -V || true
 pip list || true
 
-# Запуск бота (long polling)
+# Запуск бота (long polling или webhook — см. BOT_MODE)
 python -u bot.py
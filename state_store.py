@@ -0,0 +1,372 @@
+# Хранилища состояния пользователей (user_data, корзина, последний заказ, шаги оформления)
+# и общего снимка меню. STATE_BACKEND выбирает реализацию:
+#   memory — в памяти процесса (тесты, один процесс без сохранения);
+#   sqlite — файл PERSISTENCE_PATH (один процесс, переживает рестарт);
+#   redis  — общий для нескольких процессов/хостов (REDIS_URL).
+import abc
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+import weakref
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, Optional, Tuple
+
+try:
+    import redis.asyncio as aioredis
+    from redis.exceptions import LockError, LockNotOwnedError, RedisError
+except ImportError:  # redis нужен только при STATE_BACKEND=redis
+    aioredis = None
+
+from config import STATE_BACKEND, PERSISTENCE_PATH, REDIS_URL, STATE_KEY_PREFIX, STATE_LOCK_TIMEOUT_SECONDS
+
+UserRow = Tuple[str, str, str]  # JSON: user_data, корзина, последний заказ
+ConvRef = Tuple[str, str]       # (имя ConversationHandler, JSON ключа диалога)
+
+class StateStore(abc.ABC):
+    """
+    Интерфейс хранилища. shared=True — состояние видят другие процессы: его нужно
+    перечитывать на каждом апдейте и записывать сразу, под блокировкой пользователя.
+    Неполная реализация не создаётся (TypeError), а не падает на первом апдейте.
+    """
+    shared = False
+
+    @abc.abstractmethod
+    async def load_user(self, user_id: int) -> Optional[UserRow]:
+        ...
+
+    @abc.abstractmethod
+    async def save_users(self, rows: Dict[int, UserRow]):
+        ...
+
+    @abc.abstractmethod
+    async def delete_user(self, user_id: int):
+        ...
+
+    @abc.abstractmethod
+    async def load_conversations(self, name: str) -> Dict[str, str]:
+        ...
+
+    @abc.abstractmethod
+    async def save_conversations(self, states: Dict[ConvRef, Optional[str]]):
+        ...
+
+    async def load_session(self, user_id: int, convs: Iterable[ConvRef]) -> Tuple[Optional[UserRow], Dict[ConvRef, Optional[str]]]:
+        """Всё состояние пользователя для одного апдейта; сетевые хранилища читают за один запрос."""
+        row = await self.load_user(user_id)
+        states = {}
+        for name, key in convs:
+            states[(name, key)] = (await self.load_conversations(name)).get(key)
+        return row, states
+
+    async def save_session(self, user_id: int, row: Optional[UserRow], convs: Dict[ConvRef, Optional[str]]):
+        if row is not None:
+            await self.save_users({user_id: row})
+        if convs:
+            await self.save_conversations(convs)
+
+    @abc.abstractmethod
+    def lock(self, user_id: int):
+        """Асинхронный контекстный менеджер: эксклюзивный доступ к состоянию пользователя."""
+
+    async def load_menu(self) -> Optional[bytes]:
+        return None
+
+    async def save_menu(self, blob: bytes):
+        pass
+
+    async def close(self):
+        pass
+
+class _LocalLocks:
+    """Блокировки пользователей в пределах процесса; неиспользуемые удаляет сборщик мусора."""
+
+    def __init__(self):
+        self._locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    @asynccontextmanager
+    async def lock(self, user_id: int) -> AsyncIterator[None]:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        async with lock:
+            yield
+
+class MemoryStore(_LocalLocks, StateStore):
+    def __init__(self):
+        super().__init__()
+        self._users: Dict[int, UserRow] = {}
+        self._convs: Dict[str, Dict[str, str]] = {}
+        self._menu: Optional[bytes] = None
+
+    async def load_user(self, user_id):
+        return self._users.get(user_id)
+
+    async def save_users(self, rows):
+        self._users.update(rows)
+
+    async def delete_user(self, user_id):
+        self._users.pop(user_id, None)
+
+    async def load_conversations(self, name):
+        return dict(self._convs.get(name, {}))
+
+    async def save_conversations(self, states):
+        for (name, key), state in states.items():
+            if state is None:
+                self._convs.get(name, {}).pop(key, None)
+            else:
+                self._convs.setdefault(name, {})[key] = state
+
+    async def load_menu(self):
+        return self._menu
+
+    async def save_menu(self, blob):
+        self._menu = blob
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id    INTEGER PRIMARY KEY,
+    data       TEXT NOT NULL,
+    cart       TEXT NOT NULL,
+    last_order TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name  TEXT NOT NULL,
+    key   TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+"""
+
+class SqliteStore(_LocalLocks, StateStore):
+    """SQLite в режиме WAL; запросы идут в пуле потоков, одно соединение под блокировкой."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_SQLITE_SCHEMA)
+        return self._db
+
+    async def _run(self, fn, *args):
+        def locked():
+            with self._db_lock:
+                return fn(self._connect(), *args)
+        return await asyncio.get_running_loop().run_in_executor(None, locked)
+
+    async def load_user(self, user_id):
+        return await self._run(lambda db: db.execute(
+            "SELECT data, cart, last_order FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone())
+
+    async def save_users(self, rows):
+        def write(db):
+            now = time.time()
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)",
+                    [(uid, data, cart, last, now) for uid, (data, cart, last) in rows.items()],
+                )
+        await self._run(write)
+
+    async def delete_user(self, user_id):
+        def write(db):
+            with db:
+                db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        await self._run(write)
+
+    async def load_conversations(self, name):
+        rows = await self._run(lambda db: db.execute(
+            "SELECT key, state FROM conversations WHERE name = ?", (name,)
+        ).fetchall())
+        return dict(rows)
+
+    async def save_conversations(self, states):
+        def write(db):
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                    [(name, key, state) for (name, key), state in states.items() if state is not None],
+                )
+                db.executemany(
+                    "DELETE FROM conversations WHERE name = ? AND key = ?",
+                    [(name, key) for (name, key), state in states.items() if state is None],
+                )
+        await self._run(write)
+
+    async def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+                self._db = None
+
+class RedisStore(StateStore):
+    """
+    Общее хранилище для нескольких процессов. Пользователь — hash {data, cart, last},
+    диалоги — hash на ConversationHandler, меню — одна строка. Чтение и запись состояния
+    пользователя на апдейт — по одному конвейерному запросу; блокировка — SET NX с истечением,
+    которое продлевается, пока обработка апдейта идёт.
+    """
+    shared = True
+
+    def __init__(self, url: str, prefix: str = STATE_KEY_PREFIX, client=None,
+                 lock_timeout: float = STATE_LOCK_TIMEOUT_SECONDS):
+        if client is None:
+            if aioredis is None:
+                raise RuntimeError("STATE_BACKEND=redis requires the 'redis' package")
+            client = aioredis.from_url(url)
+        self._r = client
+        self._prefix = prefix
+        self._lock_timeout = lock_timeout
+
+    def _user_key(self, user_id: int) -> str:
+        return f"{self._prefix}user:{user_id}"
+
+    def _conv_key(self, name: str) -> str:
+        return f"{self._prefix}conv:{name}"
+
+    @staticmethod
+    def _row(values) -> Optional[UserRow]:
+        if values is None or values[0] is None:
+            return None
+        return tuple(v.decode("utf-8") if isinstance(v, bytes) else v for v in values)
+
+    @staticmethod
+    def _text(value) -> Optional[str]:
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    async def load_user(self, user_id):
+        return self._row(await self._r.hmget(self._user_key(user_id), "data", "cart", "last"))
+
+    def _queue_users(self, pipe, rows: Dict[int, UserRow]):
+        for uid, (data, cart, last) in rows.items():
+            pipe.hset(self._user_key(uid), mapping={"data": data, "cart": cart, "last": last})
+
+    def _queue_convs(self, pipe, states: Dict[ConvRef, Optional[str]]):
+        for (name, key), state in states.items():
+            if state is None:
+                pipe.hdel(self._conv_key(name), key)
+            else:
+                pipe.hset(self._conv_key(name), key, state)
+
+    async def save_users(self, rows):
+        if not rows:
+            return
+        async with self._r.pipeline(transaction=False) as pipe:
+            self._queue_users(pipe, rows)
+            await pipe.execute()
+
+    async def delete_user(self, user_id):
+        await self._r.delete(self._user_key(user_id))
+
+    async def load_conversations(self, name):
+        raw = await self._r.hgetall(self._conv_key(name))
+        return {self._text(k): self._text(v) for k, v in raw.items()}
+
+    async def save_conversations(self, states):
+        if not states:
+            return
+        async with self._r.pipeline(transaction=False) as pipe:
+            self._queue_convs(pipe, states)
+            await pipe.execute()
+
+    async def load_session(self, user_id, convs):
+        convs = list(convs)
+        async with self._r.pipeline(transaction=False) as pipe:
+            pipe.hmget(self._user_key(user_id), "data", "cart", "last")
+            for name, key in convs:
+                pipe.hget(self._conv_key(name), key)
+            res = await pipe.execute()
+        return self._row(res[0]), {ref: self._text(v) for ref, v in zip(convs, res[1:])}
+
+    async def save_session(self, user_id, row, convs):
+        async with self._r.pipeline(transaction=False) as pipe:
+            if row is not None:
+                self._queue_users(pipe, {user_id: row})
+            self._queue_convs(pipe, convs)
+            await pipe.execute()
+
+    @asynccontextmanager
+    async def lock(self, user_id):
+        # истечение страхует от упавшего процесса; ждём не дольше того же таймаута
+        lock = self._r.lock(
+            f"{self._prefix}lock:user:{user_id}",
+            timeout=self._lock_timeout,
+            blocking_timeout=self._lock_timeout,
+        )
+        if not await lock.acquire():
+            raise LockError(f"State lock of user {user_id} is busy")
+        # обработка может идти дольше таймаута (Sheets, повторы ЮKassa) — продлеваем, пока она жива
+        watchdog = asyncio.create_task(self._keep_lock(lock, user_id))
+        try:
+            yield
+        finally:
+            watchdog.cancel()
+            await asyncio.gather(watchdog, return_exceptions=True)
+            try:
+                await lock.release()
+            except LockNotOwnedError:
+                logging.warning("State lock of user %s expired before release", user_id)
+
+    async def _keep_lock(self, lock, user_id: int):
+        while True:
+            await asyncio.sleep(self._lock_timeout / 3)
+            try:
+                await lock.extend(self._lock_timeout, replace_ttl=True)
+            except LockNotOwnedError:
+                logging.error("State lock of user %s was lost while the update was running", user_id)
+                return
+            except RedisError as e:
+                logging.warning("Failed to extend state lock of user %s: %r", user_id, e)
+
+    async def load_menu(self):
+        return await self._r.get(f"{self._prefix}menu")
+
+    async def save_menu(self, blob):
+        await self._r.set(f"{self._prefix}menu", blob)
+
+    # ---------- Онлайн-оплаты, ждущие подтверждения (payment_tracker) ----------
+
+    def _payments_key(self) -> str:
+        return f"{self._prefix}payments"
+
+    async def save_payment(self, payment_id: str, blob: str):
+        await self._r.hset(self._payments_key(), payment_id, blob)
+
+    async def load_payment(self, payment_id: str) -> Optional[str]:
+        return self._text(await self._r.hget(self._payments_key(), payment_id))
+
+    async def load_payments(self) -> Dict[str, str]:
+        raw = await self._r.hgetall(self._payments_key())
+        return {self._text(k): self._text(v) for k, v in raw.items()}
+
+    async def claim_payment(self, payment_id: str) -> Optional[str]:
+        """Снимает платёж с ожидания; значение получает только одна реплика — та, что сняла."""
+        async with self._r.pipeline(transaction=True) as pipe:
+            pipe.hget(self._payments_key(), payment_id)
+            pipe.hdel(self._payments_key(), payment_id)
+            value, removed = await pipe.execute()
+        return self._text(value) if removed else None
+
+    async def close(self):
+        await self._r.aclose()
+
+def create_store() -> Optional[StateStore]:
+    """Хранилище по STATE_BACKEND; None — состояние только в памяти PTB, без сохранения."""
+    if STATE_BACKEND == "redis":
+        return RedisStore(REDIS_URL)
+    if STATE_BACKEND == "memory":
+        return MemoryStore()
+    if STATE_BACKEND == "sqlite" and PERSISTENCE_PATH:
+        return SqliteStore(PERSISTENCE_PATH)
+    return None
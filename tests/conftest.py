@@ -0,0 +1,27 @@
+# Окружение для тестов: обязательные переменные и все файлы состояния — во временной папке,
+# чтобы тесты не трогали рабочие базы рядом с ботом. Задаётся до импорта config.
+import os
+import sys
+import tempfile
+
+_TMP = tempfile.mkdtemp(prefix="tfb-tests-")
+
+for _name, _value in (
+    ("BOT_TOKEN", "1:test"),
+    ("OPERATOR_CHAT_ID", "1"),
+    ("SPREADSHEET_ID", "test"),
+    ("QR_IMAGE_URL", "http://test"),
+    ("STATE_BACKEND", "memory"),
+    ("PERSISTENCE_PATH", os.path.join(_TMP, "bot_state.sqlite3")),
+    ("PAYMENTS_DB_PATH", os.path.join(_TMP, "payments.sqlite3")),
+    ("TIMERS_DB_PATH", os.path.join(_TMP, "timers.sqlite3")),
+    ("OUTBOX_DB_PATH", os.path.join(_TMP, "outbox.sqlite3")),
+    ("ORDER_JOURNAL_DIR", os.path.join(_TMP, "orders")),
+    ("MENU_SNAPSHOT_PATH", os.path.join(_TMP, "menu_snapshot.sqlite3")),
+    ("PHOTO_CACHE_PATH", os.path.join(_TMP, "photo_cache.sqlite3")),
+    ("SHEETS_EXPORT_SPOOL_PATH", os.path.join(_TMP, "sheets_export.jsonl")),
+    ("OPERATOR_BOARD_STATE_PATH", os.path.join(_TMP, "operator_board.json")),
+):
+    os.environ.setdefault(_name, _value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,80 @@
+import asyncio
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+
+from handlers import cart
+
+USER = 11
+CHAT = 11
+MESSAGE = 500
+
+class FakeBot:
+    def __init__(self):
+        self.edits = []
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.edits.append(text)
+
+    async def edit_message_reply_markup(self, chat_id, message_id, **kwargs):
+        self.edits.append("markup")
+
+class FakeApp:
+    """Без persistence: user_session отдаёт user_data приложения."""
+
+    def __init__(self):
+        self.bot = FakeBot()
+        self.persistence = None
+        self._user_data = defaultdict(dict)
+
+    def create_task(self, coro):
+        return asyncio.get_running_loop().create_task(coro)
+
+@pytest.fixture
+def basket(monkeypatch):
+    """Корзина — просто счётчик нажатий; отрисовка — его текст."""
+    state = {"count": 0}
+    monkeypatch.setattr(cart, "build_cart_view", lambda user_id: (f"{state['count']} шт.", None))
+    monkeypatch.setattr(cart, "CART_EDIT_DEBOUNCE_MS", 100)
+    monkeypatch.setattr(cart, "_last_edit", {})
+    monkeypatch.setattr(cart, "_pending_refresh", {})
+    return state
+
+async def _tap(app, basket):
+    basket["count"] += 1
+    context = SimpleNamespace(application=app, bot=app.bot, user_data=app._user_data[USER])
+    await cart._refresh(context, CHAT, USER, MESSAGE)
+
+def test_first_tap_edits_at_once_and_burst_is_coalesced(basket):
+    async def scenario():
+        app = FakeApp()
+        await _tap(app, basket)
+        assert app.bot.edits == ["1 шт."]  # без задержки, внутри обработчика
+
+        await _tap(app, basket)
+        await _tap(app, basket)
+        assert app.bot.edits == ["1 шт."]
+
+        await asyncio.sleep(0.15)
+        assert app.bot.edits == ["1 шт.", "3 шт."]
+        # отложенная правка записала отрисовку в user_data — следующая её не повторит
+        assert app._user_data[USER]["cart_render"][0] == "3 шт."
+        assert app._user_data[USER]["cart_message_id"] == MESSAGE
+
+        await asyncio.sleep(0.15)
+        await _tap(app, basket)
+        assert app.bot.edits == ["1 шт.", "3 шт.", "4 шт."]
+
+    asyncio.run(scenario())
+
+def test_unchanged_render_is_not_edited_again(basket):
+    async def scenario():
+        app = FakeApp()
+        await _tap(app, basket)
+        basket["count"] -= 1
+        await asyncio.sleep(0.15)
+        await _tap(app, basket)  # то же число — та же отрисовка
+        assert app.bot.edits == ["1 шт."]
+
+    asyncio.run(scenario())
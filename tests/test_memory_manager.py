@@ -0,0 +1,58 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+import memory_manager
+from persistence import StatePersistence
+from state_store import MemoryStore, SqliteStore
+
+class FakeApp:
+    """Что memory_manager и StatePersistence берут у Application."""
+
+    def __init__(self, persistence):
+        self.persistence = persistence
+        self._user_data = defaultdict(dict)
+        self._user_ids_to_be_deleted_in_persistence = set()
+        self._conversation_handler_conversations = {}
+        persistence.attach(self)
+
+    @property
+    def user_data(self):
+        return self._user_data
+
+    def drop_user_data(self, user_id):
+        # как у PTB: удаление из хранилища — при следующем update_persistence
+        self._user_data.pop(user_id, None)
+        self._user_ids_to_be_deleted_in_persistence.add(user_id)
+
+    def mark_data_for_update_persistence(self, user_ids):
+        pass
+
+def test_eviction_is_disabled_with_memory_store(caplog):
+    app = FakeApp(StatePersistence(MemoryStore()))
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(asyncio.wait_for(memory_manager.sweep_loop(app), 1))
+    assert "Memory eviction disabled" in caplog.text
+
+def test_returning_user_is_not_deleted_by_the_pending_drop(tmp_path):
+    async def scenario():
+        persistence = StatePersistence(SqliteStore(str(tmp_path / "state.sqlite3")))
+        app = FakeApp(persistence)
+        data = app._user_data[3]
+        await persistence.refresh_user_data(3, data)
+        data["name"] = "Иван"
+
+        assert await persistence.evict({3: data}) == [3]
+        app.drop_user_data(3)
+
+        # пользователь вернулся раньше, чем PTB передал удаление в хранилище
+        data = app._user_data[3]
+        await persistence.refresh_user_data(3, data)
+        assert data == {"name": "Иван"}
+        assert app._user_ids_to_be_deleted_in_persistence == set()
+
+        # настоящее удаление после возвращения снова стирает строку
+        await persistence.drop_user_data(3)
+        assert await persistence.store.load_user(3) is None
+
+    asyncio.run(scenario())
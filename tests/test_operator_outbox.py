@@ -0,0 +1,87 @@
+import asyncio
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest, NetworkError
+
+import operator_outbox
+
+OPERATOR = 1
+BACKOFF = operator_outbox._backoff
+
+class FakeBot:
+    """Отвечает по сценарию для каждого текста: исключение — сбой, иначе доставлено."""
+
+    def __init__(self, failures=None):
+        self.failures = {text: deque(errors) for text, errors in (failures or {}).items()}
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        errors = self.failures.get(text)
+        if errors:
+            error = errors[0] if len(errors) == 1 else errors.popleft()
+            raise error
+        self.sent.append(text)
+
+@pytest.fixture(autouse=True)
+def outbox(tmp_path, monkeypatch):
+    monkeypatch.setattr(operator_outbox, "OUTBOX_DB_PATH", str(tmp_path / "outbox.sqlite3"))
+    monkeypatch.setattr(operator_outbox, "_db", None)
+    monkeypatch.setattr(operator_outbox, "_queue", deque())
+    monkeypatch.setattr(operator_outbox, "_dirty", {})
+    monkeypatch.setattr(operator_outbox, "_flush_task", None)
+    monkeypatch.setattr(operator_outbox, "_backoff", lambda attempt: 0)
+    monkeypatch.setattr(operator_outbox, "dead", 0)
+
+def _rows(table: str):
+    return operator_outbox._connect().execute(f"SELECT id, text FROM {table} ORDER BY id").fetchall()
+
+async def _deliver_all(bot, until):
+    task = asyncio.create_task(operator_outbox.run(SimpleNamespace(bot=bot)))
+    try:
+        async def poll():
+            while not until():
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(poll(), 2)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    await operator_outbox.stop()
+
+def test_dead_letter_is_not_resurrected_by_an_earlier_retry_write():
+    async def scenario():
+        # сначала сетевой сбой (запись попытки в outbox), потом окончательный отказ
+        bot = FakeBot({"Заказ 1": [NetworkError("reset"), BadRequest("chat not found")]})
+        operator_outbox.send("Заказ 1", chat_id=OPERATOR)
+        operator_outbox.send("Заказ 2", chat_id=OPERATOR)
+        await _deliver_all(bot, lambda: "Заказ 2" in bot.sent)
+
+        assert _rows("outbox") == []
+        assert [text for _, text in _rows("dead_letters")] == ["Заказ 1"]
+        assert operator_outbox.stats()["dead"] == 1
+        # после рестарта похороненное не доставляется снова
+        operator_outbox._queue.clear()
+        operator_outbox.load()
+        assert list(operator_outbox._queue) == []
+
+    asyncio.run(scenario())
+
+def test_failing_head_gives_way_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(operator_outbox, "OUTBOX_MAX_ATTEMPTS", 3)
+
+    async def scenario():
+        bot = FakeBot({"Заказ 1": [NetworkError("down")]})
+        operator_outbox.send("Заказ 1", chat_id=OPERATOR)
+        operator_outbox.send("Заказ 2", chat_id=OPERATOR)
+        await _deliver_all(bot, lambda: "Заказ 2" in bot.sent)
+
+        assert bot.sent[0] == "Заказ 2"
+        assert bot.sent[1].startswith("⚠️ Не удалось доставить")  # отчёт о недоставке
+        assert operator_outbox.stats()["retries"] >= 2
+
+    asyncio.run(scenario())
+
+def test_default_retries_hold_the_queue_for_under_half_a_minute():
+    blocked = sum(BACKOFF(attempt) for attempt in range(1, operator_outbox.OUTBOX_MAX_ATTEMPTS))
+    assert blocked <= 30
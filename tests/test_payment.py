@@ -0,0 +1,87 @@
+import json
+import asyncio
+
+import httpx
+import pytest
+
+import payment
+
+CREATED = {"id": "pay-1", "status": "pending", "confirmation": {"confirmation_url": "https://pay.test/1"}}
+
+class StandIn:
+    """Подставной API ЮKassa: отвечает по сценарию и запоминает запросы."""
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        answer = self.answers.pop(0) if len(self.answers) > 1 else self.answers[0]
+        if isinstance(answer, Exception):
+            raise answer
+        status, body = answer
+        return httpx.Response(status, json=body)
+
+@pytest.fixture
+def backoffs(monkeypatch):
+    delays = []
+    monkeypatch.setattr(payment, "_backoff", lambda attempt: delays.append(attempt) or 0)
+    return delays
+
+def _install(monkeypatch, stand_in: StandIn):
+    client = httpx.AsyncClient(base_url="https://api.test/v3/", transport=httpx.MockTransport(stand_in))
+    monkeypatch.setattr(payment, "_client", client)
+    monkeypatch.setattr(payment, "YOOKASSA_MAX_RETRIES", 3)
+
+def test_5xx_and_timeouts_are_retried_with_the_same_idempotence_key(monkeypatch, backoffs):
+    stand_in = StandIn((500, {}), httpx.ReadTimeout("slow"), (503, {}), (200, CREATED))
+    _install(monkeypatch, stand_in)
+
+    url, payment_id = asyncio.run(payment.create_payment(50050, 7, "261017-1"))
+
+    assert (url, payment_id) == ("https://pay.test/1", "pay-1")
+    assert len(stand_in.requests) == 4
+    assert backoffs == [0, 1, 2]
+    keys = {r.headers["Idempotence-Key"] for r in stand_in.requests}
+    assert keys == {payment.idempotence_key(7, "261017-1", 50050)}
+    assert json.loads(stand_in.requests[0].content)["amount"] == {"value": "500.50", "currency": "RUB"}
+
+def test_429_is_retried(monkeypatch, backoffs):
+    stand_in = StandIn((429, {}), (200, {"id": "pay-1", "status": "succeeded"}))
+    _install(monkeypatch, stand_in)
+    assert asyncio.run(payment.get_payment("pay-1"))["status"] == "succeeded"
+    assert len(stand_in.requests) == 2
+
+def test_4xx_is_not_retried(monkeypatch, backoffs):
+    stand_in = StandIn((400, {"type": "error", "description": "bad amount"}))
+    _install(monkeypatch, stand_in)
+    with pytest.raises(payment.PaymentError, match="400"):
+        asyncio.run(payment.create_payment(100, 7, "261017-2"))
+    assert len(stand_in.requests) == 1
+    assert backoffs == []
+
+def test_error_surfaces_after_all_retries(monkeypatch, backoffs):
+    stand_in = StandIn((502, {}))
+    _install(monkeypatch, stand_in)
+    with pytest.raises(payment.PaymentError, match="502 after 4 attempts"):
+        asyncio.run(payment.get_payment("pay-1"))
+    assert len(stand_in.requests) == 4
+
+def test_unreachable_api_surfaces_as_payment_error(monkeypatch, backoffs):
+    stand_in = StandIn(httpx.ConnectError("refused"))
+    _install(monkeypatch, stand_in)
+    with pytest.raises(payment.PaymentError, match="unreachable"):
+        asyncio.run(payment.list_payments({"limit": 100}))
+    assert len(stand_in.requests) == 4
+
+def test_idempotence_key_is_stable_per_order_and_amount():
+    key = payment.idempotence_key(7, "261017-1", 50050)
+    assert key == payment.idempotence_key(7, "261017-1", 50050)
+    assert key != payment.idempotence_key(7, "261017-1", 50100)
+    assert key != payment.idempotence_key(7, "261017-2", 50050)
+
+def test_backoff_grows_and_is_capped():
+    for attempt in range(10):
+        base = min(8.0, 0.5 * 2 ** attempt)
+        assert base * 0.5 <= payment._backoff(attempt) <= base * 1.5
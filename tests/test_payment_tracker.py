@@ -0,0 +1,163 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+import order_journal
+import payment
+import payment_tracker
+import webhook_server
+from state_store import RedisStore
+
+YOOKASSA_IP = "185.71.76.1"
+
+@pytest.fixture(autouse=True)
+def clean_tracker(monkeypatch):
+    payment_tracker._pending.clear()
+    monkeypatch.setattr(payment_tracker, "_shared_store", None)
+    monkeypatch.setattr(payment_tracker, "_bot", None)
+    yield
+    payment_tracker._pending.clear()
+
+class FakeYooKassa:
+    """Состояние платежей «в ЮKassa»: get_payment и постраничный list_payments."""
+
+    def __init__(self, payments=None, page_size=2):
+        self.payments = dict(payments or {})
+        self.page_size = page_size
+        self.list_calls = []
+
+    async def get_payment(self, payment_id):
+        if payment_id not in self.payments:
+            raise payment.PaymentError(f"404 {payment_id}")
+        return {"id": payment_id, "status": self.payments[payment_id]}
+
+    async def list_payments(self, params):
+        self.list_calls.append(params)
+        ids = sorted(self.payments)
+        start = int(params.get("cursor", 0))
+        page = ids[start:start + self.page_size]
+        more = start + self.page_size < len(ids)
+        return {"items": [{"id": i, "status": self.payments[i]} for i in page],
+                "next_cursor": str(start + self.page_size) if more else None}
+
+@pytest.fixture
+def yookassa(monkeypatch):
+    fake = FakeYooKassa()
+    monkeypatch.setattr(payment, "get_payment", fake.get_payment)
+    monkeypatch.setattr(payment, "list_payments", fake.list_payments)
+    return fake
+
+def _notification(payment_id: str, status: str = "succeeded", remote: str = YOOKASSA_IP):
+    body = ('{"type":"notification","event":"payment.%s","object":{"id":"%s","status":"%s"}}'
+            % (status, payment_id, status)).encode()
+    return webhook_server.Request("POST", "/yookassa", "", {}, body, remote)
+
+async def _register(payment_id: str, order_id: str):
+    await order_journal.append(order_id, 42, status="awaiting_payment", method="online", total=500)
+    await payment_tracker.register(payment_id, order_id, 42, 42, 50000, "заказ")
+
+def test_notification_on_another_replica_settles_once_through_shared_store(yookassa):
+    async def scenario():
+        server = fakeredis.FakeServer()
+        payment_tracker.set_shared_store(RedisStore("", client=fakeredis.FakeAsyncRedis(server=server)))
+        await _register("pay-shared", "O-shared")
+        local = payment_tracker._pending.pop("pay-shared")  # на другой реплике его в памяти нет
+        yookassa.payments["pay-shared"] = "succeeded"
+
+        status, _, _ = await payment_tracker._notification(_notification("pay-shared"))
+        assert status == 200
+        assert order_journal.get("O-shared")["status"] == "paid"
+        assert payment_tracker.stats()["pending"] == 0
+
+        # исходная реплика узнаёт о том же платеже (сверка) — второй раз не закрывает
+        payment_tracker._pending["pay-shared"] = local
+        assert await payment_tracker.settle({"id": "pay-shared", "status": "succeeded"}) is False
+
+    asyncio.run(scenario())
+
+def test_notification_from_unlisted_address_is_rejected(yookassa):
+    async def scenario():
+        await _register("pay-ip", "O-ip")
+        yookassa.payments["pay-ip"] = "succeeded"
+        status, _, _ = await payment_tracker._notification(_notification("pay-ip", remote="203.0.113.7"))
+        assert status == 403
+        assert "pay-ip" in payment_tracker._pending
+
+    asyncio.run(scenario())
+
+def test_notification_contradicted_by_api_is_ignored(yookassa):
+    async def scenario():
+        await _register("pay-forged", "O-forged")
+        yookassa.payments["pay-forged"] = "pending"  # в теле уведомления — succeeded
+        status, _, _ = await payment_tracker._notification(_notification("pay-forged", "succeeded"))
+        assert status == 200
+        assert "pay-forged" in payment_tracker._pending
+        assert order_journal.get("O-forged")["status"] == "awaiting_payment"
+
+    asyncio.run(scenario())
+
+def test_duplicate_notifications_settle_once(yookassa, monkeypatch):
+    async def scenario():
+        await _register("pay-dup", "O-dup")
+        yookassa.payments["pay-dup"] = "succeeded"
+        appended = []
+        original = order_journal.append
+
+        async def counting_append(order_id, *args, **fields):
+            appended.append((order_id, fields.get("status")))
+            await original(order_id, *args, **fields)
+
+        monkeypatch.setattr(order_journal, "append", counting_append)
+        results = await asyncio.gather(*(payment_tracker._notification(_notification("pay-dup")) for _ in range(3)))
+        assert [status for status, _, _ in results] == [200, 200, 200]
+        assert await payment_tracker.settle({"id": "pay-dup", "status": "succeeded"}) is False
+        assert appended == [("O-dup", "paid")]
+
+    asyncio.run(scenario())
+
+def test_reconcile_pages_through_the_payment_list(yookassa):
+    async def scenario():
+        for i in range(5):
+            await _register(f"pay-{i}", f"O-page-{i}")
+            payment_tracker._pending[f"pay-{i}"].created_at -= payment_tracker.YOOKASSA_RECONCILE_SECONDS + 1
+        yookassa.payments.update({f"pay-{i}": "succeeded" for i in range(4)})
+        yookassa.payments["pay-4"] = "canceled"
+        yookassa.payments.update({"other-a": "succeeded", "other-b": "pending"})  # чужие платежи магазина
+
+        assert await payment_tracker.reconcile() == 5
+        assert payment_tracker.stats()["pending"] == 0
+        assert [call.get("cursor") for call in yookassa.list_calls] == [None, "2", "4", "6"]
+        assert all(call["limit"] == payment_tracker._PAGE_LIMIT for call in yookassa.list_calls)
+        assert order_journal.get("O-page-4")["status"] == "canceled"
+
+    asyncio.run(scenario())
+
+def test_reconcile_skips_payments_younger_than_the_interval(yookassa):
+    async def scenario():
+        await _register("pay-fresh", "O-fresh")
+        yookassa.payments["pay-fresh"] = "succeeded"
+        assert await payment_tracker.reconcile() == 0
+        assert yookassa.list_calls == []
+
+    asyncio.run(scenario())
+
+def test_payments_older_than_ttl_expire(yookassa, monkeypatch):
+    monkeypatch.setattr(payment_tracker, "YOOKASSA_PAYMENT_TTL_SECONDS", 1000)
+
+    async def scenario():
+        for pid, age in (("pay-late", 1500), ("pay-stuck", 1500), ("pay-gone", 2500), ("pay-flaky", 1500)):
+            await _register(pid, "O-" + pid)
+            payment_tracker._pending[pid].created_at -= age
+        yookassa.payments.update({"pay-late": "succeeded", "pay-stuck": "pending"})
+        # pay-gone и pay-flaky API не отдаёт: первый старше 2×TTL — снимается, второй ждёт повтора
+
+        assert await payment_tracker.reconcile() == 1
+        assert order_journal.get("O-pay-late")["status"] == "paid"
+        assert order_journal.get("O-pay-stuck")["status"] == "expired"
+        assert order_journal.get("O-pay-gone")["status"] == "expired"
+        assert set(payment_tracker._pending) == {"pay-flaky"}
+        # просроченный не растягивает окно списка платежей
+        assert yookassa.list_calls == []
+
+    asyncio.run(scenario())
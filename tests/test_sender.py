@@ -0,0 +1,150 @@
+import time
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+import sender
+from sender import TokenBucket
+
+@pytest.fixture(autouse=True)
+def buckets(monkeypatch):
+    """Быстрые квоты: весь тест укладывается в доли секунды."""
+    monkeypatch.setattr(sender, "_global", TokenBucket(1000, 1000))
+    monkeypatch.setattr(sender, "_per_chat", {})
+    monkeypatch.setattr(sender, "SEND_PER_CHAT_RATE", 1000)
+    monkeypatch.setattr(sender, "SEND_PER_CHAT_BURST", 1000)
+
+async def _timed(n: int, acquire) -> float:
+    started = time.monotonic()
+    for _ in range(n):
+        await acquire()
+    return time.monotonic() - started
+
+def test_bucket_gives_burst_at_once_then_paces_at_rate():
+    async def scenario():
+        bucket = TokenBucket(rate=20, burst=3)
+        assert await _timed(3, bucket.acquire) < 0.02
+        assert 0.18 <= await _timed(4, bucket.acquire) < 0.4  # 4 токена по 1/20 с
+
+    asyncio.run(scenario())
+
+def test_bucket_serves_waiters_in_order():
+    async def scenario():
+        bucket = TokenBucket(rate=50, burst=1)
+        served = []
+
+        async def waiter(i):
+            await bucket.acquire()
+            served.append(i)
+
+        await asyncio.gather(*(waiter(i) for i in range(5)))
+        assert served == [0, 1, 2, 3, 4]
+
+    asyncio.run(scenario())
+
+def test_paused_bucket_waits_out_the_pause():
+    async def scenario():
+        bucket = TokenBucket(rate=1000, burst=10)
+        bucket.pause(0.15)
+        assert await _timed(1, bucket.acquire) >= 0.14
+
+    asyncio.run(scenario())
+
+def test_per_chat_quota_does_not_slow_other_chats(monkeypatch):
+    monkeypatch.setattr(sender, "SEND_PER_CHAT_RATE", 10)
+    monkeypatch.setattr(sender, "SEND_PER_CHAT_BURST", 2)
+
+    async def scenario():
+        assert 0.08 <= await _timed(3, lambda: sender.acquire(1)) < 0.3  # третий ждёт 1/10 с
+        assert await _timed(2, lambda: sender.acquire(2)) < 0.02
+
+    asyncio.run(scenario())
+
+def test_global_quota_is_shared_by_all_chats(monkeypatch):
+    monkeypatch.setattr(sender, "_global", TokenBucket(rate=10, burst=2))
+
+    async def scenario():
+        await sender.acquire(1)
+        await sender.acquire(2)
+        assert 0.08 <= await _timed(1, lambda: sender.acquire(3)) < 0.3
+
+    asyncio.run(scenario())
+
+def test_call_retries_after_flood_limit():
+    async def scenario():
+        attempts = []
+
+        async def request():
+            attempts.append(time.monotonic())
+            if len(attempts) < 3:
+                raise RetryAfter(0.1)
+            return "sent"
+
+        assert await sender.call(5, request) == "sent"
+        assert len(attempts) == 3
+        # каждый повтор — не раньше, чем через retry_after
+        assert all(b - a >= 0.09 for a, b in zip(attempts, attempts[1:]))
+
+    asyncio.run(scenario())
+
+def test_call_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(sender, "SEND_MAX_RETRIES", 2)
+
+    async def scenario():
+        attempts = []
+
+        async def request():
+            attempts.append(1)
+            raise RetryAfter(0.01)
+
+        with pytest.raises(RetryAfter):
+            await sender.call(5, request)
+        assert len(attempts) == 3
+
+    asyncio.run(scenario())
+
+def test_send_ordered_starts_in_order_with_stagger_and_bounded_window(monkeypatch):
+    monkeypatch.setattr(sender, "SEND_PIPELINE_DEPTH", 3)
+    monkeypatch.setattr(sender, "SEND_STAGGER_MS", 30)
+
+    async def scenario():
+        starts, in_flight, peak = [], [0], [0]
+
+        def make(i):
+            async def request():
+                starts.append((i, time.monotonic()))
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+                try:
+                    await asyncio.sleep(0.2)
+                    if i == 4:
+                        raise RuntimeError("bad photo")
+                    return f"msg-{i}"
+                finally:
+                    in_flight[0] -= 1
+            return request
+
+        results = await sender.send_ordered(5, [make(i) for i in range(6)], label="test")
+        assert [i for i, _ in starts] == list(range(6))
+        # пока предыдущий в полёте, следующий стартует не раньше зазора
+        assert all(b - a >= 0.025 for (_, a), (_, b) in zip(starts, starts[1:]))
+        assert peak[0] == 3
+        assert results == ["msg-0", "msg-1", "msg-2", "msg-3", None, "msg-5"]
+        assert sender.render_stats()["pages"] >= 1
+
+    asyncio.run(scenario())
+
+def test_send_ordered_does_not_wait_for_stagger_after_fast_reply(monkeypatch):
+    monkeypatch.setattr(sender, "SEND_PIPELINE_DEPTH", 3)
+    monkeypatch.setattr(sender, "SEND_STAGGER_MS", 500)
+
+    async def scenario():
+        async def request():
+            return "ok"
+
+        started = time.monotonic()
+        assert await sender.send_ordered(5, [request] * 4) == ["ok"] * 4
+        assert time.monotonic() - started < 0.2  # зазор ждём, только пока предыдущий в полёте
+
+    asyncio.run(scenario())
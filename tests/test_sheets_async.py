@@ -0,0 +1,47 @@
+import time
+import asyncio
+
+import pytest
+
+import menu_store
+import sheets_async
+from menu_snapshot import Menu
+from state_store import MemoryStore
+
+@pytest.fixture(autouse=True)
+def clean_cache(monkeypatch):
+    sheets_async._cache.clear()
+    sheets_async._inflight.clear()
+    monkeypatch.setattr(sheets_async, "MENU_SNAPSHOT_PATH", "")
+    monkeypatch.setattr(sheets_async, "SHEETS_CACHE_TTL_SECONDS", 100)
+    monkeypatch.setattr(sheets_async, "_shared_store", None)
+    yield
+    sheets_async._cache.clear()
+
+def test_shared_snapshot_keeps_its_own_age(monkeypatch):
+    fetched = []
+
+    def load_from_sheets():
+        fetched.append(1)
+        return Menu([("Пицца", [])])
+
+    monkeypatch.setattr(sheets_async, "_sync_load_menu", load_from_sheets)
+
+    async def scenario():
+        store = MemoryStore()
+        shared = Menu([("Пицца", [])], loaded_at=time.time() - 70)  # другой процесс выбрал 70 с назад
+        await store.save_menu(menu_store.dumps(shared))
+        sheets_async.set_shared_store(store)
+
+        menu = await sheets_async.get_menu()
+        assert menu.version == shared.version and fetched == []
+        cached_at, _ = sheets_async._cache[sheets_async._MENU_KEY]
+        assert cached_at == pytest.approx(shared.loaded_at)
+
+        # через 40 с снимку 110 с — он устарел, хотя в этом процессе пролежал меньше TTL
+        monkeypatch.setattr(sheets_async.time, "time", lambda real=time.time: real() + 40)
+        await sheets_async.get_menu()
+        await asyncio.gather(*sheets_async._inflight.values())
+        assert fetched == [1]
+
+    asyncio.run(scenario())
@@ -0,0 +1,94 @@
+import json
+import queue
+
+import httplib2
+import pytest
+from google.auth.exceptions import RefreshError
+
+import sheets
+import sheets_client
+
+SPREADSHEET = "menu-sheet"
+META = {"sheets": [
+    {"properties": {"title": "Пицца", "gridProperties": {"rowCount": 4, "columnCount": 3}}},
+    {"properties": {"title": "Напитки", "gridProperties": {"rowCount": 3, "columnCount": 3}}},
+]}
+VALUES = {"valueRanges": [
+    {"values": [["ID", "Название блюда", "Цена"], ["p1", "Маргарита", "450"], [], ["p2", "", "500"]]},
+    {"values": [["ID", "Название блюда", "Цена"], ["d1", "Морс", "120,50"]]},
+]}
+
+class CountingReplay(sheets_client.ReplayHttp):
+    """ReplayHttp, который считает созданные транспорты и запросы."""
+
+    created = 0
+    requests = []
+
+    def __init__(self, path):
+        super().__init__(path)
+        CountingReplay.created += 1
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        CountingReplay.requests.append(uri)
+        return super().request(uri, method, body, headers, **kwargs)
+
+@pytest.fixture(autouse=True)
+def pool(tmp_path, monkeypatch):
+    path = tmp_path / "replay.json"
+    path.write_text(json.dumps([
+        {"path": f"/v4/spreadsheets/{SPREADSHEET}", "body": META},
+        {"path": f"/v4/spreadsheets/{SPREADSHEET}/values:batchGet", "body": VALUES},
+    ], ensure_ascii=False), encoding="utf-8")
+    CountingReplay.created, CountingReplay.requests = 0, []
+    monkeypatch.setattr(sheets, "SPREADSHEET_ID", SPREADSHEET)
+    monkeypatch.setattr(sheets_client, "SHEETS_REPLAY_FILE", str(path))
+    monkeypatch.setattr(sheets_client, "ReplayHttp", CountingReplay)
+    monkeypatch.setattr(sheets_client, "SHEETS_HTTP_POOL_SIZE", 2)
+    monkeypatch.setattr(sheets_client, "SHEETS_HTTP_POOL_WAIT_SECONDS", 0.05)
+    monkeypatch.setattr(sheets_client, "_pool", queue.LifoQueue(maxsize=2))
+    monkeypatch.setattr(sheets_client, "_pool_created", 0)
+
+def test_load_menu_takes_two_requests():
+    menu = sheets.load_menu()
+    assert len(CountingReplay.requests) == 2  # метаданные + один values.batchGet
+    assert menu.categories == ("Пицца", "Напитки")
+    assert [(d.id, d.name, d.price) for d in menu.dishes("Пицца")] == [("p1", "Маргарита", 45000)]
+    assert [d.price for d in menu.dishes("Напитки")] == [12050]
+    assert menu.problems == ("Пицца, строка 4: no name",)
+
+def test_services_are_reused_and_the_pool_is_bounded():
+    with sheets_client.borrow() as first:
+        with sheets_client.borrow() as second:
+            assert first is not second
+            with pytest.raises(TimeoutError):
+                with sheets_client.borrow():
+                    pass
+    assert sheets_client._pool.qsize() == 2
+    for _ in range(3):
+        sheets.load_menu()
+    assert CountingReplay.created == 2  # новые запросы берут готовые сервисы
+
+def test_service_returns_to_the_pool_when_token_refresh_fails(monkeypatch):
+    monkeypatch.setattr(sheets_client, "SHEETS_REPLAY_FILE", "")
+    service = object()
+    monkeypatch.setattr(sheets_client, "_new_service", lambda: service)
+
+    def refresh_fails():
+        raise RefreshError("invalid_grant")
+
+    monkeypatch.setattr(sheets_client, "_credentials", refresh_fails)
+    for _ in range(3):  # больше, чем размер пула: слоты не утекают
+        with pytest.raises(RefreshError):
+            with sheets_client.borrow():
+                pass
+    assert sheets_client._pool_created == 1
+    assert sheets_client._pool.get_nowait() is service
+
+def test_broken_connection_is_not_returned():
+    with pytest.raises(httplib2.HttpLib2Error):
+        with sheets_client.borrow():
+            raise httplib2.ServerNotFoundError("dns")
+    assert sheets_client._pool.qsize() == 0
+    assert sheets_client._pool_created == 0
+    sheets.load_menu()  # место освободилось — создаётся новый сервис
+    assert CountingReplay.created == 2
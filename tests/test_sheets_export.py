@@ -0,0 +1,175 @@
+import os
+import json
+import queue
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+import order_journal
+import sheets_client
+import sheets_export
+
+SPREADSHEET = "export-sheet"
+APPEND_PATH = f"/v4/spreadsheets/{SPREADSHEET}/values/'Заказы'!A1:append"
+OK = {"method": "POST", "path": APPEND_PATH, "status": 200, "body": {"updates": {"updatedRows": 1}}}
+DOWN = {"method": "POST", "path": APPEND_PATH, "status": 503, "body": {"error": {"code": 503, "message": "unavailable"}}}
+
+class RecordingReplay(sheets_client.ReplayHttp):
+    """ReplayHttp, который ещё и запоминает строки из каждого values.append."""
+
+    appends = []
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        resp, content = super().request(uri, method, body, headers, **kwargs)
+        if resp.status == 200:
+            RecordingReplay.appends.append(json.loads(body)["values"])
+        return resp, content
+
+@pytest.fixture
+def replay(tmp_path, monkeypatch):
+    """Sheets из записанных ответов; пул и очередь выгрузки — с чистого листа."""
+    path = tmp_path / "replay.json"
+
+    def record(*responses):
+        path.write_text(json.dumps(list(responses), ensure_ascii=False), encoding="utf-8")
+
+    record(OK)
+    RecordingReplay.appends = []
+    monkeypatch.setattr(sheets_client, "SHEETS_REPLAY_FILE", str(path))
+    monkeypatch.setattr(sheets_client, "ReplayHttp", RecordingReplay)
+    monkeypatch.setattr(sheets_client, "_pool", queue.LifoQueue(maxsize=sheets_client.SHEETS_HTTP_POOL_SIZE))
+    monkeypatch.setattr(sheets_client, "_pool_created", 0)
+    monkeypatch.setattr(sheets_export, "SHEETS_EXPORT_ENABLED", True)
+    monkeypatch.setattr(sheets_export, "SHEETS_EXPORT_SPREADSHEET_ID", SPREADSHEET)
+    monkeypatch.setattr(sheets_export, "SHEETS_EXPORT_SHEET", "Заказы")
+    monkeypatch.setattr(sheets_export, "SHEETS_EXPORT_SPOOL_PATH", str(tmp_path / "spool.jsonl"))
+    monkeypatch.setattr(sheets_export, "_spilled", False)
+    monkeypatch.setattr(sheets_export, "failures", 0)
+    sheets_export._queue.clear()
+    yield record
+    sheets_export._queue.clear()
+
+async def _order(order_id: str) -> dict:
+    await order_journal.append(order_id, 42, status="accepted", method="cash", total=500,
+                               name="Иван", items=[{"qty": 2, "name": "Пицца"}])
+    return order_journal.get(order_id)
+
+@asynccontextmanager
+async def _exporter():
+    """Фоновый выгрузчик на время блока."""
+    task = asyncio.create_task(sheets_export.run())
+    await asyncio.sleep(0)  # run() успел создать событие пробуждения
+    try:
+        yield
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+async def _wait_for(until, timeout: float = 2.0):
+    async def poll():
+        while not until():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+def test_order_is_queued_once_and_marked_exported(replay):
+    async def scenario():
+        order = await _order("E-dedup")
+        sheets_export.enqueue(order)
+        sheets_export.enqueue(order)
+        assert sheets_export.stats()["queued"] == 1
+
+        assert await sheets_export.flush_once() == 1
+        [[row]] = RecordingReplay.appends
+        assert row[0] == "E-dedup" and row[2] == "Наличные" and row[8] == "2 x Пицца"
+        assert order_journal.get("E-dedup")["exported"] is True
+
+        # уже выгруженный заказ повторно не ставится
+        sheets_export.enqueue(order_journal.get("E-dedup"))
+        assert sheets_export.stats()["queued"] == 0
+
+    asyncio.run(scenario())
+
+def test_full_batch_is_flushed_at_once(replay, monkeypatch):
+    monkeypatch.setattr(sheets_export, "SHEETS_EXPORT_BATCH", 3)
+    monkeypatch.setattr(sheets_export, "SHEETS_EXPORT_FLUSH_SECONDS", 60)
+
+    async def scenario():
+        orders = [await _order(f"E-batch-{i}") for i in range(3)]
+        async with _exporter():
+            for order in orders:
+                sheets_export.enqueue(order)
+            await _wait_for(lambda: RecordingReplay.appends, timeout=1.0)
+        assert [[row[0] for row in rows] for rows in RecordingReplay.appends] == [["E-batch-0", "E-batch-1", "E-batch-2"]]
+
+    asyncio.run(scenario())
+
+def test_partial_batch_is_flushed_after_the_interval(replay, monkeypatch):
+    monkeypatch.setattr(sheets_export, "SHEETS_EXPORT_BATCH", 50)
+    monkeypatch.setattr(sheets_export, "SHEETS_EXPORT_FLUSH_SECONDS", 0.2)
+
+    async def scenario():
+        order = await _order("E-timer")
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        async with _exporter():
+            sheets_export.enqueue(order)
+            await asyncio.sleep(0.1)
+            assert RecordingReplay.appends == []  # пачка ещё добирается
+            await _wait_for(lambda: RecordingReplay.appends)
+        assert loop.time() - started >= 0.2
+        assert [[row[0] for row in rows] for rows in RecordingReplay.appends] == [["E-timer"]]
+
+    asyncio.run(scenario())
+
+def test_failures_back_off_and_spill_to_disk(replay, monkeypatch):
+    replay(DOWN, DOWN, DOWN, OK)
+    delays = []
+    real_sleep = asyncio.sleep
+
+    async def fast_sleep(delay, *args):
+        delays.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(sheets_export.random, "random", lambda: 0.5)
+    monkeypatch.setattr(sheets_export.asyncio, "sleep", fast_sleep)
+    monkeypatch.setattr(sheets_export, "SHEETS_EXPORT_FLUSH_SECONDS", 0.01)
+
+    async def scenario():
+        sheets_export.enqueue(await _order("E-down"))
+        spilled = []
+        original_spill = sheets_export._spill
+
+        async def watching_spill():
+            await original_spill()
+            spilled.append(os.path.exists(sheets_export.SHEETS_EXPORT_SPOOL_PATH))
+
+        monkeypatch.setattr(sheets_export, "_spill", watching_spill)
+        async with _exporter():
+            await _wait_for(lambda: len(spilled) == 4)
+        assert [d for d in delays if d >= 1] == [5.0, 10.0, 20.0]
+        assert sheets_export.stats()["failures"] == 3
+        # при каждом сбое очередь на диске, после успешной выгрузки файл убран
+        assert spilled == [True, True, True, False]
+        assert not os.path.exists(sheets_export.SHEETS_EXPORT_SPOOL_PATH)
+        assert order_journal.get("E-down")["exported"] is True
+
+    asyncio.run(scenario())
+
+def test_spool_survives_restart(replay):
+    async def scenario():
+        for order_id in ("E-spool-1", "E-spool-2"):
+            sheets_export.enqueue(await _order(order_id))
+        await sheets_export.stop()
+        sheets_export._queue.clear()  # «перезапуск»
+
+        # пока процесс лежал, один заказ успел выгрузиться (например, другой копией)
+        await order_journal.append("E-spool-2", exported=True)
+        sheets_export.load()
+        assert list(sheets_export._queue) == ["E-spool-1"]
+
+        assert await sheets_export.flush_once() == 1
+        assert [[row[0] for row in rows] for rows in RecordingReplay.appends] == [["E-spool-1"]]
+        assert not os.path.exists(sheets_export.SHEETS_EXPORT_SPOOL_PATH)
+
+    asyncio.run(scenario())
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+import fakeredis
+import pytest
+
+from telegram import Chat, Message, Update, User
+
+from persistence import StatePersistence
+from state_store import MemoryStore, RedisStore, SqliteStore, StateStore
+
+LOCK_TIMEOUT = 0.3
+
+class FakeApp:
+    """То, что StatePersistence берёт у Application: user_data и словари диалогов."""
+
+    def __init__(self):
+        self._user_data = defaultdict(dict)
+        self._conversation_handler_conversations = {"checkout": {}}
+        self.marked = []
+
+    def mark_data_for_update_persistence(self, user_ids):
+        self.marked.append(user_ids)
+
+def _replica(server: fakeredis.FakeServer):
+    store = RedisStore("", client=fakeredis.FakeAsyncRedis(server=server), lock_timeout=LOCK_TIMEOUT)
+    persistence = StatePersistence(store)
+    app = FakeApp()
+    persistence.attach(app)
+    return persistence, app
+
+def _update(user_id: int) -> Update:
+    chat = Chat(user_id, Chat.PRIVATE)
+    return Update(1, message=Message(1, None, chat, from_user=User(user_id, "Test", is_bot=False), text="hi"))
+
+def test_session_row_and_conversations_round_trip():
+    async def scenario():
+        store = RedisStore("", client=fakeredis.FakeAsyncRedis())
+        row = ('{"name":"Иван"}', "[]", "[]")
+        await store.save_session(5, row, {("checkout", "[5,5]"): "2"})
+        loaded, states = await store.load_session(5, [("checkout", "[5,5]"), ("checkout", "[6,6]")])
+        assert loaded == row
+        assert states == {("checkout", "[5,5]"): "2", ("checkout", "[6,6]"): None}
+        await store.save_conversations({("checkout", "[5,5]"): None})
+        assert await store.load_conversations("checkout") == {}
+
+    asyncio.run(scenario())
+
+def test_lock_is_renewed_while_body_runs_longer_than_timeout():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        first = RedisStore("", client=fakeredis.FakeAsyncRedis(server=server), lock_timeout=LOCK_TIMEOUT)
+        second = RedisStore("", client=fakeredis.FakeAsyncRedis(server=server), lock_timeout=3)
+        events = []
+
+        async def long_update():
+            async with first.lock(1):
+                events.append("first-start")
+                await asyncio.sleep(LOCK_TIMEOUT * 4)
+                events.append("first-end")
+
+        async def other_replica():
+            await asyncio.sleep(LOCK_TIMEOUT)
+            async with second.lock(1):
+                events.append("second")
+
+        await asyncio.gather(long_update(), other_replica())
+        assert events == ["first-start", "first-end", "second"]
+
+    asyncio.run(scenario())
+
+def test_lost_lock_does_not_raise_on_release(caplog):
+    async def scenario():
+        client = fakeredis.FakeAsyncRedis()
+        store = RedisStore("", client=client, lock_timeout=LOCK_TIMEOUT)
+        async with store.lock(1):
+            await client.delete("tfb:lock:user:1")  # истекла или её сняли вручную
+
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(scenario())
+    assert "expired before release" in caplog.text
+
+def test_guard_writes_through_and_other_replica_sees_it():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        (p1, app1), (p2, app2) = _replica(server), _replica(server)
+        update = _update(7)
+
+        async with p1.guard(update):
+            data = app1._user_data[7]
+            await p1.refresh_user_data(7, data)
+            data["name"] = "Иван"
+            app1._conversation_handler_conversations["checkout"][(7, 7)] = 1
+
+        async with p2.guard(update):
+            data = app2._user_data[7]
+            await p2.refresh_user_data(7, data)
+            assert data == {"name": "Иван"}
+            assert app2._conversation_handler_conversations["checkout"][(7, 7)] == 1
+            data["name"] = "Пётр"
+            del app2._conversation_handler_conversations["checkout"][(7, 7)]
+
+        async with p1.guard(update):
+            data = app1._user_data[7]
+            await p1.refresh_user_data(7, data)
+            assert data == {"name": "Пётр"}
+            assert (7, 7) not in app1._conversation_handler_conversations["checkout"]
+
+    asyncio.run(scenario())
+
+def test_session_saves_changes_even_if_body_fails():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        (p1, _), (p2, app2) = _replica(server), _replica(server)
+        try:
+            async with p1.session(9) as data:
+                data["awaiting_qr_confirm"] = False
+                raise RuntimeError("timer body failed")
+        except RuntimeError:
+            pass
+        async with p2.session(9) as data:
+            assert data == {"awaiting_qr_confirm": False}
+
+    asyncio.run(scenario())
+
+def test_incomplete_backend_fails_at_creation():
+    class NoLocks(StateStore):
+        async def load_user(self, user_id): ...
+        async def save_users(self, rows): ...
+        async def delete_user(self, user_id): ...
+        async def load_conversations(self, name): ...
+        async def save_conversations(self, states): ...
+
+    with pytest.raises(TypeError):
+        NoLocks()
+    MemoryStore()
+    SqliteStore(":memory:")
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+import timers
+
+@pytest.fixture(autouse=True)
+def clean_timers(monkeypatch):
+    monkeypatch.setattr(timers, "_handlers", {})
+    monkeypatch.setattr(timers, "_timers", {})
+    monkeypatch.setattr(timers, "_heap", [])
+    monkeypatch.setattr(timers, "_firing", set())
+    monkeypatch.setattr(timers, "TIMERS_DB_PATH", "")
+
+async def _wait_for(until, timeout: float = 2.0):
+    async def poll():
+        while not until():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+def test_slow_handler_does_not_delay_later_deadlines():
+    async def scenario():
+        fired = []
+
+        async def slow(app, batch):
+            await asyncio.sleep(0.5)
+            fired.append("slow")
+
+        async def fast(app, batch):
+            fired.append("fast")
+
+        timers.register("slow", slow)
+        timers.register("fast", fast)
+        timers.start(None)
+        timers.schedule("a", "slow", 0)
+        timers.schedule("b", "fast", 0.05)
+        await _wait_for(lambda: fired)
+        assert fired == ["fast"]
+        assert timers.stats()["firing"] == 1
+        await timers.stop()  # даёт медленному дойти до конца
+        assert fired == ["fast", "slow"]
+
+    asyncio.run(scenario())
+
+def test_handlers_in_flight_are_bounded(monkeypatch):
+    monkeypatch.setattr(timers, "TIMERS_FIRE_CONCURRENCY", 2)
+    monkeypatch.setattr(timers, "FIRE_BATCH", 1)
+
+    async def scenario():
+        running, peak, done = [0], [0], []
+
+        async def handler(app, batch):
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            await asyncio.sleep(0.05)
+            running[0] -= 1
+            done.extend(t.key for t in batch)
+
+        timers.register("reminder", handler)
+        timers.start(None)
+        for i in range(6):
+            timers.schedule(f"t{i}", "reminder", 0)
+        await _wait_for(lambda: len(done) == 6)
+        assert peak[0] == 2
+        await timers.stop()
+
+    asyncio.run(scenario())
+
+def test_failing_handler_frees_its_slot(monkeypatch, caplog):
+    monkeypatch.setattr(timers, "TIMERS_FIRE_CONCURRENCY", 1)
+
+    async def scenario():
+        fired = []
+
+        async def broken(app, batch):
+            raise RuntimeError("boom")
+
+        async def ok(app, batch):
+            fired.append(batch[0].key)
+
+        timers.register("broken", broken)
+        timers.register("ok", ok)
+        timers.start(None)
+        timers.schedule("x", "broken", 0)
+        timers.schedule("y", "ok", 0.02)
+        await _wait_for(lambda: fired)
+        assert fired == ["y"]
+        await timers.stop()
+
+    asyncio.run(scenario())
+    assert "Timer handler broken failed" in caplog.text
@@ -0,0 +1,45 @@
+import asyncio
+from datetime import datetime
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+from update_processor import OrderedUpdateProcessor
+
+_USER = User(7, "Test", is_bot=False)
+_CHAT = Chat(7, Chat.PRIVATE)
+
+def _tap(update_id: int, data: str) -> Update:
+    message = Message(100, datetime.now(), _CHAT)
+    return Update(update_id, callback_query=CallbackQuery(str(update_id), _USER, "ci", message=message, data=data))
+
+def _run_taps(*data: str) -> list:
+    """Первое нажатие держит очередь пользователя, остальные ждут за ним; возвращает выполненные."""
+    async def scenario():
+        processor = OrderedUpdateProcessor(concurrency=4, max_pending=10)
+        release = asyncio.Event()
+        done = []
+
+        async def handle(value: str, wait: bool = False):
+            if wait:
+                await release.wait()
+            done.append(value)
+
+        tasks = [asyncio.create_task(processor.do_process_update(_tap(0, "pg:0:Меню"), handle("hold", True)))]
+        await asyncio.sleep(0)
+        for i, value in enumerate(data, 1):
+            tasks.append(asyncio.create_task(processor.do_process_update(_tap(i, value), handle(value))))
+            await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*tasks)
+        return done[1:]
+
+    return asyncio.run(scenario())
+
+def test_repeated_add_taps_are_all_processed():
+    assert _run_taps("add:Меню:1", "add:Меню:1") == ["add:Меню:1", "add:Меню:1"]
+
+def test_repeated_inc_dec_taps_are_all_processed():
+    assert _run_taps("inc:a", "inc:a", "dec:a", "dec:a") == ["inc:a", "inc:a", "dec:a", "dec:a"]
+
+def test_repeated_navigation_taps_are_merged():
+    assert _run_taps("pg:1:Меню", "pg:1:Меню", "back") == ["pg:1:Меню", "back"]
@@ -0,0 +1,122 @@
+import json
+import asyncio
+
+import pytest
+
+import webhook_server
+
+SECRET = "s3cret"
+UPDATE = {"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 5, "type": "private"}, "text": "hi"}}
+
+class FakeApp:
+    def __init__(self):
+        self.bot = None
+        self.running = True
+        self.update_queue = asyncio.Queue()
+        self.update_processor = None
+
+@pytest.fixture(autouse=True)
+def clean_registry(monkeypatch):
+    monkeypatch.setattr(webhook_server, "_routes", {})
+    monkeypatch.setattr(webhook_server, "_health_providers", {})
+
+async def _start():
+    app = FakeApp()
+    webhook_server.install_telegram_routes(app, "/telegram", SECRET)
+    webhook_server.add_health_provider("answer", lambda: 42)
+    server = webhook_server.Server()
+    await server.start("127.0.0.1", 0)
+    port = server._server.sockets[0].getsockname()[1]
+    return app, server, port
+
+def _request(method: str, path: str, body: bytes = b"", headers: dict = None) -> bytes:
+    head = [f"{method} {path} HTTP/1.1", "Host: test"]
+    headers = {"Content-Length": str(len(body)), **(headers or {})}
+    head += [f"{k}: {v}" for k, v in headers.items()]
+    return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+async def _read_response(reader) -> tuple:
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ")[1])
+    headers = {k.strip().lower(): v.strip() for k, v in (l.split(":", 1) for l in lines[1:] if ":" in l)}
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return status, headers, body
+
+async def _exchange(port: int, *requests: bytes) -> list:
+    """Запросы по одному соединению (keep-alive); ответы по порядку."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    responses = []
+    try:
+        for raw in requests:
+            writer.write(raw)
+            await writer.drain()
+            responses.append(await _read_response(reader))
+    finally:
+        writer.close()
+    return responses
+
+def _run(scenario):
+    async def main():
+        app, server, port = await _start()
+        try:
+            await scenario(app, port)
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+def test_update_with_secret_is_queued():
+    async def scenario(app, port):
+        body = json.dumps(UPDATE).encode()
+        [(status, _, _)] = await _exchange(port, _request(
+            "POST", "/telegram", body, {"X-Telegram-Bot-Api-Secret-Token": SECRET}))
+        assert status == 200
+        update = app.update_queue.get_nowait()
+        assert update.update_id == 1 and update.message.text == "hi"
+    _run(scenario)
+
+def test_wrong_secret_is_rejected():
+    async def scenario(app, port):
+        body = json.dumps(UPDATE).encode()
+        [(status, _, _)] = await _exchange(port, _request(
+            "POST", "/telegram", body, {"X-Telegram-Bot-Api-Secret-Token": "wrong"}))
+        assert status == 403
+        assert app.update_queue.empty()
+    _run(scenario)
+
+@pytest.mark.parametrize("length, expected", [("abc", 400), ("-1", 400), (str(webhook_server.MAX_BODY_BYTES + 1), 413)])
+def test_bad_content_length(length, expected):
+    async def scenario(app, port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"POST /telegram HTTP/1.1\r\nContent-Length: {length}\r\n\r\n".encode())
+        await writer.drain()
+        status, headers, _ = await _read_response(reader)
+        assert status == expected
+        assert headers["connection"] == "close"
+        assert await reader.read() == b""  # сервер закрыл соединение
+        writer.close()
+    _run(scenario)
+
+def test_keep_alive_connection_serves_several_requests():
+    async def scenario(app, port):
+        body = json.dumps(UPDATE).encode()
+        post = _request("POST", "/telegram", body, {"X-Telegram-Bot-Api-Secret-Token": SECRET})
+        responses = await _exchange(port, post, post, _request("GET", "/health"))
+        assert [status for status, _, _ in responses] == [200, 200, 200]
+        assert all(headers["connection"] == "keep-alive" for _, headers, _ in responses)
+        assert app.update_queue.qsize() == 2
+    _run(scenario)
+
+def test_health():
+    async def scenario(app, port):
+        [(status, headers, body)] = await _exchange(port, _request("GET", "/health"))
+        assert status == 200
+        assert headers["content-type"] == "application/json"
+        assert json.loads(body) == {"status": "ok", "running": True, "update_queue": 0, "answer": 42}
+    _run(scenario)
+
+def test_unknown_route_is_404():
+    async def scenario(app, port):
+        [(status, _, _)] = await _exchange(port, _request("GET", "/nope"))
+        assert status == 404
+    _run(scenario)
@@ -0,0 +1,240 @@
+# Отложенные действия (напоминание и авто-отмена QR-оплаты и т.п.).
+# Одна фоновая задача спит до ближайшего срока в min-heap; постановка и отмена — O(log n)
+# и O(1): отменённые записи не ищутся в куче, а пропускаются при извлечении.
+# Сроки пишутся в SQLite пачками и поднимаются при старте, поэтому рестарт их не теряет;
+# просроченные за время простоя срабатывают сразу после запуска.
+# Сработавшие пачки обрабатываются отдельными задачами (не больше TIMERS_FIRE_CONCURRENCY
+# сразу), чтобы медленный обработчик не задерживал следующие сроки.
+import json
+import time
+import heapq
+import asyncio
+import sqlite3
+import logging
+import threading
+from itertools import count
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from config import TIMERS_DB_PATH, TIMERS_FIRE_CONCURRENCY
+
+# Сколько сработавших таймеров одного вида передаётся обработчику за раз
+FIRE_BATCH = 200
+# Запись на диск — не чаще, чем раз в столько секунд (все изменения за окно одной транзакцией)
+_FLUSH_DELAY = 0.5
+# Сколько при остановке ждать обработчики, которые уже запущены
+_STOP_GRACE_SECONDS = 10
+
+class Timer:
+    __slots__ = ("key", "kind", "due", "payload", "seq")
+
+    def __init__(self, key: str, kind: str, due: float, payload: dict, seq: int):
+        self.key = key
+        self.kind = kind
+        self.due = due  # unix time: переживает рестарт
+        self.payload = payload
+        self.seq = seq
+
+Handler = Callable[[object, List[Timer]], Awaitable[None]]
+
+_handlers: Dict[str, Handler] = {}
+_timers: Dict[str, Timer] = {}
+_heap: List[Tuple[float, int, str]] = []  # (срок, seq, ключ); seq отличает перепоставленный таймер
+_seq = count()
+_wakeup: Optional[asyncio.Event] = None
+_task: Optional[asyncio.Task] = None
+_slots: Optional[asyncio.Semaphore] = None
+_firing: Set[asyncio.Task] = set()
+_app = None
+fired_total = 0
+
+_db: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()
+_dirty: Dict[str, Optional[Timer]] = {}  # ключ -> таймер для записи или None для удаления
+_flush_task: Optional[asyncio.Task] = None
+
+def register(kind: str, handler: Handler):
+    """handler(app, timers) получает пачку сработавших таймеров одного вида."""
+    _handlers[kind] = handler
+
+# ---------- Хранение ----------
+
+def _connect() -> Optional[sqlite3.Connection]:
+    global _db
+    if _db is None and TIMERS_DB_PATH:
+        _db = sqlite3.connect(TIMERS_DB_PATH, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS timers ("
+            " key TEXT PRIMARY KEY, kind TEXT NOT NULL, due REAL NOT NULL, payload TEXT NOT NULL)"
+        )
+    return _db
+
+def load():
+    """Поднимает отложенные сроки с прошлого запуска."""
+    try:
+        db = _connect()
+        if db is None:
+            return
+        with _db_lock:
+            rows = db.execute("SELECT key, kind, due, payload FROM timers").fetchall()
+    except sqlite3.Error:
+        logging.exception("Timers DB %s is unreadable, starting empty", TIMERS_DB_PATH)
+        return
+    for key, kind, due, payload in rows:
+        _push(Timer(key, kind, due, json.loads(payload), next(_seq)))
+    logging.info("Timers: %d pending deadlines restored", len(rows))
+
+def _write(changes: Dict[str, Optional[Timer]]):
+    db = _connect()
+    if db is None:
+        return
+    with _db_lock, db:
+        db.executemany(
+            "INSERT OR REPLACE INTO timers VALUES (?, ?, ?, ?)",
+            [(t.key, t.kind, t.due, json.dumps(t.payload)) for t in changes.values() if t is not None],
+        )
+        db.executemany("DELETE FROM timers WHERE key = ?", [(k,) for k, t in changes.items() if t is None])
+
+async def _flush():
+    global _dirty
+    await asyncio.sleep(_FLUSH_DELAY)
+    while _dirty:
+        changes, _dirty = _dirty, {}
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, _write, changes)
+        except sqlite3.Error:
+            logging.exception("Timers DB write failed, will retry")
+            for key, t in changes.items():
+                _dirty.setdefault(key, t)
+            await asyncio.sleep(5)
+
+def _mark(key: str, timer: Optional[Timer]):
+    global _flush_task
+    if not TIMERS_DB_PATH:
+        return
+    _dirty[key] = timer
+    if _flush_task is None or _flush_task.done():
+        try:
+            _flush_task = asyncio.get_running_loop().create_task(_flush())
+        except RuntimeError:
+            pass  # вне цикла событий (load при старте) — запишется вместе со следующими
+
+# ---------- Постановка и отмена ----------
+
+def _push(timer: Timer):
+    _timers[timer.key] = timer
+    heapq.heappush(_heap, (timer.due, timer.seq, timer.key))
+
+def schedule(key: str, kind: str, delay: float, payload: Optional[dict] = None):
+    """Ставит (или переставляет) таймер key через delay секунд."""
+    timer = Timer(key, kind, time.time() + delay, payload or {}, next(_seq))
+    earliest = _heap[0][0] if _heap else None
+    _push(timer)
+    _mark(key, timer)
+    if _wakeup is not None and (earliest is None or timer.due < earliest):
+        _wakeup.set()
+    _compact()
+
+def cancel(*keys: str):
+    """Отмена: запись в куче остаётся и будет пропущена при извлечении."""
+    for key in keys:
+        if _timers.pop(key, None) is not None:
+            _mark(key, None)
+    _compact()
+
+def pending(key: str) -> bool:
+    return key in _timers
+
+def _compact():
+    # отменённые записи копятся в куче — пересобираем, когда их больше половины
+    if len(_heap) > 1024 and len(_heap) > 2 * len(_timers):
+        _heap[:] = [(t.due, t.seq, t.key) for t in _timers.values()]
+        heapq.heapify(_heap)
+
+# ---------- Срабатывание ----------
+
+def _pop_due(now: float) -> List[Timer]:
+    due = []
+    while _heap and _heap[0][0] <= now:
+        _, seq, key = heapq.heappop(_heap)
+        timer = _timers.get(key)
+        if timer is None or timer.seq != seq:
+            continue  # отменён или переставлен
+        del _timers[key]
+        _mark(key, None)
+        due.append(timer)
+    return due
+
+async def _run(kind: str, handler: Handler, batch: List[Timer]):
+    try:
+        await handler(_app, batch)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logging.exception("Timer handler %s failed", kind)
+    finally:
+        _slots.release()
+
+async def _fire(timers: List[Timer]):
+    """Раздаёт пачки обработчикам; ждёт только свободного места, а не их завершения."""
+    global fired_total
+    by_kind: Dict[str, List[Timer]] = {}
+    for t in timers:
+        by_kind.setdefault(t.kind, []).append(t)
+    for kind, batch in by_kind.items():
+        handler = _handlers.get(kind)
+        if handler is None:
+            logging.warning("No handler for %d timers of kind %s", len(batch), kind)
+            continue
+        for i in range(0, len(batch), FIRE_BATCH):
+            await _slots.acquire()
+            task = asyncio.create_task(_run(kind, handler, batch[i:i + FIRE_BATCH]))
+            _firing.add(task)
+            task.add_done_callback(_firing.discard)
+    fired_total += len(timers)
+
+async def _sweeper():
+    while True:
+        _wakeup.clear()
+        due = _pop_due(time.time())
+        if due:
+            await _fire(due)
+            continue
+        timeout = _heap[0][0] - time.time() if _heap else None
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def start(app):
+    global _wakeup, _task, _slots, _app
+    _app = app
+    _wakeup = asyncio.Event()
+    _slots = asyncio.Semaphore(max(1, TIMERS_FIRE_CONCURRENCY))
+    _task = asyncio.create_task(_sweeper())
+    return _task
+
+async def stop():
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+    if _firing:
+        # сработавшие таймеры уже сняты с диска — даём обработчикам дойти до конца
+        _, late = await asyncio.wait(set(_firing), timeout=_STOP_GRACE_SECONDS)
+        for task in late:
+            task.cancel()
+        await asyncio.gather(*late, return_exceptions=True)
+    if _flush_task is not None:
+        _flush_task.cancel()
+        await asyncio.gather(_flush_task, return_exceptions=True)
+    if _dirty:
+        changes = dict(_dirty)
+        _dirty.clear()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, _write, changes)
+        except sqlite3.Error:
+            logging.exception("Timers DB write failed on shutdown")
+
+def stats() -> dict:
+    return {"pending": len(_timers), "heap": len(_heap), "firing": len(_firing), "fired": fired_total}
@@ -1,4 +1,8 @@
+import time
+import asyncio
+import logging
 from telegram import ReplyKeyboardMarkup, KeyboardButton
+from config import DELETE_CONCURRENCY, MESSAGE_IDS_MAX
 
 # Базовая клавиатура в одном месте
 BASE_KEYBOARD = [
@@ -7,14 +11,70 @@ BASE_KEYBOARD = [
     [KeyboardButton("🔁 Повторить заказ")]
 ]
 
+# Telegram даёт удалять сообщения бота только в течение 48 часов (берём с запасом)
+DELETE_WINDOW_SECONDS = 48 * 3600 - 300
+# deleteMessages принимает не больше 100 идентификаторов за вызов
+DELETE_BATCH_SIZE = 100
+
 def base_reply_markup():
     return ReplyKeyboardMarkup(BASE_KEYBOARD, resize_keyboard=True)
 
-async def delete_all_bot_messages(context, chat_id: int):
-    """Удаляем все сохранённые ботом сообщения для чистоты чата."""
-    for msg_id in context.user_data.get("message_ids", []):
+def track_message(user_data: dict, message):
+    """Запоминает сообщение бота (id и время отправки), чтобы потом убрать его из чата."""
+    sent_at = message.date.timestamp() if getattr(message, "date", None) else time.time()
+    ids = user_data.setdefault("message_ids", [])
+    ids.append([message.message_id, sent_at])
+    if len(ids) > MESSAGE_IDS_MAX:
+        # самые старые уже не удалить или почти не удалить — не копим их бесконечно
+        del ids[:len(ids) - MESSAGE_IDS_MAX]
+
+def _deletable_ids(entries) -> list:
+    """id сообщений, которые ещё можно удалить; старше 48 ч — отбрасываем без запроса к API."""
+    cutoff = time.time() - DELETE_WINDOW_SECONDS
+    ids = []
+    for entry in entries:
+        if isinstance(entry, (list, tuple)):
+            msg_id, sent_at = entry
+            if sent_at < cutoff:
+                continue
+        else:
+            msg_id = entry  # старый формат — только id
+        ids.append(msg_id)
+    return ids
+
+async def _delete_one_by_one(bot, chat_id: int, ids: list):
+    """Запасной путь: параллельные одиночные delete_message с ограничением одновременности."""
+    sem = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+    async def one(msg_id):
+        async with sem:
+            try:
+                await bot.delete_message(chat_id, msg_id)
+            except Exception:
+                pass
+
+    await asyncio.gather(*(one(m) for m in ids))
+
+async def delete_messages(bot, chat_id: int, ids: list):
+    """Удаляет сообщения пачками по 100 через deleteMessages, при ошибке — по одному."""
+    for i in range(0, len(ids), DELETE_BATCH_SIZE):
+        chunk = ids[i:i + DELETE_BATCH_SIZE]
         try:
-            await context.bot.delete_message(chat_id, msg_id)
-        except Exception:
-            pass
+            await bot.delete_messages(chat_id, chunk)
+        except Exception as e:
+            logging.debug("deleteMessages failed (%r), falling back to single deletes", e)
+            await _delete_one_by_one(bot, chat_id, chunk)
+
+async def delete_all_bot_messages(context, chat_id: int, background: bool = False):
+    """
+    Удаляем все сохранённые ботом сообщения для чистоты чата.
+    background=True — удаление идёт фоновой задачей, и новый экран показывается сразу.
+    """
+    ids = _deletable_ids(context.user_data.get("message_ids", []))
     context.user_data["message_ids"] = []
+    if not ids:
+        return
+    if background:
+        context.application.create_task(delete_messages(context.bot, chat_id, ids))
+    else:
+        await delete_messages(context.bot, chat_id, ids)
@@ -0,0 +1,157 @@
+# Порядок обработки апдейтов: у одного пользователя — строго по очереди,
+# между разными пользователями — параллельно (до UPDATE_CONCURRENCY одновременно).
+# Корзина, message_ids и флаги оформления заказа меняются без гонок между быстрыми нажатиями.
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, AsyncContextManager, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from config import UPDATE_CONCURRENCY, UPDATE_MAX_PENDING_PER_USER
+
+# Семафор базового класса берётся ДО очереди пользователя; если бы он был настоящим
+# лимитом, ждущие своей очереди апдейты одного пользователя занимали бы общие слоты.
+# Поэтому у базового класса — только предохранитель, а настоящий лимит — после очереди.
+_ADMISSION_LIMIT = 10000
+
+# Схлопывать можно только кнопки, повторное нажатие которых ничего не меняет
+# (листание, «назад», оплата, кнопки QR и доски оператора). «Добавить», «+» и «−»
+# нажатые дважды — это два действия пользователя, их выполняем оба.
+_IDEMPOTENT_TAPS = ("pg:", "back", "clear", "del:", "checkout", "pay:", "qr_", "board:")
+
+class _UserQueue:
+    __slots__ = ("lock", "pending", "taps")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # asyncio.Lock будит ожидающих в порядке очереди
+        self.pending = 0
+        self.taps: Set[Tuple[int, str]] = set()  # ещё не начатые нажатия (сообщение, data)
+
+def _user_key(update: object) -> Optional[int]:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+def _tap_key(update: Update) -> Optional[Tuple[int, str]]:
+    query = update.callback_query
+    if query is None or query.message is None:
+        return None
+    return query.message.message_id, query.data or ""
+
+def _mergeable(tap: Optional[Tuple[int, str]]) -> bool:
+    return tap is not None and tap[1].startswith(_IDEMPOTENT_TAPS)
+
+def _ack(update: Update, text: Optional[str] = None):
+    """Снимает «часики» с кнопки, нажатие по которой не будет обработано."""
+    async def answer():
+        try:
+            await update.callback_query.answer(text)
+        except Exception:
+            pass
+    asyncio.get_running_loop().create_task(answer())
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейты одного пользователя выполняются по одному в порядке поступления.
+    Повторное нажатие той же идемпотентной кнопки (_IDEMPOTENT_TAPS), пока предыдущее
+    ещё ждёт очереди, схлопывается;
+    если у пользователя в очереди уже UPDATE_MAX_PENDING_PER_USER апдейтов, новые
+    нажатия кнопок отбрасываются (текстовые сообщения не теряются никогда).
+    """
+
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY, max_pending: int = UPDATE_MAX_PENDING_PER_USER):
+        super().__init__(max_concurrent_updates=_ADMISSION_LIMIT)
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self._running = asyncio.Semaphore(concurrency)
+        self._queues: Dict[int, _UserQueue] = {}
+        self._wait_ms: deque = deque(maxlen=1000)
+        self.processed = 0
+        self.merged = 0
+        self.dropped = 0
+        # обёртка вокруг обработки апдейта пользователя (общее хранилище: блокировка и запись)
+        self.guard: Optional[Callable[[Update], AsyncContextManager]] = None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._queues.clear()
+
+    async def do_process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        key = _user_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = _UserQueue()
+        tap = _tap_key(update)
+        merge = _mergeable(tap)
+        if tap is not None:
+            if merge and tap in queue.taps:
+                self.merged += 1
+                coroutine.close()
+                _ack(update)
+                return
+            if queue.pending >= self.max_pending:
+                self.dropped += 1
+                coroutine.close()
+                _ack(update, "Секунду, обрабатываем предыдущие нажатия…")
+                return
+            if merge:
+                queue.taps.add(tap)
+
+        queued_at = time.monotonic()
+        queue.pending += 1
+        try:
+            async with queue.lock:
+                if merge:
+                    queue.taps.discard(tap)
+                async with self._running:
+                    self._wait_ms.append(int((time.monotonic() - queued_at) * 1000))
+                    if self.guard is None:
+                        await coroutine
+                    else:
+                        async with self.guard(update):
+                            await coroutine
+                    self.processed += 1
+        finally:
+            queue.pending -= 1
+            if merge:
+                queue.taps.discard(tap)
+            if queue.pending == 0 and self._queues.get(key) is queue:
+                del self._queues[key]
+
+    def stats(self) -> dict:
+        """Ожидание в очереди (мс) по последним 1000 апдейтам и счётчики."""
+        result = {
+            "processed": self.processed,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "users_queued": len(self._queues),
+            "waiting": sum(q.pending for q in self._queues.values()),
+        }
+        if self._wait_ms:
+            data = sorted(self._wait_ms)
+            result.update({
+                "wait_p50_ms": data[len(data) // 2],
+                "wait_p95_ms": data[min(len(data) - 1, int(len(data) * 0.95))],
+                "wait_max_ms": data[-1],
+            })
+        return result
+
+    async def log_stats_loop(self, interval: float = 300):
+        """Периодически пишет метрики очереди в лог."""
+        while True:
+            await asyncio.sleep(interval)
+            logging.info("Update queue: %s", self.stats())
@@ -0,0 +1,216 @@
+# Встроенный асинхронный HTTP-сервер для режима webhook (BOT_MODE=webhook).
+# Минимальный HTTP/1.1 на asyncio streams: keep-alive, тела только с Content-Length
+# (так шлют и Telegram, и ЮKassa). Маршруты регистрируются через add_route().
+import json
+import hmac
+import asyncio
+import logging
+import ipaddress
+from http import HTTPStatus
+from urllib.parse import urlsplit
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from telegram import Update
+
+from config import WEBHOOK_TRUSTED_PROXIES
+
+MAX_BODY_BYTES = 1 << 20
+HEADER_TIMEOUT_SECONDS = 30
+KEEPALIVE_TIMEOUT_SECONDS = 75
+
+class Request:
+    __slots__ = ("method", "path", "query", "headers", "body", "remote")
+
+    def __init__(self, method: str, path: str, query: str, headers: Dict[str, str], body: bytes, remote: str):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+        self.remote = remote
+
+    def json(self):
+        return json.loads(self.body.decode("utf-8"))
+
+Response = Tuple[int, bytes, str]  # статус, тело, content-type
+Handler = Callable[[Request], Awaitable[Response]]
+
+def json_response(status: int, payload) -> Response:
+    return status, json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json"
+
+# ---------- Адрес клиента ----------
+
+_trust_any_peer = WEBHOOK_TRUSTED_PROXIES.strip() == "*"
+_trusted_proxies = [] if _trust_any_peer else [
+    ipaddress.ip_network(part.strip()) for part in WEBHOOK_TRUSTED_PROXIES.split(",") if part.strip()
+]
+
+def _trusted(addr: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return False
+    return any(ip in net for net in _trusted_proxies)
+
+def client_address(peer: str, forwarded_for: str) -> str:
+    """
+    Адрес клиента для проверок по IP. X-Forwarded-For пишет кто угодно, поэтому он
+    учитывается, только если соединение пришло от доверенного балансировщика, и
+    берётся справа налево первый недоверенный адрес — левые записи подставляет клиент.
+    """
+    if not forwarded_for or not (_trust_any_peer or _trusted(peer)):
+        return peer
+    hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _trusted(hop):
+            return hop
+    return hops[0] if hops else peer
+
+_routes: Dict[Tuple[str, str], Handler] = {}
+
+def add_route(method: str, path: str, handler: Handler):
+    """Регистрирует обработчик: например, уведомления ЮKassa на том же порту."""
+    _routes[(method.upper(), path)] = handler
+
+_health_providers: Dict[str, Callable[[], Any]] = {}
+
+def add_health_provider(name: str, provider: Callable[[], Any]):
+    """Регистрирует раздел /health: подсистема сама отдаёт свои метрики, сервер о ней не знает."""
+    _health_providers[name] = provider
+
+async def _write(writer, status: int, body: bytes, ctype: str, keep_alive: bool):
+    reason = HTTPStatus(status).phrase if status in HTTPStatus._value2member_map_ else ""
+    head = (
+        f"HTTP/1.1 {status} {reason}\r\n"
+        f"Content-Type: {ctype}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    peer = writer.get_extra_info("peername")
+    remote = peer[0] if peer else ""
+    first = True
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(
+                    reader.readuntil(b"\r\n\r\n"),
+                    HEADER_TIMEOUT_SECONDS if first else KEEPALIVE_TIMEOUT_SECONDS,
+                )
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                return
+            first = False
+            lines = head.decode("latin-1").split("\r\n")
+            try:
+                method, target, version = lines[0].split(" ", 2)
+            except ValueError:
+                await _write(writer, 400, b"", "text/plain", False)
+                return
+            headers: Dict[str, str] = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    k, v = line.split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+
+            if "chunked" in headers.get("transfer-encoding", "").lower():
+                await _write(writer, 411, b"", "text/plain", False)
+                return
+            try:
+                length = int(headers.get("content-length") or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                await _write(writer, 400, b"", "text/plain", False)
+                return
+            if length > MAX_BODY_BYTES:
+                await _write(writer, 413, b"", "text/plain", False)
+                return
+            body = await reader.readexactly(length) if length else b""
+
+            url = urlsplit(target)
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            client = client_address(remote, headers.get("x-forwarded-for", ""))
+            handler = _routes.get((method.upper(), url.path))
+            if handler is None:
+                status, payload, ctype = 404, b"", "text/plain"
+            else:
+                try:
+                    status, payload, ctype = await handler(Request(method.upper(), url.path, url.query, headers, body, client))
+                except Exception:
+                    logging.exception("Webhook handler %s %s failed", method, url.path)
+                    status, payload, ctype = 500, b"", "text/plain"
+            await _write(writer, status, payload, ctype, keep_alive)
+            if not keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+# ---------- Telegram ----------
+
+def install_telegram_routes(app, path: str, secret: str):
+    """
+    POST path — апдейты Telegram: проверяем секретный заголовок, кладём апдейт в очередь
+    PTB и сразу отвечаем 200 (обработка идёт параллельно, с concurrent_updates).
+    GET /health — для балансировщика и мониторинга.
+    """
+
+    async def telegram_update(request: Request) -> Response:
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token, secret):
+            return 403, b"", "text/plain"
+        try:
+            update = Update.de_json(request.json(), app.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400, b"", "text/plain"
+        await app.update_queue.put(update)
+        return 200, b"", "text/plain"
+
+    async def health(request: Request) -> Response:
+        body = {
+            "status": "ok",
+            "running": app.running,
+            "update_queue": app.update_queue.qsize(),
+        }
+        for name, provider in _health_providers.items():
+            try:
+                body[name] = provider()
+            except Exception:
+                logging.exception("Health provider %s failed", name)
+                body[name] = None
+        return json_response(200, body)
+
+    add_route("POST", path, telegram_update)
+    add_route("GET", "/health", health)
+
+class Server:
+    def __init__(self):
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set["asyncio.Task"] = set()
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            await _handle_connection(reader, writer)
+        except asyncio.CancelledError:
+            pass  # остановка сервера: висящие keep-alive соединения просто закрываем
+        finally:
+            self._connections.discard(task)
+
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._serve, host, port, limit=64 * 1024)
+        logging.info("Webhook server listening on %s:%d", host, port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None